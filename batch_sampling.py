@@ -0,0 +1,112 @@
+"""
+Batches of users with similar numbers of posts under a post budget
+
+With a fixed batch size, shuffled batches mix users with a few posts and users with thousands of posts, so most of
+the padded batch is padding and the memory peak of a batch depends on its heaviest users.
+`PostBudgetBatchSampler` sorts users by their (noisy) number of posts into buckets and fills every batch until
+batch size x longest user in the batch would exceed the post budget; the batch order is shuffled every epoch.
+
+Post counts come from the packed post store or the posts index (data_loader.user_post_counts) or, for head-only
+training, from the embedding shards, so no posts are loaded to form the batches.
+"""
+import logging
+import random
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from allennlp.data.instance import Instance
+from allennlp.data.samplers import BatchSampler
+
+import data_loader
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_POST_BUDGET = 128 * 200
+
+
+@BatchSampler.register("post_budget")
+class PostBudgetBatchSampler(BatchSampler):
+    """
+    :param post_budget: maximum of batch size x number of posts of the heaviest user in the batch
+    :param max_post_count: posts counted per user at most, e.g., the number of representative posts the
+        sequences are reduced to (no limit if None)
+    :param max_batch_size: maximum number of users per batch (no limit if None)
+    :param padding_noise: relative noise added to the post counts before sorting, so that the batches change
+        every epoch
+    :param shuffle: shuffle the batch order (and add the padding noise)
+    :param embedding_shard_dir: count the posts of precomputed embedding shards (for head-only training)
+    :param post_counts: precomputed post counts per user id, looked up with data_loader.user_post_counts if None
+    """
+
+    def __init__(self,
+                 post_budget: int = DEFAULT_BATCH_POST_BUDGET,
+                 max_post_count: Optional[int] = None,
+                 max_batch_size: Optional[int] = None,
+                 padding_noise: float = 0.1,
+                 shuffle: bool = True,
+                 embedding_shard_dir: Optional[str] = None,
+                 post_counts: Optional[Dict[str, int]] = None,
+                 seed: Optional[int] = None) -> None:
+        self.post_budget = post_budget
+        self.max_post_count = max_post_count
+        self.max_batch_size = max_batch_size
+        self.padding_noise = padding_noise
+        self.shuffle = shuffle
+        self.embedding_shard_dir = embedding_shard_dir
+        self._post_counts: Dict[str, int] = dict(post_counts or {})
+        self._random = random.Random(seed)
+
+    def _load_post_counts(self, user_ids: List[str]):
+        missing_user_ids = [user_id for user_id in set(user_ids) if user_id not in self._post_counts]
+        if not missing_user_ids:
+            return
+        if self.embedding_shard_dir:
+            from embedding_shards import EmbeddingShardReader
+            embedding_shards = EmbeddingShardReader(self.embedding_shard_dir)
+            self._post_counts.update((user_id, embedding_shards.num_posts(user_id)) for user_id in missing_user_ids)
+        else:
+            self._post_counts.update(data_loader.user_post_counts(missing_user_ids))
+        logger.info("post counts of %s users loaded", len(missing_user_ids))
+
+    def _costs(self, instances: Sequence[Instance]) -> List[int]:
+        user_ids = [str(instance.fields["user_id"].metadata) for instance in instances]
+        self._load_post_counts(user_ids)
+        costs = []
+        for user_id in user_ids:
+            # users without posts are encoded as a single (zero) post
+            cost = max(self._post_counts.get(user_id, 0), 1)
+            costs.append(min(cost, self.max_post_count) if self.max_post_count else cost)
+        return costs
+
+    def _batches(self, costs: List[int], noisy: bool) -> List[List[int]]:
+        if noisy and self.padding_noise > 0:
+            sort_keys = [cost * (1 + self._random.uniform(-self.padding_noise, self.padding_noise))
+                         for cost in costs]
+        else:
+            sort_keys = costs
+        batches, batch, batch_max_cost = [], [], 0
+        for i in sorted(range(len(costs)), key=lambda j: sort_keys[j]):
+            max_cost = max(batch_max_cost, costs[i])
+            if batch and ((len(batch) + 1) * max_cost > self.post_budget or
+                          (self.max_batch_size and len(batch) >= self.max_batch_size)):
+                batches.append(batch)
+                batch, max_cost = [], costs[i]
+            batch.append(i)
+            batch_max_cost = max_cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def get_batch_indices(self, instances: Sequence[Instance]) -> Iterable[List[int]]:
+        batches = self._batches(self._costs(instances), noisy=self.shuffle)
+        if self.shuffle:
+            self._random.shuffle(batches)
+        for batch in batches:
+            yield batch
+
+    def get_num_batches(self, instances: Sequence[Instance]) -> int:
+        # without padding noise, the number of batches of an epoch differs slightly
+        return len(self._batches(self._costs(instances), noisy=False))
+
+    def get_batch_size(self) -> Optional[int]:
+        return self.max_batch_size
+
@@ -0,0 +1,75 @@
+"""
+Throughput comparison of post-by-post (`encode_content_manual`) and batched (`encode_contents_batched`)
+post encoding
+
+usage:
+    python benchmarks/bench_post_encoding.py --post_dir <post dir> --user_csv dev.csv --num_users 8
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import AutoTokenizer, AutoModel
+from allennlp.modules.seq2seq_encoders import PytorchSeq2SeqWrapper
+
+import data_loader
+from depression_classifier_778_clustering import encode_content_manual, encode_contents_batched, \
+    EMBEDDING_MODEL_NAME
+
+
+def load_posts(user_csv, num_users):
+    user_ids = pd.read_csv(user_csv, header=0, usecols=range(0, 2)).values[:num_users, 1]
+    return [post for user_id in user_ids for post in data_loader.load_user_posts(str(user_id))]
+
+
+def time_per_post_encoding(content_encoder, embedding_model, embedding_tokenizer, posts):
+    start = time.perf_counter()
+    embeddings = np.stack([encode_content_manual(content_encoder, embedding_model, embedding_tokenizer, post)
+                           for post in posts])
+    return time.perf_counter() - start, embeddings
+
+
+def time_batched_encoding(embedding_model, embedding_tokenizer, posts, batch_size):
+    start = time.perf_counter()
+    embeddings = encode_contents_batched(embedding_model, embedding_tokenizer, posts, batch_size=batch_size)
+    return time.perf_counter() - start, embeddings
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('--post_dir', dest="postdir", help="directory where posts are saved", default=None)
+    parser.add_option('--user_csv', dest="user_csv", help="csv file (label,user_id) of users to encode",
+                      default=os.path.join(os.path.dirname(__file__), '..', "dev.csv"))
+    parser.add_option('--num_users', dest="num_users", help="number of users to encode", default=8)
+    parser.add_option('--batch_sizes', dest="batch_sizes", help="comma separated mini-batch sizes",
+                      default="16,32,64,128")
+    options, args = parser.parse_args()
+
+    data_loader.post_data_dir = options.postdir
+    posts = load_posts(options.user_csv, int(options.num_users))
+    print("posts to encode: ", len(posts))
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    embedding_tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+    embedding_model = AutoModel.from_pretrained(EMBEDDING_MODEL_NAME).to(device)
+    embedding_model.eval()
+    content_encoder = PytorchSeq2SeqWrapper(torch.nn.LSTM(768, 768 * 2, num_layers=2, batch_first=True))
+
+    per_post_time, per_post_embeddings = time_per_post_encoding(
+        content_encoder, embedding_model, embedding_tokenizer, posts)
+    print("%-12s %10s %12s %14s" % ("path", "seconds", "posts/s", "max abs diff"))
+    print("%-12s %10.2f %12.1f %14s" % ("per-post", per_post_time, len(posts) / per_post_time, "-"))
+
+    for batch_size in [int(size) for size in options.batch_sizes.split(",")]:
+        batched_time, batched_embeddings = time_batched_encoding(
+            embedding_model, embedding_tokenizer, posts, batch_size)
+        max_abs_diff = np.abs(batched_embeddings - per_post_embeddings).max() if len(posts) else 0.0
+        print("%-12s %10.2f %12.1f %14.2e" % ("batch=%s" % batch_size, batched_time,
+                                              len(posts) / batched_time, max_abs_diff))
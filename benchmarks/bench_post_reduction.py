@@ -0,0 +1,117 @@
+"""
+Wall time and selection stability of the post reducers (post_reduction.py) against the original K-means
+selection (scikit-learn KMeans, n_init=10)
+
+Selections are compared by the Jaccard index of the selected post indices. Users are synthetic (clustered
+embeddings) unless --embedding_shard_dir is given, in which case the users of the shards with the most posts
+are used. Warm starts are measured on a second "epoch" over the same users.
+
+usage:
+    python benchmarks/bench_post_reduction.py --num_posts 500,2000,10000 --reducers kmeans,minibatch,torch
+    python benchmarks/bench_post_reduction.py --embedding_shard_dir shards/ --num_users 16 --workers 4
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+from post_reduction import PostReductionEngine, KMeansReducer, new_reducer, NUM_REPRESENTATIVE_POSTS
+
+
+def synthetic_user_embeddings(rng, num_posts, dim=768, num_topics=50):
+    # posts around a few topics, L2 normalised as the mean pooled encoder output
+    topics = rng.normal(size=(num_topics, dim))
+    embeddings = topics[rng.integers(num_topics, size=num_posts)] + 0.5 * rng.normal(size=(num_posts, dim))
+    return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+
+
+def shard_user_embeddings(embedding_shard_dir, num_users):
+    from embedding_shards import EmbeddingShardReader
+    shards = EmbeddingShardReader(embedding_shard_dir)
+    users = []
+    for user_id in shards.user_ids():
+        post_embeddings, _, _ = shards.load_user(user_id)
+        if len(post_embeddings) > NUM_REPRESENTATIVE_POSTS:
+            users.append((user_id, np.asarray(post_embeddings, dtype=np.float32)))
+    users.sort(key=lambda user: -len(user[1]))
+    return users[:num_users]
+
+
+def jaccard(selection_1, selection_2):
+    set_1, set_2 = set(selection_1.tolist()), set(selection_2.tolist())
+    return len(set_1 & set_2) / max(len(set_1 | set_2), 1)
+
+
+def timed_selections(engine, user_ids, post_embeddings_list):
+    start = time.perf_counter()
+    selections = engine.select_batch(user_ids, post_embeddings_list, NUM_REPRESENTATIVE_POSTS)
+    return time.perf_counter() - start, selections
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('--num_posts', dest="num_posts", help="comma separated numbers of posts per synthetic user",
+                      default="500,2000,10000")
+    parser.add_option('--num_users', dest="num_users", help="number of users per run", default=8)
+    parser.add_option('--embedding_shard_dir', dest="embedding_shard_dir",
+                      help="benchmark on the users of precomputed embedding shards instead of synthetic users",
+                      default=None)
+    parser.add_option('--reducers', dest="reducers", help="comma separated reducers to compare",
+                      default="kmeans,minibatch,torch")
+    parser.add_option('--projection_dim', dest="projection_dim",
+                      help="random projection dimension, the torch reducer is run with and without", default=64)
+    parser.add_option('--workers', dest="workers", help="processes of the parallel runs (0: in-process only)",
+                      default=4)
+    options, args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    num_users = int(options.num_users)
+    num_workers = int(options.workers)
+
+    if options.embedding_shard_dir:
+        user_sets = {"shards": shard_user_embeddings(options.embedding_shard_dir, num_users)}
+    else:
+        user_sets = {}
+        for num_posts in [int(n) for n in options.num_posts.split(",")]:
+            user_sets["%s posts" % num_posts] = [("user_%s" % i, synthetic_user_embeddings(rng, num_posts))
+                                                 for i in range(num_users)]
+
+    configurations = []
+    for reducer_name in options.reducers.split(","):
+        configurations.append((reducer_name, new_reducer(reducer_name)))
+        if reducer_name == "torch" and options.projection_dim:
+            configurations.append(("torch+proj%s" % options.projection_dim,
+                                   new_reducer(reducer_name, projection_dim=int(options.projection_dim))))
+
+    print("%-12s %-18s %10s %12s %12s %10s %10s" % ("users", "reducer", "seconds", "warm seconds",
+                                                     "parallel s", "jaccard", "warm jacc."))
+    for user_set_name, users in user_sets.items():
+        user_ids = [user_id for user_id, _ in users]
+        post_embeddings_list = [post_embeddings for _, post_embeddings in users]
+        reference_time, reference_selections = timed_selections(
+            PostReductionEngine(KMeansReducer()), user_ids, post_embeddings_list)
+        print("%-12s %-18s %10.3f %12s %12s %10s %10s" % (user_set_name, "original kmeans", reference_time,
+                                                          "-", "-", "1.000", "-"))
+
+        for name, reducer in configurations:
+            # cold run, then a warm started second epoch over the same users
+            engine = PostReductionEngine(reducer, warm_start=True)
+            cold_time, cold_selections = timed_selections(engine, user_ids, post_embeddings_list)
+            warm_time, warm_selections = timed_selections(engine, user_ids, post_embeddings_list)
+            parallel_time = float("nan")
+            if num_workers > 0:
+                parallel_engine = PostReductionEngine(reducer, num_workers=num_workers)
+                # first batch starts the worker processes
+                timed_selections(parallel_engine, user_ids[:2], post_embeddings_list[:2])
+                parallel_time, _ = timed_selections(parallel_engine, user_ids, post_embeddings_list)
+                parallel_engine.shutdown()
+            print("%-12s %-18s %10.3f %12.3f %12.3f %10.3f %10.3f" % (
+                user_set_name, name, cold_time, warm_time, parallel_time,
+                np.mean([jaccard(reference, selection)
+                         for reference, selection in zip(reference_selections, cold_selections)]),
+                np.mean([jaccard(cold, warm) for cold, warm in zip(cold_selections, warm_selections)])))
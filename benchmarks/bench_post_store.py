@@ -0,0 +1,75 @@
+"""
+Per-user post load latency and memory of the per-user json files and of the packed post store
+
+Every mode runs in a fresh process, so that peak RSS is not shared between modes.
+
+usage:
+    python benchmarks/bench_post_store.py --post_dir <post dir> --packed_dir <packed dir> --num_users 1000
+"""
+import os
+import sys
+import time
+import random
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+import data_loader
+from packed_posts import PackedPostStore
+
+
+def current_rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def run_mode(mode, post_data_dir, packed_dir, user_ids):
+    data_loader.post_data_dir = post_data_dir
+    if mode != "json":
+        data_loader.packed_post_store = PackedPostStore(packed_dir)
+    else:
+        data_loader.load_posts_dataset_dir(post_data_dir)
+    rss_before = current_rss_mb()
+
+    latencies = []
+    num_posts = 0
+    for user_id in user_ids:
+        start = time.perf_counter()
+        if mode == "packed (post set)":
+            user_post_set = data_loader.packed_post_store.load_user_post_set(user_id)
+            posts = user_post_set.texts() if user_post_set is not None else []
+        else:
+            posts = list(data_loader.load_user_posts(user_id))
+        latencies.append(time.perf_counter() - start)
+        num_posts += len(posts)
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    latencies = np.array(latencies) * 1000
+    return (mode, num_posts, latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95),
+            current_rss_mb() - rss_before, max_rss_mb)
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('--post_dir', dest="postdir", help="directory where posts are saved", default=None)
+    parser.add_option('--packed_dir', dest="packed_dir", help="directory of the packed post store", default=None)
+    parser.add_option('--num_users', dest="num_users", help="number of randomly sampled users", default=1000)
+    options, args = parser.parse_args()
+
+    data_loader.post_data_dir = options.postdir
+    all_user_ids = sorted(PackedPostStore(options.packed_dir).user_ids())
+    random.seed(42)
+    sampled_user_ids = random.sample(all_user_ids, min(int(options.num_users), len(all_user_ids)))
+
+    print("%-18s %10s %10s %10s %10s %14s %12s" % ("mode", "posts", "mean ms", "p50 ms", "p95 ms",
+                                                   "RSS delta MB", "max RSS MB"))
+    context = multiprocessing.get_context("spawn")
+    for mode in ["json", "packed", "packed (post set)"]:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_mode, (mode, options.postdir, options.packed_dir, sampled_user_ids))
+        print("%-18s %10d %10.3f %10.3f %10.3f %14.1f %12.1f" % result)
@@ -0,0 +1,114 @@
+"""
+Equivalence and speed of the numpy temporal sentiment features (temporal_features.py) against the original
+pure Python implementations of `calculate_metrics`
+
+usage:
+    python benchmarks/bench_temporal_features.py --num_posts 100,1000,10000,100000
+"""
+import os
+import sys
+import math
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+from temporal_features import sentiment_features, batch_sentiment_features, pad_score_sequences, \
+    MOMENTUM_WINDOW, MIN_POSTS_FOR_METRICS
+
+
+# original implementations (depression_classifier_778_clustering.py before temporal_features.py)
+def reference_sma(data, window_size):
+    sma = [sum(data[i - window_size + 1:i + 1]) /
+           window_size for i in range(window_size - 1, len(data))]
+    return [0] * (window_size - 1) + sma
+
+
+def reference_mean_momentum(data, window_size):
+    sma = reference_sma(data, window_size)
+    momentum = [(window_size + 1) * (sma[i - 1] - sma[i])
+                for i in range(window_size, len(data))]
+    return sum(momentum) / (len(data) - (window_size - 1))
+
+
+def reference_second_order_differencing(data, window_size):
+    sma = np.convolve(data, np.ones(window_size)/window_size, mode='valid')
+    return np.diff(np.diff(sma))
+
+
+def reference_entropy(data):
+    counts = Counter(data)
+    probabilities = [count / len(data) for count in counts.values()]
+    return -sum(p * math.log2(p) for p in probabilities)
+
+
+def reference_features(data_1, data_2):
+    if len(data_1) <= MIN_POSTS_FOR_METRICS:
+        return [0.0] * 10
+    window_size = MOMENTUM_WINDOW
+    return [np.mean(data_1), np.std(data_1), reference_entropy(data_1), reference_mean_momentum(data_1, window_size),
+            np.std(reference_second_order_differencing(data_1, window_size)),
+            np.mean(data_2), np.std(data_2), reference_entropy(data_2), reference_mean_momentum(data_2, window_size),
+            np.std(reference_second_order_differencing(data_2, window_size))]
+
+
+def random_vader_scores(rng, num_posts):
+    # VADER scores are rounded to 3 decimals, many posts score 0
+    scores = np.round(rng.beta(0.5, 3.0, size=num_posts), 3)
+    scores[rng.random(num_posts) < 0.4] = 0.0
+    return scores
+
+
+def timed(function, *args, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('--num_posts', dest="num_posts", help="comma separated numbers of posts per user",
+                      default="100,1000,10000,100000")
+    parser.add_option('--batch_users', dest="batch_users", help="number of users of the batched variant",
+                      default=128)
+    parser.add_option('--batch_lengths', dest="batch_lengths",
+                      help="comma separated ranges of posts per user of the batched variant", default="101-500,50-5000")
+    parser.add_option('--tolerance', dest="tolerance", help="absolute tolerance of the equivalence check",
+                      default=1e-9)
+    options, args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    tolerance = float(options.tolerance)
+
+    print("%-10s %14s %14s %10s %14s" % ("posts", "reference ms", "numpy ms", "speed-up", "max abs diff"))
+    for num_posts in [int(n) for n in options.num_posts.split(",")]:
+        data_1, data_2 = random_vader_scores(rng, num_posts), random_vader_scores(rng, num_posts)
+        # the reference implementation is O(n * window) in pure Python, run it once
+        reference_time, reference_result = timed(reference_features, data_1.tolist(), data_2.tolist())
+        numpy_time, numpy_result = timed(sentiment_features, data_1, data_2, repeat=10)
+        max_abs_diff = np.abs(np.array(reference_result) - np.array(numpy_result)).max()
+        assert max_abs_diff <= tolerance, "features differ by %s for %s posts" % (max_abs_diff, num_posts)
+        print("%-10d %14.3f %14.3f %10.1f %14.2e" % (num_posts, reference_time * 1000, numpy_time * 1000,
+                                                     reference_time / numpy_time, max_abs_diff))
+
+    # batched variant over padded users x posts matrices of mixed history lengths
+    num_users = int(options.batch_users)
+    for length_range in options.batch_lengths.split(","):
+        min_length, max_length = [int(length) for length in length_range.split("-")]
+        lengths = rng.integers(min_length, max_length, size=num_users)
+        pos_sequences = [random_vader_scores(rng, length) for length in lengths]
+        neg_sequences = [random_vader_scores(rng, length) for length in lengths]
+        per_user_time, per_user_result = timed(
+            lambda: np.array([sentiment_features(pos, neg) for pos, neg in zip(pos_sequences, neg_sequences)]))
+        padded_pos, padded_lengths = pad_score_sequences(pos_sequences)
+        padded_neg, _ = pad_score_sequences(neg_sequences)
+        batched_time, batched_result = timed(batch_sentiment_features, padded_pos, padded_neg, padded_lengths)
+        max_abs_diff = np.abs(per_user_result - batched_result).max()
+        assert max_abs_diff <= tolerance, "batched features differ by %s" % max_abs_diff
+        print("batched, %s users with %s posts: per-user %.3f ms, batched %.3f ms, max abs diff %.2e" % (
+            num_users, length_range, per_user_time * 1000, batched_time * 1000, max_abs_diff))
@@ -0,0 +1,113 @@
+"""
+Representative posts selected before encoding (proxy_selection.py) against post-encode K-means clustering
+
+For users with more than 200 posts, all posts are encoded once and compared by:
+    jaccard   -- overlap of the proxy selection with the post-encode selection
+    coverage  -- mean cosine similarity of every post to its closest selected post (post-encode / proxy)
+    encoded   -- fraction of the user's posts encoded with the proxy selection
+and the selection times. With --vocab_dir and --model_weights, a trained model is also evaluated on --test_set
+with post-encode clustering and with every proxy selection, to compare the downstream F1.
+
+usage:
+    python benchmarks/compare_proxy_selection.py --post_dir <post dir> --user_csv dev.csv --num_users 50
+    python benchmarks/compare_proxy_selection.py --post_dir <post dir> --vocab_dir <vocabulary> \
+        --model_weights <weights_best.th> --test_set test.csv
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import AutoTokenizer, AutoModel
+
+import data_loader
+from depression_classifier_778_clustering import encode_texts_batched, kmeans_representative_indices, \
+    load_classifier_from_archive, evaluation, EMBEDDING_MODEL_NAME
+from post_reduction import NUM_REPRESENTATIVE_POSTS
+from proxy_selection import ProxyPostSelector, PROXY_SELECTIONS
+
+
+def coverage(post_embeddings: np.ndarray, selected_indices: np.ndarray) -> float:
+    # embeddings are L2 normalised
+    return float((post_embeddings @ post_embeddings[selected_indices].T).max(axis=1).mean())
+
+
+def jaccard(selection_1, selection_2) -> float:
+    set_1, set_2 = set(np.asarray(selection_1).tolist()), set(np.asarray(selection_2).tolist())
+    return len(set_1 & set_2) / max(len(set_1 | set_2), 1)
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('--post_dir', dest="postdir", help="directory where posts are saved", default=None)
+    parser.add_option('--user_csv', dest="user_csv", help="csv file (label,user_id) of users to compare",
+                      default=os.path.join(os.path.dirname(__file__), '..', "dev.csv"))
+    parser.add_option('--num_users', dest="num_users", help="number of users with more than 200 posts to compare",
+                      default=50)
+    parser.add_option('--methods', dest="methods", help="comma separated proxy selections",
+                      default=",".join(PROXY_SELECTIONS))
+    parser.add_option('--vocab_dir', dest="vocab_dir", help="vocabulary of a trained model (F1 comparison)",
+                      default=None)
+    parser.add_option('--model_weights', dest="model_weights", help="weights of a trained model (F1 comparison)",
+                      default=None)
+    parser.add_option('--test_set', dest="test_set", help="csv file (label,user_id) of the F1 comparison",
+                      default=None)
+    options, args = parser.parse_args()
+
+    data_loader.post_data_dir = options.postdir
+    data_loader.load_posts_dataset_index(options.postdir)
+    proxy_selectors = [ProxyPostSelector(method) for method in options.methods.split(",")]
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    embedding_tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+    embedding_model = AutoModel.from_pretrained(EMBEDDING_MODEL_NAME).to(device)
+    embedding_model.eval()
+
+    results = {selector.method: [] for selector in proxy_selectors}
+    num_compared = 0
+    for user_id in pd.read_csv(options.user_csv, header=0, usecols=range(0, 2)).values[:, 1]:
+        if num_compared >= int(options.num_users):
+            break
+        post_set = data_loader.load_user_post_set(str(user_id))
+        if len(post_set) <= NUM_REPRESENTATIVE_POSTS:
+            continue
+        num_compared += 1
+        texts = post_set.texts()
+        with torch.no_grad():
+            post_embeddings = encode_texts_batched(embedding_model, embedding_tokenizer, texts)
+        start = time.perf_counter()
+        reference = kmeans_representative_indices(post_embeddings, num_clusters=NUM_REPRESENTATIVE_POSTS)
+        reference_seconds = time.perf_counter() - start
+        reference_coverage = coverage(post_embeddings, reference)
+        for selector in proxy_selectors:
+            start = time.perf_counter()
+            selected = selector.select(post_set.timestamps, texts)
+            results[selector.method].append((jaccard(reference, selected), reference_coverage,
+                                             coverage(post_embeddings, selected), len(selected) / len(post_set),
+                                             reference_seconds, time.perf_counter() - start))
+
+    print("users compared: ", num_compared)
+    print("%-10s %10s %22s %10s %14s %14s" % ("proxy", "jaccard", "coverage (enc./proxy)", "encoded",
+                                               "post-encode s", "proxy s"))
+    for method, user_results in results.items():
+        if not user_results:
+            continue
+        means = np.mean(np.array(user_results), axis=0)
+        print("%-10s %10.3f %10.3f / %9.3f %10.3f %14.3f %14.3f" % (method, means[0], means[1], means[2], means[3],
+                                                                     means[4], means[5]))
+
+    if options.vocab_dir and options.model_weights and options.test_set:
+        n_gpu = 0 if torch.cuda.is_available() else -1
+        model, _ = load_classifier_from_archive(options.vocab_dir, options.model_weights, n_gpu)
+        f1_scores = {"post-encode": evaluation(options.test_set, model, n_gpu).get("f1")}
+        for selector in proxy_selectors:
+            model.set_proxy_selector(selector)
+            f1_scores[selector.method] = evaluation(options.test_set, model, n_gpu).get("f1")
+        for name, f1 in f1_scores.items():
+            print("F1 (%s): %s" % (name, f1))
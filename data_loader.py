@@ -1,11 +1,19 @@
 # Utility module to load dataset
 import os
 import json
+import time
+import zlib
+import heapq
+import hashlib
 import pickle
+import random
+import threading
 
 import sys
-from typing import Generator, Dict, Text, List, Union
+from typing import Generator, Dict, Text, List, Union, Optional, Iterable, Tuple
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # to fix a weird crash due to "ValueError: failed to parse CPython sys.version '3.6.6 |Anaconda, Inc.| (default, Jun 28 2018, 11:27:44) [MSC v.1900 64 bit (AMD64)]'"
 # possible due to a bug on anaconda
@@ -25,6 +33,8 @@ try:
 except ValueError:  # Catch .index() method not finding a pipe
     pass
 
+import calendar
+import numpy as np
 import pandas as pd
 import csv
 from pprint import pprint as pp
@@ -60,43 +70,539 @@ def load_abs_path(data_path: str) -> str:
     return data_path
 
 
+POST_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def to_epoch_seconds(timestamp: Union[str, int, float]) -> int:
+    """
+    convert a post timestamp, either a '%Y-%m-%d %H:%M:%S' string (UTC) or seconds past Epoch, to seconds past Epoch
+    """
+    if isinstance(timestamp, str):
+        return calendar.timegm(datetime.strptime(timestamp, POST_TIMESTAMP_FORMAT).timetuple())
+    return int(timestamp)
+
+
+def epoch_seconds_to_str(epoch_seconds: int) -> str:
+    return datetime.utcfromtimestamp(int(epoch_seconds)).strftime(POST_TIMESTAMP_FORMAT)
+
+
+class UserPostSet(object):
+    """
+    compact posts of a user: int64 timestamps (seconds past Epoch, UTC) and UTF-8 encoded texts
+        in one buffer, where text i is text_buffer[text_offsets[i]:text_offsets[i + 1]]
+
+    The buffer can be a slice-able view (e.g., a memory-mapped packed post store), texts are decoded on access.
+    """
+    __slots__ = ('timestamps', 'text_buffer', 'text_offsets')
+
+    def __init__(self, timestamps: np.ndarray, text_buffer, text_offsets: np.ndarray):
+        self.timestamps = timestamps
+        self.text_buffer = text_buffer
+        self.text_offsets = text_offsets
+
+    @classmethod
+    def from_posts(cls, timestamps: List, texts: List[str]) -> 'UserPostSet':
+        encoded_texts = [text.encode('utf-8', errors='surrogatepass') for text in texts]
+        text_offsets = np.zeros(len(encoded_texts) + 1, dtype=np.int64)
+        text_offsets[1:] = np.cumsum(np.array([len(text) for text in encoded_texts], dtype=np.int64))
+        return cls(np.array([to_epoch_seconds(timestamp) for timestamp in timestamps], dtype=np.int64),
+                   b''.join(encoded_texts), text_offsets)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def text(self, i: int) -> str:
+        return bytes(self.text_buffer[self.text_offsets[i]:self.text_offsets[i + 1]]).decode(
+            'utf-8', errors='surrogatepass')
+
+    def texts(self) -> List[str]:
+        return [self.text(i) for i in range(len(self))]
+
+    @property
+    def nbytes(self) -> int:
+        """ size of the timestamps, offsets and the part of the text buffer used by this post set """
+        return int(self.timestamps.nbytes + self.text_offsets.nbytes +
+                   (self.text_offsets[-1] - self.text_offsets[0]))
+
+    def fingerprint(self) -> str:
+        """ hash of the timestamps and texts, identifies the post set (e.g., to detect new posts) """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(self.timestamps, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(self.text_offsets - self.text_offsets[0], dtype=np.int64).tobytes())
+        digest.update(bytes(self.text_buffer[self.text_offsets[0]:self.text_offsets[-1]]))
+        return digest.hexdigest()
+
+    def subset(self, indices) -> 'UserPostSet':
+        """ post set of the posts at the given indices, in the order of the indices """
+        indices = np.asarray(indices, dtype=np.int64)
+        return UserPostSet.from_posts(self.timestamps[indices].tolist(), [self.text(i) for i in indices])
+
+    def to_post_dicts(self) -> Generator[Dict, None, None]:
+        for i in range(len(self)):
+            yield {'timestamp': epoch_seconds_to_str(self.timestamps[i]), 'text': self.text(i)}
+
+
+class UserPostsCache(object):
+    """
+    LRU cache of parsed user post sets under a byte budget
+
+    Entries are keyed by user id and the mtime of the user's posts json, so a rewritten file is re-parsed.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: Dict[str, Tuple[int, UserPostSet]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: str, mtime: int) -> Optional[UserPostSet]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] != mtime:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id: str, mtime: int, user_post_set: UserPostSet):
+        entry_bytes = user_post_set.nbytes
+        if entry_bytes > self.max_bytes:
+            return
+        with self._lock:
+            previous_entry = self._entries.pop(user_id, None)
+            if previous_entry is not None:
+                self.current_bytes -= previous_entry[1].nbytes
+            while self._entries and self.current_bytes + entry_bytes > self.max_bytes:
+                _, (_, evicted_post_set) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_post_set.nbytes
+                self.evictions += 1
+            self._entries[user_id] = (mtime, user_post_set)
+            self.current_bytes += entry_bytes
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"users": len(self._entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+POST_SELECTION_RECENT = "recent"
+POST_SELECTION_STRATIFIED = "stratified"
+POST_SELECTIONS = [POST_SELECTION_RECENT, POST_SELECTION_STRATIFIED]
+# maximum number of time buckets of the stratified post selection, buckets are widened to stay under it
+STRATIFIED_MAX_BUCKETS = 32
+STRATIFIED_INITIAL_BUCKET_SECONDS = 24 * 3600
+POST_JSON_CHUNK_SIZE = 1 << 20
+
+
+class RecentPostSelector(object):
+    """
+    keep the max_posts most recent posts while posts are added one by one
+    """
+
+    def __init__(self, max_posts: int):
+        self.max_posts = max_posts
+        self._heap = []
+        self._seq = 0
+
+    def add(self, timestamp: int, item):
+        entry = (timestamp, self._seq, item)
+        self._seq += 1
+        if len(self._heap) < self.max_posts:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    def selected(self) -> List:
+        """ :return: kept items in the order they were added """
+        return [item for _, _, item in sorted(self._heap, key=lambda entry: entry[1])]
+
+
+class StratifiedPostSelector(object):
+    """
+    keep up to max_posts posts spread evenly over the user's history: posts are bucketed by time and a
+    reservoir sample of up to max_posts posts is kept per bucket. When there are more than
+    STRATIFIED_MAX_BUCKETS buckets, buckets are widened (doubled) and their reservoirs merged,
+    so at most STRATIFIED_MAX_BUCKETS * max_posts posts are held at any time.
+    """
+
+    def __init__(self, max_posts: int, seed: int = 42):
+        self.max_posts = max_posts
+        self.bucket_seconds = STRATIFIED_INITIAL_BUCKET_SECONDS
+        self._random = random.Random(seed)
+        # bucket key -> [number of posts seen, reservoir of (seq, item)]
+        self._buckets: Dict[int, list] = {}
+        self._seq = 0
+
+    def add(self, timestamp: int, item):
+        bucket_key = timestamp // self.bucket_seconds
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = [0, []]
+        bucket[0] += 1
+        if len(bucket[1]) < self.max_posts:
+            bucket[1].append((self._seq, item))
+        else:
+            position = self._random.randrange(bucket[0])
+            if position < self.max_posts:
+                bucket[1][position] = (self._seq, item)
+        self._seq += 1
+        if len(self._buckets) > STRATIFIED_MAX_BUCKETS:
+            self._widen_buckets()
+
+    def _merge_reservoirs(self, bucket_1: list, bucket_2: list) -> list:
+        num_seen = bucket_1[0] + bucket_2[0]
+        # number of posts taken from the first reservoir is hypergeometric, as in a sample of the merged posts
+        num_samples = min(self.max_posts, num_seen)
+        num_from_1 = 0
+        remaining_1, remaining_total = bucket_1[0], num_seen
+        for _ in range(num_samples):
+            if self._random.randrange(remaining_total) < remaining_1:
+                num_from_1 += 1
+                remaining_1 -= 1
+            remaining_total -= 1
+        return [num_seen, self._random.sample(bucket_1[1], num_from_1) +
+                self._random.sample(bucket_2[1], num_samples - num_from_1)]
+
+    def _widen_buckets(self):
+        while len(self._buckets) > STRATIFIED_MAX_BUCKETS:
+            self.bucket_seconds *= 2
+            widened_buckets = {}
+            for bucket_key in sorted(self._buckets):
+                widened_key = bucket_key // 2
+                if widened_key in widened_buckets:
+                    widened_buckets[widened_key] = self._merge_reservoirs(
+                        widened_buckets[widened_key], self._buckets[bucket_key])
+                else:
+                    widened_buckets[widened_key] = self._buckets[bucket_key]
+            self._buckets = widened_buckets
+
+    def selected(self) -> List:
+        """ :return: kept items in the order they were added, the same number from every bucket where possible """
+        reservoirs = [self._buckets[bucket_key][1] for bucket_key in sorted(self._buckets)]
+        quotas = [0] * len(reservoirs)
+        remaining = self.max_posts
+        open_buckets = [i for i, reservoir in enumerate(reservoirs) if reservoir]
+        while remaining > 0 and open_buckets:
+            share = max(1, remaining // len(open_buckets))
+            for i in list(open_buckets):
+                taken = min(share, len(reservoirs[i]) - quotas[i], remaining)
+                quotas[i] += taken
+                remaining -= taken
+                if quotas[i] == len(reservoirs[i]):
+                    open_buckets.remove(i)
+                if remaining == 0:
+                    break
+        kept = [entry for reservoir, quota in zip(reservoirs, quotas)
+                for entry in (reservoir if quota == len(reservoir) else self._random.sample(reservoir, quota))]
+        return [item for _, item in sorted(kept, key=lambda entry: entry[0])]
+
+
+def new_post_selector(max_posts: int, post_selection: str = POST_SELECTION_RECENT, seed: int = 42):
+    if post_selection == POST_SELECTION_RECENT:
+        return RecentPostSelector(max_posts)
+    if post_selection == POST_SELECTION_STRATIFIED:
+        return StratifiedPostSelector(max_posts, seed=seed)
+    raise ValueError("unknown post selection [%s], expected one of %s" % (post_selection, POST_SELECTIONS))
+
+
+def iter_post_json(post_json_path: str, chunk_size: int = POST_JSON_CHUNK_SIZE) -> Generator:
+    """
+    parse the elements of a posts json file (a json array) one by one, reading the file in chunks,
+        so that the whole file is never materialised
+    """
+    decoder = json.JSONDecoder()
+    with open(post_json_path, encoding='UTF-8', mode='r') as f:
+        buffer = f.read(chunk_size).lstrip()
+        end_of_file = len(buffer) == 0
+        if not buffer.startswith('['):
+            raise ValueError("posts json file [%s] is not a json array" % post_json_path)
+        position = 1
+        while True:
+            # skip whitespace and separators
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer, position)
+                # an element at the end of the buffer may be cut (e.g., a number), decode it again with more data
+                if end < len(buffer) or end_of_file:
+                    yield obj
+                    position = end
+                    continue
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+            chunk = f.read(chunk_size)
+            end_of_file = len(chunk) == 0
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def load_capped_post_set(post_json_path: str, max_posts: int, post_selection: str = POST_SELECTION_RECENT,
+                         seed: int = 42) -> UserPostSet:
+    """
+    stream a posts json file and keep at most max_posts posts while reading
+
+    :param post_json_path: posts json file, a list of [timestamp, text]
+    :param max_posts: maximum number of posts kept
+    :param post_selection: 'recent' (the most recent posts) or 'stratified' (time-stratified reservoir sample)
+    :param seed: seed of the stratified sampling
+    :return: UserPostSet of the kept posts, in file order
+    """
+    post_selector = new_post_selector(max_posts, post_selection, seed=seed)
+    for obj in iter_post_json(post_json_path):
+        post_selector.add(to_epoch_seconds(obj[0]), obj)
+    kept_objs = post_selector.selected()
+    return UserPostSet.from_posts([obj[0] for obj in kept_objs], [obj[1] for obj in kept_objs])
+
+
+def cap_post_set(user_post_set: UserPostSet, max_posts: int, post_selection: str = POST_SELECTION_RECENT,
+                 seed: int = 42) -> UserPostSet:
+    """
+    keep at most max_posts posts of a post set (e.g., from the packed post store)
+    """
+    if len(user_post_set) <= max_posts:
+        return user_post_set
+    post_selector = new_post_selector(max_posts, post_selection, seed=seed)
+    for i, timestamp in enumerate(user_post_set.timestamps.tolist()):
+        post_selector.add(timestamp, i)
+    return user_post_set.subset(post_selector.selected())
+
+
 posts_dataset_dir_dict = {}
 metaphors_dataset_dir_dict = {}
+# cap on the number of posts loaded per user (no cap if None), see load_capped_post_set
+max_posts_per_user = None
+post_selection = POST_SELECTION_RECENT
+# packed_posts.PackedPostStore to read posts from instead of the per-user json files (if set)
+packed_post_store = None
+# UserPostsCache of post sets parsed from the per-user json files (no caching if None)
+user_posts_cache = None
 
 
-def load_user_posts(user_id: Text) -> Generator[Dict, None, None]:
+def load_posts_dataset_dirs():
+    """
+    load the posts (and metaphors) dataset directories if not loaded yet
+    """
     global posts_dataset_dir_dict, metaphors_dataset_dir_dict, post_data_dir
 
     # Load the posts dataset directory if not loaded
     if len(posts_dataset_dir_dict) == 0:
         posts_dataset_dir_dict = load_posts_dataset_dir(post_data_dir)
 
-    # Load the metaphors dataset directory if not loaded
+    # metaphors ({user_id}_cm.json) are saved in the same directories as the posts
     if len(metaphors_dataset_dir_dict) == 0:
-        metaphors_dataset_dir_dict = load_posts_dataset_dir(post_data_dir)
+        metaphors_dataset_dir_dict = posts_dataset_dir_dict
+
+
+def load_user_post_set(user_id: Text) -> UserPostSet:
+    """
+    load the posts of a user with timestamps parsed once into an int64 array (seconds past Epoch)
+
+    :return: UserPostSet, empty if the user is not found
+    """
+    if packed_post_store is not None:
+        user_post_set = packed_post_store.load_user_post_set(user_id)
+        if user_post_set is None:
+            return UserPostSet.from_posts([], [])
+        if max_posts_per_user is not None:
+            user_post_set = cap_post_set(user_post_set, max_posts_per_user, post_selection,
+                                         seed=zlib.crc32(str(user_id).encode()))
+        return user_post_set
+
+    load_posts_dataset_dirs()
 
     # Get the directory for posts dataset
     posts_dataset_dir = posts_dataset_dir_dict.get(user_id)
 
-    # If the user_id is not found in the posts dataset, return an empty generator
+    # If the user_id is not found in the posts dataset, return an empty post set
     if not posts_dataset_dir:
-        return
+        return UserPostSet.from_posts([], [])
+
+    post_json_path = os.path.join(posts_dataset_dir, '{}.json'.format(user_id))
+    posts_cache = user_posts_cache
+    if posts_cache is not None:
+        post_json_mtime = os.stat(post_json_path).st_mtime_ns
+        user_post_set = posts_cache.get(user_id, post_json_mtime)
+        if user_post_set is not None:
+            return user_post_set
+
+    if max_posts_per_user is not None:
+        # bounded number of posts held while parsing, seeded by user for the same sample in every epoch
+        user_post_set = load_capped_post_set(post_json_path, max_posts_per_user, post_selection,
+                                             seed=zlib.crc32(str(user_id).encode()))
+    else:
+        # Load the user objects from the posts dataset
+        user_objs = load_post_json(post_json_path)
 
-    # Load the user objects from the posts dataset
-    user_objs = load_post_json(os.path.join(
-        posts_dataset_dir, '{}.json'.format(user_id)))
+        # timestamps are either '%Y-%m-%d %H:%M:%S' strings or seconds past Epoch
+        user_post_set = UserPostSet.from_posts([obj[0] for obj in user_objs], [obj[1] for obj in user_objs])
+    if posts_cache is not None:
+        posts_cache.put(user_id, post_json_mtime, user_post_set)
+    return user_post_set
+
+
+POST_COUNT_SAMPLE_SIZE = 32
+# posts per byte of posts json, calibrated on a sample of users of the posts index
+_posts_per_json_byte = None
+
+
+def _calibrate_posts_per_json_byte(posts_index: Dict[str, Dict], sample_size: int = POST_COUNT_SAMPLE_SIZE) -> float:
+    user_ids = sorted(user_id for user_id, user_entry in posts_index.items() if user_entry.get('size'))
+    sampled_user_ids = random.Random(42).sample(user_ids, min(sample_size, len(user_ids)))
+    num_posts, num_bytes = 0, 0
+    for user_id in sampled_user_ids:
+        user_entry = posts_index[user_id]
+        num_posts += sum(1 for _ in iter_post_json(os.path.join(user_entry['dir'], '{}.json'.format(user_id))))
+        num_bytes += user_entry['size']
+    return num_posts / num_bytes if num_bytes > 0 else 0.0
+
+
+def user_post_counts(user_ids: Iterable) -> Dict[str, int]:
+    """
+    number of posts loaded per user (after the max_posts_per_user cap), without loading the posts:
+        exact from the packed post store, or estimated from the size of the posts json in the posts index
 
+    :return: {user id: number of posts}, 0 for unknown users
+    """
+    global _posts_per_json_byte
+    user_ids = [str(user_id) for user_id in user_ids]
+    if packed_post_store is not None:
+        post_counts = {user_id: packed_post_store.num_posts(user_id) for user_id in user_ids}
+    else:
+        posts_index = load_posts_dataset_index(post_data_dir, refresh=False)
+        if _posts_per_json_byte is None:
+            _posts_per_json_byte = _calibrate_posts_per_json_byte(posts_index)
+        post_counts = {user_id: int(round(posts_index[user_id].get('size', 0) * _posts_per_json_byte))
+                       if user_id in posts_index else 0 for user_id in user_ids}
+    if max_posts_per_user is not None:
+        post_counts = {user_id: min(post_count, max_posts_per_user) for user_id, post_count in post_counts.items()}
+    return post_counts
+
+
+DEFAULT_POST_LOADER_WORKERS = 8
+
+
+def _timed_load_user_post_set(user_id: Text) -> Tuple[UserPostSet, float]:
+    start = time.perf_counter()
+    return load_user_post_set(user_id), time.perf_counter() - start
+
+
+class UserPostPrefetcher(object):
+    """
+    load the post sets of users on a bounded thread pool
+
+    Users of the next batch can be submitted with `prefetch` while the current batch is encoded,
+    `fetch` then only waits for loads that are not done yet.
+    """
+
+    def __init__(self, num_workers: int = DEFAULT_POST_LOADER_WORKERS, max_pending: int = 1024):
+        """
+        :param num_workers: number of loader threads
+        :param max_pending: maximum number of prefetched users kept until fetched, the oldest are dropped first
+        """
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="post_loader")
+        self._pending: Dict[str, Future] = OrderedDict()
+        self._lock = threading.Lock()
+        # cumulative timing of all fetches, in seconds
+        self.load_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.last_load_seconds = 0.0
+        self.last_wait_seconds = 0.0
+
+    def _submit(self, user_id: str) -> Future:
+        future = self._pending.get(user_id)
+        if future is None:
+            future = self._executor.submit(_timed_load_user_post_set, user_id)
+            self._pending[user_id] = future
+        return future
+
+    def prefetch(self, user_ids: Iterable):
+        """
+        start loading the posts of users in the background
+        """
+        # the directory index is loaded once here rather than concurrently by the loader threads
+        if packed_post_store is None:
+            load_posts_dataset_dirs()
+        with self._lock:
+            for user_id in user_ids:
+                self._submit(str(user_id))
+            while len(self._pending) > self.max_pending:
+                _, dropped_future = self._pending.popitem(last=False)
+                dropped_future.cancel()
+
+    def discard(self, user_ids: Iterable):
+        """
+        drop prefetched users that are not going to be fetched
+        """
+        with self._lock:
+            for user_id in user_ids:
+                future = self._pending.pop(str(user_id), None)
+                if future is not None:
+                    future.cancel()
+
+    def fetch(self, user_ids: List) -> Tuple[List[Optional[UserPostSet]], Dict[str, Exception]]:
+        """
+        load the posts of users concurrently, reusing prefetched loads
+
+        :param user_ids: user ids
+        :return: post sets in the order of user_ids (None for users that failed to load),
+            {user id: error} of failed users
+        """
+        user_ids = [str(user_id) for user_id in user_ids]
+        if packed_post_store is None:
+            load_posts_dataset_dirs()
+        with self._lock:
+            futures = [self._pending.pop(user_id, None) or
+                       self._executor.submit(_timed_load_user_post_set, user_id) for user_id in user_ids]
+
+        post_sets, errors = [], {}
+        load_seconds = 0.0
+        start = time.perf_counter()
+        for user_id, future in zip(user_ids, futures):
+            try:
+                user_post_set, user_load_seconds = future.result()
+            except Exception as err:
+                errors[user_id] = err
+                post_sets.append(None)
+                continue
+            post_sets.append(user_post_set)
+            load_seconds += user_load_seconds
+        self.last_wait_seconds = time.perf_counter() - start
+        self.last_load_seconds = load_seconds
+        self.wait_seconds += self.last_wait_seconds
+        self.load_seconds += self.last_load_seconds
+        return post_sets, errors
+
+    def hidden_fraction(self) -> float:
+        """
+        fraction of the (summed) loading time that was not waited for, i.e., hidden behind compute
+            or overlapped by concurrent loads
+        """
+        if self.load_seconds <= 0:
+            return 0.0
+        return max(0.0, 1.0 - self.wait_seconds / self.load_seconds)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def load_user_posts(user_id: Text) -> Generator[Dict, None, None]:
     # Check if metaphors data is available for the user
     # If no metaphors data, yield the posts as they are
-    for obj in user_objs:
-        post_obj = {}
-        if bool(datetime.strptime(obj[0], '%Y-%m-%d %H:%M:%S')):
-            post_obj['timestamp'] = obj[0]
-        else:
-            post_obj['timestamp'] = datetime.utcfromtimestamp(
-                obj[0]).strftime('%Y-%m-%d %H:%M:%S')
-        post_obj['text'] = obj[1]
-        yield post_obj
+    yield from load_user_post_set(user_id).to_post_dicts()
     # else:
     #     # If metaphors data is available, load it
     #     metaphors_objs = load_post_json(os.path.join(
@@ -138,7 +644,7 @@ def load_user_metaphors(user_id: Text) -> Generator[Dict, None, None]:
         # print(f"Key '{user_id_str}' not found in metaphors_dataset_dir_dict.")
         return {}
 
-    if os.path.exists(os.path.join(posts_dataset_dir, '{}_cm.json'.format(user_id))):
+    if load_posts_dataset_index(post_data_dir).get(user_id_str, {}).get('has_cm', False):
         # print("exists ")
         user_objs = load_post_json(os.path.join(
             posts_dataset_dir, '{}_cm.json'.format(user_id)))
@@ -163,6 +669,159 @@ def load_user_metaphors(user_id: Text) -> Generator[Dict, None, None]:
         yield post_obj
 
 
+POSTS_INDEX_FILE_NAME = ".posts_index.pkl"
+POSTS_INDEX_VERSION = 1
+# where the posts index is persisted, defaults to <post data dir>/.posts_index.pkl
+posts_index_path = None
+# number of threads scanning directories when the posts index is built or refreshed
+posts_index_num_workers = 16
+# posts index loaded in this process, by absolute post data directory path
+_posts_dataset_indexes = {}
+
+
+def _stat_user_files(user_dir: str, user_id: str) -> Dict:
+    """
+    index entry of a user directory: the directory, size and mtime (ns) of {user_id}.json and
+        whether {user_id}_cm.json (metaphors) exists
+    """
+    user_entry = {'dir': user_dir, 'size': -1, 'mtime': -1,
+                  'has_cm': os.path.exists(os.path.join(user_dir, '{}_cm.json'.format(user_id)))}
+    try:
+        post_file_stat = os.stat(os.path.join(user_dir, '{}.json'.format(user_id)))
+        user_entry['size'] = post_file_stat.st_size
+        user_entry['mtime'] = post_file_stat.st_mtime_ns
+    except FileNotFoundError:
+        pass
+    return user_entry
+
+
+def _scan_directory(dir_path: str):
+    """
+    :return: (directory mtime in ns, sub-directory paths, user entry if it is a user directory else None)
+    """
+    # like os.walk, symlinks to directories are not followed
+    with os.scandir(dir_path) as dir_entries:
+        subdirectories = [dir_entry.path for dir_entry in dir_entries if dir_entry.is_dir(follow_symlinks=False)]
+    user_id = os.path.basename(dir_path)
+    user_entry = _stat_user_files(dir_path, user_id) if user_id.isdigit() else None
+    return os.stat(dir_path).st_mtime_ns, subdirectories, user_entry
+
+
+def _directory_mtime(dir_path: str):
+    try:
+        return os.stat(dir_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _scan_directory_trees(index: Dict, root_dirs: List[str], executor: ThreadPoolExecutor):
+    """
+    scan directory trees level by level, each level in parallel, and add them to the index
+    """
+    frontier = root_dirs
+    while frontier:
+        next_frontier = []
+        for dir_path, (dir_mtime, subdirectories, user_entry) in zip(
+                frontier, executor.map(_scan_directory, frontier)):
+            index['directories'][dir_path] = [dir_mtime, subdirectories]
+            if user_entry is not None:
+                index['users'][os.path.basename(dir_path)] = user_entry
+            next_frontier.extend(subdirectories)
+        frontier = next_frontier
+
+
+def _remove_directory_tree(index: Dict, dir_path: str):
+    if dir_path not in index['directories']:
+        return
+    _, subdirectories = index['directories'].pop(dir_path)
+    user_id = os.path.basename(dir_path)
+    if user_id in index['users'] and index['users'][user_id]['dir'] == dir_path:
+        del index['users'][user_id]
+    for subdirectory in subdirectories:
+        _remove_directory_tree(index, subdirectory)
+
+
+def _refresh_posts_index(index: Dict, executor: ThreadPoolExecutor) -> int:
+    """
+    re-scan directories whose mtime has changed since the index was built, i.e., directories
+        where entries have been added, removed or renamed
+
+    :return: number of changed directories
+    """
+    dir_paths = list(index['directories'].keys())
+    changed_dirs = [dir_path for dir_path, dir_mtime in zip(dir_paths, executor.map(_directory_mtime, dir_paths))
+                    if dir_mtime != index['directories'][dir_path][0]]
+    for dir_path in changed_dirs:
+        if dir_path not in index['directories']:
+            # already removed with a changed parent directory
+            continue
+        previous_subdirectories = index['directories'][dir_path][1]
+        if _directory_mtime(dir_path) is None:
+            _remove_directory_tree(index, dir_path)
+            continue
+        dir_mtime, subdirectories, user_entry = _scan_directory(dir_path)
+        index['directories'][dir_path] = [dir_mtime, subdirectories]
+        if user_entry is not None:
+            index['users'][os.path.basename(dir_path)] = user_entry
+        for removed_subdirectory in set(previous_subdirectories) - set(subdirectories):
+            _remove_directory_tree(index, removed_subdirectory)
+        _scan_directory_trees(index, [subdirectory for subdirectory in subdirectories
+                                      if subdirectory not in index['directories']], executor)
+    return len(changed_dirs)
+
+
+def _save_posts_index(index: Dict, index_path: str):
+    tmp_index_path = "%s.%s.tmp" % (index_path, os.getpid())
+    try:
+        with open(tmp_index_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_index_path, index_path)
+    except OSError as err:
+        # e.g., read-only dataset directory, the index is then rebuilt by the next run
+        logger.warning("failed to save posts index to [%s]: %s", index_path, err)
+
+
+def load_posts_dataset_index(post_data_dir, refresh: bool = True) -> Dict[str, Dict]:
+    """
+    load the index of user directories under the post data directory
+
+    The index is built once (in parallel with os.scandir) and persisted at `posts_index_path`.
+    Later loads reuse it and, if refresh is True, re-scan only the directories whose mtime has changed.
+
+    :param post_data_dir: post data directory
+    :param refresh: check directory mtimes of a persisted index
+    :return: dict {user id: {'dir': user directory, 'size': size of posts json, 'mtime': mtime (ns) of posts json,
+        'has_cm': whether the metaphors json exists}}
+    """
+    post_dataset_abs_path = load_abs_path(post_data_dir)
+    if post_dataset_abs_path in _posts_dataset_indexes:
+        return _posts_dataset_indexes[post_dataset_abs_path]['users']
+
+    index_path = posts_index_path or os.path.join(post_dataset_abs_path, POSTS_INDEX_FILE_NAME)
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            index = pickle.load(f)
+        if index.get('version') != POSTS_INDEX_VERSION or index.get('root') != post_dataset_abs_path:
+            index = None
+
+    with ThreadPoolExecutor(max_workers=posts_index_num_workers) as executor:
+        if index is None:
+            print("build posts index of dir: ", post_dataset_abs_path)
+            index = {'version': POSTS_INDEX_VERSION, 'root': post_dataset_abs_path, 'directories': {}, 'users': {}}
+            _scan_directory_trees(index, [post_dataset_abs_path], executor)
+            _save_posts_index(index, index_path)
+        elif refresh:
+            num_changed_dirs = _refresh_posts_index(index, executor)
+            if num_changed_dirs > 0:
+                print("posts index refreshed: %s directories changed" % num_changed_dirs)
+                _save_posts_index(index, index_path)
+
+    print("posts index loaded: %s users" % len(index['users']))
+    _posts_dataset_indexes[post_dataset_abs_path] = index
+    return index['users']
+
+
 def load_posts_dataset_dir(post_data_dir):
     """
     load tweet context dataset directory into a dictionary that can be mapped and
@@ -175,13 +834,9 @@ def load_posts_dataset_dir(post_data_dir):
 
     """
     print("load post data from dir: ", post_data_dir)
-    post_dataset_dir = post_data_dir
-    post_dataset_abs_path = load_abs_path(post_dataset_dir)
-    print("post_dataset_abs_path: ", post_dataset_abs_path)
-    all_subdirectories = [x[0] for x in os.walk(post_dataset_abs_path)]
+    posts_dataset_index = load_posts_dataset_index(post_data_dir)
     print("done.")
-    return {os.path.basename(subdirectory): subdirectory for subdirectory in all_subdirectories if os.path.basename(subdirectory).isdigit()}
-    # return {os.path.basename(subdirectory): subdirectory for subdirectory in all_subdirectories}
+    return {user_id: user_entry['dir'] for user_id, user_entry in posts_dataset_index.items()}
 
 
 def load_post_json(post_json_path):
@@ -5,6 +5,9 @@ from torch import Tensor
 import torch.nn.functional as F
 import torch.nn as nn
 import math
+import json
+import socket
+import time
 import matplotlib.pyplot as plt
 from overrides import overrides
 from collections import Counter
@@ -17,12 +20,14 @@ from allennlp.common import JsonDict
 from allennlp.predictors import Predictor
 from allennlp.common import Params
 from allennlp.data.data_loaders import MultiProcessDataLoader
+from allennlp.data.data_loaders.data_loader import DataLoader as AllennlpDataLoader, TensorDict
+from allennlp.data.data_loaders.data_collator import DefaultDataCollator
 from allennlp.data.tokenizers.sentence_splitter import SpacySentenceSplitter
 from allennlp.training.callbacks.callback import TrainerCallback
 from allennlp.data.tokenizers import Tokenizer, SpacyTokenizer, PretrainedTransformerTokenizer
 from allennlp.data.token_indexers import TokenIndexer, SingleIdTokenIndexer, ELMoTokenCharactersIndexer
 from allennlp.data.instance import Instance
-from allennlp.data.fields import LabelField, TextField, Field, ListField, MetadataField
+from allennlp.data.fields import LabelField, TextField, Field, ListField, MetadataField, TensorField
 from allennlp.data.dataset_readers import MultiTaskDatasetReader
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
 from allennlp.common.file_utils import cached_path
@@ -37,25 +42,38 @@ from allennlp.common.checks import ConfigurationError
 from allennlp.modules.seq2seq_encoders import PytorchSeq2SeqWrapper
 from allennlp.modules.seq2vec_encoders import PytorchSeq2VecWrapper
 from allennlp.modules.layer_norm import LayerNorm
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, AutoConfig
 import torch
 from torch.utils.data import DataLoader
-from data_loader import load_user_posts, load_user_metaphors
-from typing import Iterator, List, Dict, Union, Tuple, Optional
+import data_loader
+from data_loader import load_user_posts, load_user_post_set, load_user_metaphors, to_epoch_seconds, UserPostSet, \
+    UserPostPrefetcher, DEFAULT_POST_LOADER_WORKERS
+from embedding_cache import EmbeddingCache, DEFAULT_CACHE_SIZE_MB
+from embedding_shards import EmbeddingShardReader
+from temporal_features import simple_moving_average, mean_momentum, second_order_differencing, entropy, \
+    sentiment_features, MOMENTUM_WINDOW, MIN_POSTS_FOR_METRICS, NUM_SENTIMENT_FEATURES
+from typing import Any, Iterator, List, Dict, Union, Tuple, Optional
 import logging
 import datetime
 from datetime import datetime
 from pprint import pprint as pp
 from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
 import random
 import pandas as pd
 import torch.optim as optim
 import sys
 import operator
 import os
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
-sid_obj = SentimentIntensityAnalyzer()
+import tempfile
+from feature_store import FeatureStore, MemoryFeatureStore, SelectionStore, MemorySelectionStore
+from sentiment_scoring import SentimentScorer, PendingSentimentScores, DEFAULT_SENTIMENT_WORKERS, score_texts
+from proxy_selection import ProxyPostSelector
+from shared_encoder import MemoryStatus, share_memory_encoder, memory_status, reset_peak_rss
+from shared_batches import SharedBatchRing, SharedMemoryBatchCollator, SharedBatchDataLoader
+import instrumentation
+from batch_sampling import PostBudgetBatchSampler
+from post_reduction import KMeansReducer, PostReductionEngine, new_reducer, reducer_id, NUM_REPRESENTATIVE_POSTS, \
+    REDUCER_KMEANS, DEFAULT_WARM_START_CACHE_SIZE_MB
 
 
 # Load model directly
@@ -69,8 +87,9 @@ ATTENTION_OPTION_ATTENTION_WITH_POST = 1
 ATTENTION_OPTION_ATTENTION_WITH_METAPHOR = 1
 POST_ENCODER_OPTION_LSTM = 1
 METAPHOR_ENCODER_OPTION_LSTM = 1
+EMBEDDING_MODEL_NAME = "bert-base-uncased"
+DEFAULT_ENCODING_BATCH_SIZE = 64
 
-user_metric_scores = {}
 print("CUDA AVAILABILITY: {}".format(torch.cuda.is_available()))
 
 
@@ -81,68 +100,39 @@ def timestamped_print(msg):
 
 
 def calculate_sma(data, window_size):
-    sma = [sum(data[i - window_size + 1:i + 1]) /
-           window_size for i in range(window_size - 1, len(data))]
-    return [0] * (window_size - 1) + sma
+    return simple_moving_average(data, window_size).tolist()
 
 
 def calculate_mean_momentum(data, window_size):
-    sma = calculate_sma(data, window_size)
-
-    momentum = [(window_size + 1) * (sma[i - 1] - sma[i])
-                for i in range(window_size, len(data))]
-
-    mean_momentum = sum(momentum) / (len(data) - (window_size - 1))
-
-    return mean_momentum
+    return mean_momentum(data, window_size)
 
 
 def calculate_second_order_differencing(data, window_size):
-    # Calculate the simple moving average (SMA)
-    sma = np.convolve(data, np.ones(window_size)/window_size, mode='valid')
-
-    # Take the first-order differences
-    diff_1 = np.diff(sma)
+    return second_order_differencing(data, window_size)
 
-    # Take the second-order differences
-    diff_2 = np.diff(diff_1)
 
-    return diff_2
+def calculate_entropy(data):
+    return entropy(data)
 
 
-def calculate_entropy(data):
-    # Count the occurrences of each unique value in the dataset
-    counts = Counter(data)
-
-    # Calculate the probability of each unique value
-    probabilities = [count / len(data) for count in counts.values()]
-
-    # Calculate entropy using the formula
-    entropy = -sum(p * math.log2(p) for p in probabilities)
-
-    return entropy
-
-
-def calculate_metrics(content):
-    if len(content) > 100:
-        data_1 = []
-        data_2 = []
-        for sentence in content:
-            array = sid_obj.polarity_scores(sentence)
-            data_1.append(array['pos'])
-            data_2.append(array['neg'])
-        mean_1 = np.mean(data_1)
-        mean_2 = np.mean(data_2)
-        stdev1, stdev2 = np.std(data_1), np.std(data_2)
-        mean_momentum_1, mean_momentum_2 = calculate_mean_momentum(
-            data_1, 14), calculate_mean_momentum(data_2, 14)
-        entropy_1, entropy_2 = calculate_entropy(
-            data_1), calculate_entropy(data_2)
-        mean_diff_1, mean_diff_2 = np.std(calculate_second_order_differencing(
-            data_1, 14)), np.std(calculate_second_order_differencing(data_2, 14))
-        return [mean_1,  stdev1,  entropy_1,  mean_momentum_1, mean_diff_1, mean_2, stdev2, entropy_2, mean_momentum_2, mean_diff_2]
+def calculate_metrics(pos_scores: np.ndarray, neg_scores: np.ndarray):
+    """
+    :param pos_scores: VADER 'pos' score per post (see sentiment_scoring.py)
+    :param neg_scores: VADER 'neg' score per post
+    :return: [mean, stdev, entropy, mean momentum, stdev of 2nd-order differences] of pos, then of neg
+    """
+    if len(pos_scores) > MIN_POSTS_FOR_METRICS:
+        return sentiment_features(pos_scores, neg_scores, MOMENTUM_WINDOW)
     else:
-        return [0.0] * 10
+        return [0.0] * NUM_SENTIMENT_FEATURES
+
+
+def embedding_model_id(embedding_model_config) -> str:
+    """
+    encoder name and revision, used to address cached and precomputed post embeddings
+    """
+    revision = getattr(embedding_model_config, "_commit_hash", None) or "main"
+    return "%s@%s" % (EMBEDDING_MODEL_NAME, revision)
 
 
 # Mean Pooling - Take attention mask into account for correct averaging
@@ -154,13 +144,136 @@ def mean_pooling(model_output, attention_mask):
     return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
 
+def kmeans_last_post_per_cluster(post_embeddings: np.ndarray, num_clusters: int = 200) -> (np.ndarray, np.ndarray):
+    """
+    cluster post embeddings with K-means
+
+    :param post_embeddings: (number of posts, embedding dim)
+    :param num_clusters: number of clusters
+    :return: index of the last post assigned to each cluster (-1 for empty clusters), (num_clusters, embedding dim)
+        cluster centroids
+    """
+    logger.debug("kmeans_last_post_per_cluster: %s", post_embeddings.shape)
+    # Perform K-means clustering
+    return KMeansReducer().fit(post_embeddings, num_clusters)
+
+
+def kmeans_representative_indices(post_embeddings: np.ndarray, num_clusters: int = 200) -> np.ndarray:
+    """
+    cluster post embeddings with K-means and keep the last post of every (non-empty) cluster
+
+    :param post_embeddings: (number of posts, embedding dim)
+    :param num_clusters: number of clusters
+    :return: indices of the representative posts, in cluster order
+    """
+    last_post_indices, _ = kmeans_last_post_per_cluster(post_embeddings, num_clusters)
+    return last_post_indices[last_post_indices >= 0]
+
+
+def kmeans_clustering(embedding_tensor):
+    # Extract data from embedding_tensor
+    data = np.array([item[0] for item in embedding_tensor])
+    return [embedding_tensor[i] for i in kmeans_representative_indices(data)]
+
+
+def sort_encoding_with_time_sequence(individual_post_set: List[Dict],
+                                     all_post_content_embeddings: List[np.ndarray]) -> (
+        torch.FloatTensor, torch.FloatTensor):
+    """
+    put post representation in temporal order before feeding into LSTM
+    """
+    post_timestamps = np.array([to_epoch_seconds(post["timestamp"]) for post in individual_post_set],
+                               dtype=np.int64)
+    return reduce_and_sort_post_sequence(post_timestamps, np.asarray(all_post_content_embeddings),
+                                         max_post_size=None)
+
+
+def reduce_and_sort_post_sequence(post_timestamps: np.ndarray, post_embeddings: np.ndarray,
+                                  max_post_size: Optional[int] = NUM_REPRESENTATIVE_POSTS,
+                                  post_reducer: Optional[PostReductionEngine] = None, user_id: str = None,
+                                  selected_indices: np.ndarray = None) -> torch.FloatTensor:
+    """
+    keep one representative post per cluster for users with more than max_post_size posts, then put the post
+    embeddings in temporal order with a single gather
+
+    :param post_timestamps: int64 post timestamps (seconds past Epoch)
+    :param post_embeddings: (number of posts, embedding dim) post embeddings
+    :param max_post_size: number of clusters, no reduction if None
+    :param post_reducer: reduction engine (see post_reduction.py), K-means as in `kmeans_clustering` if None
+    :param user_id: user of the posts, for warm starts of the post reducer
+    :param selected_indices: representative posts if already selected (e.g., for the whole batch)
+    :return: (number of posts, embedding dim) sequence tensor
+    """
+    if selected_indices is None:
+        selected_indices = np.arange(len(post_timestamps))
+        if max_post_size is not None and len(post_embeddings) > max_post_size:
+            with instrumentation.stage(instrumentation.STAGE_CLUSTERING):
+                if post_reducer is not None:
+                    selected_indices = post_reducer.select(post_embeddings, num_clusters=max_post_size,
+                                                           user_id=user_id)
+                else:
+                    selected_indices = kmeans_representative_indices(post_embeddings, num_clusters=max_post_size)
+
+    with instrumentation.stage(instrumentation.STAGE_SORT):
+        # stable sort keeps the cluster order of posts with identical timestamps
+        temporal_order = selected_indices[np.argsort(post_timestamps[selected_indices], kind='stable')]
+        return torch.as_tensor(np.ascontiguousarray(post_embeddings[temporal_order]), dtype=torch.float32)
+
+
+def select_representatives(user_ids: List, post_embeddings_list: List[np.ndarray],
+                           post_reducer: Optional[PostReductionEngine] = None) -> List[np.ndarray]:
+    """
+    representative posts of users with more than NUM_REPRESENTATIVE_POSTS posts (see reduce_and_sort_post_sequence)
+
+    :return: indices of the representative posts per user, in cluster order
+    """
+    with instrumentation.stage(instrumentation.STAGE_CLUSTERING):
+        if post_reducer is not None:
+            return post_reducer.select_batch(user_ids, post_embeddings_list, num_clusters=NUM_REPRESENTATIVE_POSTS)
+        return [kmeans_representative_indices(post_embeddings, num_clusters=NUM_REPRESENTATIVE_POSTS)
+                for post_embeddings in post_embeddings_list]
+
+
+def representative_selection_id(encoder_id: Optional[str], post_reducer: Optional[PostReductionEngine],
+                                proxy_selector: Optional[ProxyPostSelector] = None) -> str:
+    """
+    encoder, reducer and proxy selection configuration of representative selections
+    (see feature_store.SelectionStore)
+    """
+    selection_id = "%s|%s|%s" % (encoder_id, reducer_id(post_reducer.reducer if post_reducer is not None
+                                                        else KMeansReducer()), NUM_REPRESENTATIVE_POSTS)
+    if proxy_selector is not None:
+        selection_id += "|" + proxy_selector.selection_id
+    return selection_id
+
+
+def precomputed_post_set(post_timestamps: List) -> UserPostSet:
+    """
+    post set of precomputed embeddings: timestamps only, texts are not needed
+    """
+    return UserPostSet(np.array([to_epoch_seconds(post_timestamp) for post_timestamp in post_timestamps],
+                                dtype=np.int64), b'', np.zeros(len(post_timestamps) + 1, dtype=np.int64))
+
+
+def add_post_sequence_fields(instance: Instance, post_sequence: torch.FloatTensor, metric_scores: torch.FloatTensor):
+    """
+    post sequence (padded to the longest user in the batch by the data loader), its mask and the metric scores,
+    the precomputed inputs of DepressionClassifier.forward
+    """
+    instance.add_field('post_sequence', TensorField(post_sequence))
+    instance.add_field('post_mask', TensorField(
+        torch.ones(post_sequence.size(0), dtype=torch.bool), padding_value=False))
+    instance.add_field('metric_scores', TensorField(metric_scores))
+
+
 @DatasetReader.register("depression_data_reader")
 class DepressionDataReader(DatasetReader):
     def __init__(self,
                  tokenizer: Tokenizer = None,
                  token_indexers: Dict[str, TokenIndexer] = None,
                  ) -> None:
-        super().__init__()
+        # users are split among data loader workers (and distributed processes), so that every user is read once
+        super().__init__(manual_distributed_sharding=True, manual_multiprocess_sharding=True)
         timestamped_print("DepressionDataReader ...")
         self._tokenizer = tokenizer or SpacyTokenizer()
         self._token_indexers = token_indexers or {
@@ -183,13 +296,251 @@ class DepressionDataReader(DatasetReader):
         df = pd.read_csv(file_path, header=0, encoding='utf-8', delimiter=',', lineterminator='\n',
                          usecols=range(0, 2)).values
         # df = pd.read_csv(file_path)
-        for data_row in df[:]:
+        for data_row in self.shard_iterable(df[:]):
             # label = 1 if data_row[0] == 'depression' else 0
             user_id = data_row[1]
             label = data_row[0]
             yield self.text_to_instance(user_id=user_id, tag=label)
 
 
+@DatasetReader.register("depression_precomputed_sequence_reader")
+class PrecomputedSequenceDataReader(DepressionDataReader):
+    """
+    yields the temporally sorted post embedding sequence and the 10 sentiment metric scores of every user from
+    precomputed embedding shards (see precompute_embeddings.py), so that the classifier head can be trained
+    without the embedding model
+    """
+
+    def __init__(self,
+                 embedding_shard_dir: str,
+                 tokenizer: Tokenizer = None,
+                 token_indexers: Dict[str, TokenIndexer] = None,
+                 post_reducer: Optional[PostReductionEngine] = None,
+                 selection_store: Optional[SelectionStore] = None,
+                 ) -> None:
+        super().__init__(tokenizer=tokenizer, token_indexers=token_indexers)
+        self.embedding_shard_dir = embedding_shard_dir
+        self.post_reducer = post_reducer
+        # representative posts of earlier epochs
+        self.selection_store = selection_store if selection_store is not None else MemorySelectionStore()
+        # opened lazily, once per data loader worker
+        self._embedding_shards = None
+
+    @overrides
+    def text_to_instance(self, user_id: str, tag: str = None) -> Instance:
+        instance = super().text_to_instance(user_id, tag)
+        post_sequence, metric_scores = self.load_post_sequence(str(user_id))
+        add_post_sequence_fields(instance, post_sequence, metric_scores)
+        return instance
+
+    def load_post_sequence(self, user_id: str) -> (torch.FloatTensor, torch.FloatTensor):
+        if self._embedding_shards is None:
+            self._embedding_shards = EmbeddingShardReader(self.embedding_shard_dir)
+
+        precomputed = self._embedding_shards.load_user(user_id)
+        if precomputed is None:
+            logger.warning("user [%s] not found in embedding shards [%s]. Encode as a user without posts.",
+                           user_id, self.embedding_shard_dir)
+            return torch.zeros(1, 768), torch.zeros(NUM_SENTIMENT_FEATURES)
+
+        post_embeddings, post_timestamps, metric_scores = precomputed
+        if len(post_embeddings) == 0:
+            post_sequence = torch.zeros(1, 768)
+        else:
+            post_set = precomputed_post_set(post_timestamps)
+            selected_indices = None
+            if len(post_embeddings) > NUM_REPRESENTATIVE_POSTS:
+                fingerprint = post_set.fingerprint()
+                selected_indices = self.selection_store.get(user_id, fingerprint)
+                if selected_indices is None:
+                    selected_indices = select_representatives([user_id], [post_embeddings], self.post_reducer)[0]
+                    self.selection_store.put(user_id, fingerprint, selected_indices)
+            post_sequence = reduce_and_sort_post_sequence(post_set.timestamps, post_embeddings,
+                                                          selected_indices=selected_indices)
+        return post_sequence, torch.tensor(metric_scores).float()
+
+
+class PostSequenceEncoder(object):
+    """
+    loads, scores and encodes the posts of one user into its temporally sorted representative post sequence and
+    metric scores, as DepressionClassifier.batch_encoding does for a batch, so that users can be encoded in data
+    loader worker processes
+
+    The encoder model is loaded lazily in the process that encodes (and never pickled) unless a shared encoder is
+    set (see `set_embedding_model`); the embedding cache, the embedding shards and the stores are opened per
+    process as well.
+    """
+
+    def __init__(self, encoding_batch_size: int = DEFAULT_ENCODING_BATCH_SIZE, device: str = "cpu",
+                 embedding_cache_dir: str = None, embedding_cache_size_mb: float = DEFAULT_CACHE_SIZE_MB,
+                 embedding_shard_dir: str = None, feature_store=None, selection_store=None,
+                 post_reducer: Optional[PostReductionEngine] = None,
+                 proxy_selector: Optional[ProxyPostSelector] = None):
+        """
+        :param encoding_batch_size: number of posts per forward pass of the embedding model
+        :param device: device of the embedding model, "cpu" in forked data loader workers
+        :param embedding_cache_dir: directory of the persistent post embedding cache (no caching if None)
+        :param embedding_cache_size_mb: size cap of the post embedding cache
+        :param embedding_shard_dir: precomputed post embeddings, users found in the shards are not encoded
+        :param feature_store: metric scores per user and post set (in memory if None)
+        :param selection_store: representative posts per user and post set (in memory if None)
+        :param post_reducer: clustering of users with more than 200 posts (K-means as in `kmeans_clustering` if None)
+        :param proxy_selector: selects representatives from the post texts before encoding (post-encode clustering
+            if None)
+        """
+        self.encoding_batch_size = encoding_batch_size
+        self.device = device
+        self.embedding_cache_dir = embedding_cache_dir
+        self.embedding_cache_size_mb = embedding_cache_size_mb
+        self.embedding_shard_dir = embedding_shard_dir
+        self.feature_store = feature_store if feature_store is not None else MemoryFeatureStore()
+        self.selection_store = selection_store if selection_store is not None else MemorySelectionStore()
+        self.post_reducer = post_reducer
+        self.proxy_selector = proxy_selector
+        # frozen encoder with its weights in shared memory, used by all processes instead of their own copy
+        self.shared_embedding_model = None
+        self._embedding_tokenizer = None
+        self._embedding_model = None
+        self._embedding_cache = None
+        self._embedding_shards = None
+        self._memory_status = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for lazy_attribute in ['_embedding_tokenizer', '_embedding_model', '_embedding_cache', '_embedding_shards',
+                               '_memory_status']:
+            state[lazy_attribute] = None
+        return state
+
+    def set_embedding_model(self, shared_embedding_model):
+        """
+        :param shared_embedding_model: CPU encoder with its weights in shared memory (see
+            DepressionClassifier.shared_embedding_model), used by the worker processes instead of their own copy
+        """
+        self.shared_embedding_model = shared_embedding_model
+        self._embedding_model = None
+
+    def _load_embedding_model(self):
+        if self._embedding_model is None:
+            self._embedding_tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+            if self.shared_embedding_model is not None:
+                embedding_model = self.shared_embedding_model
+            else:
+                embedding_model = AutoModel.from_pretrained(EMBEDDING_MODEL_NAME).to(self.device)
+            # inference mode of this process's copy of the module only, the shared weights are not written
+            embedding_model.eval()
+            if self.embedding_cache_dir:
+                self._embedding_cache = EmbeddingCache(self.embedding_cache_dir,
+                                                       embedding_model_id(embedding_model.config),
+                                                       max_size_mb=self.embedding_cache_size_mb)
+            self._embedding_model = embedding_model
+            logger.info("embedding model loaded in process [%s] on [%s]", os.getpid(), self.device)
+        return self._embedding_model
+
+    def _load_precomputed(self, user_id: str):
+        if not self.embedding_shard_dir:
+            return None
+        if self._embedding_shards is None:
+            self._embedding_shards = EmbeddingShardReader(self.embedding_shard_dir)
+        return self._embedding_shards.load_user(user_id)
+
+    def encode_user(self, user_id: str) -> (torch.FloatTensor, torch.FloatTensor):
+        """
+        :return: (number of representative posts, 768) post sequence sorted by time, 10 metric scores
+        """
+        user_id = str(user_id)
+        first_user_in_process = self._memory_status is None or self._memory_status.pid != os.getpid()
+        if first_user_in_process:
+            self._memory_status = MemoryStatus()
+        post_sequence, metric_scores = self._encode_user(user_id)
+        if first_user_in_process:
+            # memory this worker adds on top of what it inherited or shares, once its first user is encoded
+            timestamped_print("post sequence encoder %s" % self._memory_status.report())
+        return post_sequence, metric_scores
+
+    def _encode_user(self, user_id: str) -> (torch.FloatTensor, torch.FloatTensor):
+        precomputed = self._load_precomputed(user_id)
+        if precomputed is not None:
+            post_embeddings, post_timestamps, metric_scores = precomputed
+            post_set = precomputed_post_set(post_timestamps)
+            metric_scores = torch.tensor(metric_scores).float()
+        else:
+            try:
+                with instrumentation.stage(instrumentation.STAGE_POST_LOAD):
+                    post_set = load_user_post_set(user_id)
+            except Exception as err:
+                logger.warning("failed to load posts of user [%s]: %s", user_id, err)
+                post_set = UserPostSet.from_posts([], [])
+            post_embeddings = None
+            metric_scores = None
+
+        if len(post_set) == 0:
+            return torch.zeros(1, 768), torch.zeros(NUM_SENTIMENT_FEATURES)
+
+        fingerprint = post_set.fingerprint()
+        if metric_scores is None:
+            stored_metric_scores = self.feature_store.get(user_id, fingerprint)
+            if stored_metric_scores is not None:
+                metric_scores = torch.from_numpy(stored_metric_scores)
+            else:
+                with instrumentation.stage(instrumentation.STAGE_SENTIMENT):
+                    sentiment_scores = score_texts(post_set.texts()) if len(post_set) > MIN_POSTS_FOR_METRICS \
+                        else np.zeros((len(post_set), 2))
+                    metric_scores = torch.tensor(
+                        calculate_metrics(sentiment_scores[:, 0], sentiment_scores[:, 1])).float()
+                self.feature_store.put(user_id, fingerprint, metric_scores.numpy())
+
+        selected_indices = None
+        if len(post_set) > NUM_REPRESENTATIVE_POSTS:
+            selected_indices = self.selection_store.get(user_id, fingerprint)
+            if selected_indices is None and post_embeddings is None and self.proxy_selector is not None:
+                selected_indices = self.proxy_selector.select(post_set.timestamps, post_set.texts())
+                self.selection_store.put(user_id, fingerprint, selected_indices)
+
+        post_timestamps = post_set.timestamps
+        if post_embeddings is None:
+            # only the representative posts are encoded if they are already selected
+            encoded_post_set = post_set.subset(selected_indices) if selected_indices is not None else post_set
+            embedding_model = self._load_embedding_model()
+            post_embeddings = encode_post_texts(embedding_model, self._embedding_tokenizer, encoded_post_set.texts(),
+                                                batch_size=self.encoding_batch_size,
+                                                embedding_cache=self._embedding_cache)
+            if selected_indices is not None:
+                post_timestamps = encoded_post_set.timestamps
+                selected_indices = np.arange(len(selected_indices))
+        post_embeddings = np.asarray(post_embeddings)
+
+        if selected_indices is None and len(post_embeddings) > NUM_REPRESENTATIVE_POSTS:
+            selected_indices = select_representatives([user_id], [post_embeddings], self.post_reducer)[0]
+            self.selection_store.put(user_id, fingerprint, selected_indices)
+        return reduce_and_sort_post_sequence(post_timestamps, post_embeddings,
+                                             selected_indices=selected_indices), metric_scores
+
+
+@DatasetReader.register("depression_encoding_reader")
+class EncodingDataReader(DepressionDataReader):
+    """
+    yields the encoded post sequence and the metric scores of every user, so that posts are loaded, scored and
+    encoded in the data loader worker processes (MultiProcessDataLoader with num_workers > 0) instead of in
+    DepressionClassifier.forward
+    """
+
+    def __init__(self,
+                 post_sequence_encoder: PostSequenceEncoder,
+                 tokenizer: Tokenizer = None,
+                 token_indexers: Dict[str, TokenIndexer] = None,
+                 ) -> None:
+        super().__init__(tokenizer=tokenizer, token_indexers=token_indexers)
+        self.post_sequence_encoder = post_sequence_encoder
+
+    @overrides
+    def text_to_instance(self, user_id: str, tag: str = None) -> Instance:
+        instance = super().text_to_instance(user_id, tag)
+        post_sequence, metric_scores = self.post_sequence_encoder.encode_user(str(user_id))
+        add_post_sequence_fields(instance, post_sequence, metric_scores)
+        return instance
+
+
 class ScaledDotProductAttention(nn.Module):
     """
     Scaled Dot-Product Attention proposed in "Attention Is All You Need"
@@ -202,18 +553,30 @@ class ScaledDotProductAttention(nn.Module):
         - **query** (batch, q_len, d_model): tensor containing projection vector for decoder.
         - **key** (batch, k_len, d_model): tensor containing projection vector for encoder.
         - **value** (batch, v_len, d_model): tensor containing features of the encoded input sequence.
-        - **mask** (-): tensor containing indices to be masked
+        - **mask** (batch, k_len): boolean tensor, True for keys taking part in attention (posts), False for
+            padding. Every row needs at least one True.
     Returns: context, attn
         - **context**: tensor containing the context vector from attention mechanism.
-        - **attn**: tensor containing the attention (alignment) from the encoder outputs.
+        - **attn**: tensor containing the attention (alignment) from the encoder outputs, None if computed by the
+            fused `F.scaled_dot_product_attention` (need_weights=False)
     """
 
-    def __init__(self, hidden_dim: int):
+    def __init__(self, hidden_dim: int, need_weights: bool = False):
         super(ScaledDotProductAttention, self).__init__()
         self.sqrt_dim = np.sqrt(hidden_dim)
+        self.need_weights = need_weights
+
+    def forward(self, query: Tensor, key: Tensor, val: Tensor, mask: Optional[Tensor] = None) -> Tuple[
+            Tensor, Optional[Tensor]]:
+        if not self.need_weights and hasattr(F, "scaled_dot_product_attention"):
+            # fused kernel, scaled by 1 / sqrt(query dim)
+            attn_mask = mask.unsqueeze(1) if mask is not None else None
+            return F.scaled_dot_product_attention(query, key, val, attn_mask=attn_mask), None
 
-    def forward(self, query: Tensor, key: Tensor, val: Tensor) -> Tuple[Tensor, Tensor]:
         score = torch.bmm(query, key.transpose(1, 2)) / self.sqrt_dim
+        if mask is not None:
+            # padded posts get no attention weight
+            score = score.masked_fill(~mask.unsqueeze(1), float('-inf'))
         attn = F.softmax(score, -1)  # softmax applied to last score-dimension
         context = torch.bmm(attn, val)
         return context, attn
@@ -237,18 +600,22 @@ class HAN_block(nn.Module):
         self.layer_norm = nn.LayerNorm(hidden_dim)
         self.dropout = nn.Dropout(p=0.2)
 
-    def forward(self, query: Tensor, key: Tensor, value: Tensor):
-        # Make sure the batch size of query matches the size of key in the last batch of an epoch
-        query_ = query[:key.size(0), :, :]
-        context, att_weight = self.att(query_, key, value)
-
-        # Apply linear transformations and layer normalization
-        new_query_vec = self.dropout(self.layer_norm(
-            self.activation(self.linear_observer(context))))
-        new_key_matrix = self.dropout(self.layer_norm(
-            self.activation(self.linear_matrix(key))))
-        new_value_matrix = self.dropout(self.layer_norm(
-            self.activation(self.linear_value(value))))
+    def forward(self, query: Tensor, key: Tensor, value: Tensor, mask: Optional[Tensor] = None):
+        """
+        :param mask: (batch, number of posts) boolean tensor, False for padding
+        """
+        with instrumentation.profile_range("HAN_block"):
+            # a learned (1, 1, dim) query is shared by all users of the batch, whatever its size
+            query_ = query.expand(key.size(0), -1, -1) if query.size(0) == 1 else query
+            context, att_weight = self.att(query_, key, value, mask)
+
+            # Apply linear transformations and layer normalization
+            new_query_vec = self.dropout(self.layer_norm(
+                self.activation(self.linear_observer(context))))
+            new_key_matrix = self.dropout(self.layer_norm(
+                self.activation(self.linear_matrix(key))))
+            new_value_matrix = self.dropout(self.layer_norm(
+                self.activation(self.linear_value(value))))
 
         return new_query_vec, new_key_matrix, new_value_matrix, att_weight
 
@@ -263,6 +630,7 @@ class DepressionClassifier(Model):
                  cuda_device: int = -1,
                  max_post_size: int = MAXIMUM_POST_SEQ_SIZE,
                  initializer: InitializerApplicator = InitializerApplicator(),
+                 load_embedding_model: bool = True,
                  ) -> None:
 
         super().__init__(vocab)
@@ -288,18 +656,49 @@ class DepressionClassifier(Model):
             if torch.cuda.is_available() else torch.nn.CrossEntropyLoss()
 
         # Loading local files
-        self.embedding_tokenizer = AutoTokenizer.from_pretrained(
-            "bert-base-uncased")
-        self.embedding_model = AutoModel.from_pretrained(
-            "bert-base-uncased").to(self.cuda_device)
+        # (not needed to train the head only on precomputed post sequences)
+        self.embedding_tokenizer = None
+        self.embedding_model = None
+        if load_embedding_model:
+            self.embedding_tokenizer = AutoTokenizer.from_pretrained(
+                EMBEDDING_MODEL_NAME)
+            self.embedding_model = AutoModel.from_pretrained(
+                EMBEDDING_MODEL_NAME).to(self.cuda_device)
+            # frozen: posts are encoded without gradients and without dropout (see `train`)
+            self.embedding_model.requires_grad_(False)
+            self.embedding_model.eval()
+        self.embedding_cache = None
+        self.encoding_batch_size = DEFAULT_ENCODING_BATCH_SIZE
+        self.embedding_shards = None
+        self.post_prefetcher = None
+        self.sentiment_scorer = None
+        # K-means as in `kmeans_clustering` if None
+        self.post_reducer = None
+        # representative posts per user and post set, in memory unless a persistent store is set
+        self.selection_store = MemorySelectionStore()
+        # selects representatives from the post texts before encoding (post-encode clustering if None)
+        self.proxy_selector = None
+        # metric scores per user and post set, in memory unless a persistent store is set
+        self.feature_store = MemoryFeatureStore()
 
-        self.tweet_query0 = None
         self.meta_query0 = None
         self.bn_input = None
         initializer(self)
 
         self.HAN_1_tweet = HAN_block(768)
         self.HAN_2_tweet = HAN_block(768)
+        # learned query of the first attention block, expanded to the users of every batch (batch sizes vary)
+        self.tweet_query0 = nn.Parameter(torch.rand(1, 1, 768))
+
+    def train(self, mode: bool = True):
+        """
+        the trainer sets the model to training mode every epoch; the frozen encoder stays in eval mode, so that
+        posts are encoded without dropout and cached embeddings match the shards and the worker encoders
+        """
+        super().train(mode)
+        if self.embedding_model is not None:
+            self.embedding_model.eval()
+        return self
 
     def set_max_post_size(self, max_post_size: int = MAXIMUM_POST_SEQ_SIZE):
         if max_post_size:
@@ -309,6 +708,108 @@ class DepressionClassifier(Model):
             timestamped_print(
                 "re-set attention1 with the new post sequence size")
 
+    def set_encoding_batch_size(self, encoding_batch_size: int = DEFAULT_ENCODING_BATCH_SIZE):
+        if encoding_batch_size:
+            self.encoding_batch_size = encoding_batch_size
+            timestamped_print(
+                "posts are encoded in mini-batches of [%s]" % self.encoding_batch_size)
+
+    @property
+    def embedding_model_id(self) -> Optional[str]:
+        """
+        encoder name and revision, used to address cached post embeddings
+        """
+        if self.embedding_model is None:
+            return None
+        return embedding_model_id(self.embedding_model.config)
+
+    def shared_embedding_model(self):
+        """
+        frozen CPU encoder with its weights in shared memory, to encode in worker processes without a copy of the
+        weights per process: the model's own encoder if it is on CPU, otherwise a CPU copy loaded once
+        """
+        if self.embedding_model is None:
+            return None
+        if next(self.embedding_model.parameters()).device.type == "cpu":
+            return share_memory_encoder(self.embedding_model)
+        return share_memory_encoder(AutoModel.from_pretrained(EMBEDDING_MODEL_NAME))
+
+    def head_parameters(self) -> List[torch.nn.Parameter]:
+        """
+        parameters of the classifier head (attention query and blocks, feedforward), the only trained parameters
+        """
+        return [self.tweet_query0] + list(self.HAN_1_tweet.parameters()) + list(self.HAN_2_tweet.parameters()) + \
+            list(self.classifier_feedforward.parameters())
+
+    def set_embedding_cache(self, embedding_cache: Optional[EmbeddingCache]):
+        self.embedding_cache = embedding_cache
+        if embedding_cache is not None:
+            timestamped_print("post embeddings are cached in [%s] (encoder: %s, capacity: %s posts)" % (
+                embedding_cache.cache_dir, embedding_cache.encoder_id, embedding_cache.capacity))
+
+    def set_embedding_shards(self, embedding_shards: Optional[EmbeddingShardReader]):
+        self.embedding_shards = embedding_shards
+        if embedding_shards is not None:
+            timestamped_print("precomputed post embeddings of [%s] users are read from [%s]" % (
+                len(embedding_shards), embedding_shards.shard_dir))
+            if embedding_shards.encoder_id != self.embedding_model_id:
+                timestamped_print("Warning: shards were encoded with [%s], current encoder is [%s]" % (
+                    embedding_shards.encoder_id, self.embedding_model_id))
+
+    def set_post_prefetcher(self, post_prefetcher: Optional[UserPostPrefetcher]):
+        self.post_prefetcher = post_prefetcher
+        if post_prefetcher is not None:
+            timestamped_print("user posts are loaded with [%s] threads" % post_prefetcher.num_workers)
+
+    def get_post_prefetcher(self) -> UserPostPrefetcher:
+        if self.post_prefetcher is None:
+            self.set_post_prefetcher(UserPostPrefetcher(DEFAULT_POST_LOADER_WORKERS))
+        return self.post_prefetcher
+
+    def set_feature_store(self, feature_store):
+        self.feature_store = feature_store if feature_store is not None else MemoryFeatureStore()
+        if isinstance(feature_store, FeatureStore):
+            timestamped_print("metric scores are stored in [%s] ([%s] users stored)" % (
+                feature_store.db_path, len(feature_store)))
+
+    def set_sentiment_scorer(self, sentiment_scorer: Optional[SentimentScorer]):
+        self.sentiment_scorer = sentiment_scorer
+        if sentiment_scorer is not None:
+            timestamped_print("post sentiments are scored with [%s] processes" % sentiment_scorer.num_workers)
+
+    def get_sentiment_scorer(self) -> SentimentScorer:
+        if self.sentiment_scorer is None:
+            self.set_sentiment_scorer(SentimentScorer(DEFAULT_SENTIMENT_WORKERS))
+        return self.sentiment_scorer
+
+    def set_post_reducer(self, post_reducer: Optional[PostReductionEngine]):
+        self.post_reducer = post_reducer
+        if isinstance(self.selection_store, MemorySelectionStore):
+            # selections of the previous reducer
+            self.selection_store = MemorySelectionStore()
+        if post_reducer is not None:
+            timestamped_print("posts are reduced with [%s] (warm start: %s, processes: %s)" % (
+                post_reducer.reducer.name, post_reducer.warm_start, post_reducer.num_workers))
+
+    def set_proxy_selector(self, proxy_selector: Optional[ProxyPostSelector]):
+        self.proxy_selector = proxy_selector
+        if isinstance(self.selection_store, MemorySelectionStore):
+            # selections of the previous configuration
+            self.selection_store = MemorySelectionStore()
+        if proxy_selector is not None:
+            timestamped_print("representative posts are selected before encoding with [%s]" %
+                              proxy_selector.selection_id)
+
+    @property
+    def selection_id(self) -> str:
+        return representative_selection_id(self.embedding_model_id, self.post_reducer, self.proxy_selector)
+
+    def set_selection_store(self, selection_store):
+        self.selection_store = selection_store if selection_store is not None else MemorySelectionStore()
+        if isinstance(selection_store, SelectionStore):
+            timestamped_print("representative posts are stored in [%s] ([%s] users stored)" % (
+                selection_store.db_path, len(selection_store)))
+
     def cross_attention(self, tweet_query, metaphor_key, metaphor_val):
         # Compute attention weights between tweet queries and metaphor values
         attn = torch.bmm(tweet_query, metaphor_key.transpose(1, 2))
@@ -323,39 +824,48 @@ class DepressionClassifier(Model):
             # text: Dict[str, torch.Tensor],
             user_id: List,
             label: Optional[torch.Tensor] = None,
+            post_sequence: Optional[torch.Tensor] = None,
+            post_mask: Optional[torch.Tensor] = None,
+            metric_scores: Optional[torch.Tensor] = None,
     ) -> Dict[str, torch.Tensor]:
 
-        # forward function with value vector
-        content_tensor_in_batch_padded, batch_content_mask, metric_scores_in_batch = self.batch_encoding(
-            user_id, maximum_sequence_length=self.max_post_size)
-
-        timestamped_print("encode social context with LSTM")
-
-        metric_scores_in_batch = torch.stack((metric_scores_in_batch))
+        if post_sequence is None:
+            # forward function with value vector
+            content_tensor_in_batch_padded, batch_content_mask, metric_scores_in_batch = self.batch_encoding(
+                user_id, maximum_sequence_length=self.max_post_size)
+            metric_scores_in_batch = torch.stack((metric_scores_in_batch))
+        else:
+            # post sequences precomputed by the dataset reader, padded to the longest user in the batch
+            with instrumentation.stage(instrumentation.STAGE_PAD):
+                content_tensor_in_batch_padded, batch_content_mask = self.pad_precomputed_sequences(
+                    post_sequence, post_mask, maximum_sequence_length=self.max_post_size)
+            metric_scores_in_batch = metric_scores
 
-        if self.tweet_query0 == None:
-            self.tweet_query0 = torch.rand([content_tensor_in_batch_padded.size(
-                0), 1, content_tensor_in_batch_padded.size(2)], requires_grad=True)
+        logger.debug("encode social context with LSTM")
 
-        print("query shape:", self.tweet_query0.shape)
-        print("key shape:", content_tensor_in_batch_padded.shape)
+        logger.debug("query shape: %s", self.tweet_query0.shape)
+        logger.debug("key shape: %s", content_tensor_in_batch_padded.shape)
         # print("metric scores:", metric_scores_in_batch.shape)
 
-        tweet_query1, tweet_key1, tweet_val1,  att_weight_1 = self.HAN_1_tweet(
-            self.tweet_query0, content_tensor_in_batch_padded, content_tensor_in_batch_padded)
-        tweet_query2, tweet_key2, tweet_val2, att_weight_2 = self.HAN_2_tweet(
-            tweet_query1, tweet_key1, tweet_val1)
+        # padded positions are masked out of the attention of both blocks
+        batch_content_mask = batch_content_mask.to(device=content_tensor_in_batch_padded.device, dtype=torch.bool)
+        with instrumentation.stage(instrumentation.STAGE_HAN):
+            tweet_query1, tweet_key1, tweet_val1,  att_weight_1 = self.HAN_1_tweet(
+                self.tweet_query0, content_tensor_in_batch_padded, content_tensor_in_batch_padded,
+                batch_content_mask)
+            tweet_query2, tweet_key2, tweet_val2, att_weight_2 = self.HAN_2_tweet(
+                tweet_query1, tweet_key1, tweet_val1, batch_content_mask)
 
         post_encoder_out = tweet_query2.squeeze(1)
 
-        timestamped_print("post reprsentation shape : %s" %
-                          (str(post_encoder_out.shape)))
+        logger.debug("post reprsentation shape : %s", post_encoder_out.shape)
 
         # final_representation = post_encoder_out
         final_representation = post_encoder_out
         final_representation = torch.cat(
             [final_representation, metric_scores_in_batch], dim=1)
-        logits = self.classifier_feedforward(final_representation)
+        with instrumentation.stage(instrumentation.STAGE_FEEDFORWARD):
+            logits = self.classifier_feedforward(final_representation)
 
         output_dict = {"logits": logits}
         if label is not None:
@@ -363,13 +873,17 @@ class DepressionClassifier(Model):
             for metric in self.metrics.values():
                 metric(logits, label.squeeze(-1))
             output_dict["loss"] = loss
+
+        if instrumentation.is_enabled():
+            instrumentation.count(instrumentation.COUNT_USERS, len(user_id))
+            instrumentation.count(instrumentation.COUNT_POSTS, int(batch_content_mask.sum()))
+            logger.debug("batch stages: %s", instrumentation.summary(instrumentation.end_batch()))
         return output_dict
 
     @overrides
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         f1_measures = self.metrics["f1"].get_metric(reset=reset)
-        print(f1_measures)
-        print()
+        logger.debug("f1 measures: %s", f1_measures)
         return {
             # https://github.com/allenai/allennlp/issues/1863
             # f1 get_metric returns (precision, recall, f1)
@@ -402,20 +916,102 @@ class DepressionClassifier(Model):
     def batch_encoding(self, user_ids: List, maximum_sequence_length=MAXIMUM_POST_SEQ_SIZE):
         # print()
         # pp(user_ids)
-        timestamped_print("encode posts per user in batch ...")
-        timestamped_print("First two user ids in current batch: [%s] and [%s]" % (str(user_ids[0]),
-                                                                                  str(user_ids[1])))
-
-        post_set_list = [list(load_user_posts(user_id))
-                         for user_id in user_ids]
-        post_set_list = [post_list
-                         for post_list in post_set_list]
+        logger.debug("encode posts per user in batch ...")
+        logger.debug("First user ids in current batch: %s", [str(user_id) for user_id in user_ids[:2]])
+
+        # take precomputed embeddings and metric scores from shards (if set), load posts of other users
+        post_set_list = [None] * len(user_ids)
+        post_embeddings_list = [None] * len(user_ids)
+        metric_scores_list = [None] * len(user_ids)
+        users_to_encode = []
+        for i, user_id in enumerate(user_ids):
+            precomputed = self.embedding_shards.load_user(user_id) \
+                if self.embedding_shards is not None else None
+            if precomputed is None:
+                users_to_encode.append(i)
+            else:
+                # texts are not needed, embeddings and metric scores are precomputed
+                post_embeddings, post_timestamps, metric_scores = precomputed
+                post_set_list[i] = precomputed_post_set(post_timestamps)
+                post_embeddings_list[i] = post_embeddings
+                metric_scores_list[i] = torch.tensor(
+                    metric_scores).float()
+
+        # load posts concurrently (prefetched while the previous batch was encoded if the data loader
+        # is wrapped with PostPrefetchDataLoader)
+        post_prefetcher = self.get_post_prefetcher()
+        if len(users_to_encode) < len(user_ids):
+            post_prefetcher.discard(user_id for i, user_id in enumerate(user_ids) if post_set_list[i] is not None)
+        with instrumentation.stage(instrumentation.STAGE_POST_LOAD):
+            loaded_post_sets, load_errors = post_prefetcher.fetch([user_ids[i] for i in users_to_encode])
+        for i, user_post_set in zip(users_to_encode, loaded_post_sets):
+            if user_post_set is None:
+                timestamped_print("failed to load posts of user [%s]: %s" % (
+                    user_ids[i], load_errors[str(user_ids[i])]))
+                user_post_set = UserPostSet.from_posts([], [])
+            post_set_list[i] = user_post_set
+        logger.debug("posts of [%s] users loaded: [%.3f]s loading time, [%.3f]s waited "
+                     "(%.0f%% of loading time hidden so far)", len(users_to_encode), post_prefetcher.last_load_seconds,
+                     post_prefetcher.last_wait_seconds, 100 * post_prefetcher.hidden_fraction())
+
+        fingerprints = [individual_post_set.fingerprint() for individual_post_set in post_set_list]
+        # metric scores of unchanged post sets are read from the feature store
+        stored_metric_scores = self.feature_store.get_many(
+            [(user_ids[i], fingerprints[i]) for i in users_to_encode])
+        for i, metric_scores in zip(users_to_encode, stored_metric_scores):
+            if metric_scores is not None:
+                metric_scores_list[i] = torch.from_numpy(metric_scores)
+
+        # sentiment scoring of the other users runs in worker processes while the posts are encoded
+        pending_sentiment_scores_list = [
+            self._submit_sentiment_scoring(post_set_list[i])
+            if metric_scores_list[i] is None and len(post_set_list[i]) > 0 else None
+            for i in range(len(user_ids))]
+
+        # representative posts selected for unchanged post sets in earlier epochs, only those are encoded
+        to_reduce = [i for i in range(len(user_ids)) if len(post_set_list[i]) > NUM_REPRESENTATIVE_POSTS]
+        selected_indices_list = [None] * len(user_ids)
+        for i, selected_indices in zip(to_reduce, self.selection_store.get_many(
+                [(user_ids[i], fingerprints[i]) for i in to_reduce])):
+            selected_indices_list[i] = selected_indices
+        if self.proxy_selector is not None:
+            # representatives of the other users with posts to encode are selected from the post texts
+            proxy_selected = [i for i in users_to_encode if i in to_reduce and selected_indices_list[i] is None]
+            for i in proxy_selected:
+                selected_indices_list[i] = self.proxy_selector.select(post_set_list[i].timestamps,
+                                                                      post_set_list[i].texts())
+            self.selection_store.put_many([(user_ids[i], fingerprints[i], selected_indices_list[i])
+                                           for i in proxy_selected])
+        selected_posts_only = [i in users_to_encode and selected_indices_list[i] is not None
+                               for i in range(len(user_ids))]
+
+        # encode posts of all other users in one go, sorted by length into mini-batches
+        encoded_post_embeddings_list = self._encode_post_sets(
+            [post_set_list[i].subset(selected_indices_list[i]) if selected_posts_only[i] else post_set_list[i]
+             for i in users_to_encode])
+        for i, post_embeddings in zip(users_to_encode, encoded_post_embeddings_list):
+            post_embeddings_list[i] = post_embeddings
+
+        # representative posts of the other users with more posts than clusters, clustered at once (in parallel
+        # by the post reducer if it has worker processes)
+        to_select = [i for i in to_reduce if selected_indices_list[i] is None]
+        selections = select_representatives([user_ids[i] for i in to_select],
+                                             [np.asarray(post_embeddings_list[i]) for i in to_select],
+                                             self.post_reducer)
+        for i, selected_indices in zip(to_select, selections):
+            selected_indices_list[i] = selected_indices
+        self.selection_store.put_many([(user_ids[i], fingerprints[i], selected_indices_list[i]) for i in to_select])
         # loading posts and setting posts to maximum sequence_length
         content_tensor_in_batch = []
         metric_scores_in_batch = []
-        for user_id, individual_post_set in zip(user_ids, post_set_list):
+        for user_id, individual_post_set, post_embeddings, metric_scores, pending_sentiment_scores, \
+                selected_indices, selected_only in zip(user_ids, post_set_list, post_embeddings_list,
+                                                       metric_scores_list, pending_sentiment_scores_list,
+                                                       selected_indices_list, selected_posts_only):
             content_tensor, metric_scores = self._context_sequence_encoding(
-                user_id, individual_post_set, content_option='post')
+                user_id, individual_post_set, content_option='post', post_embeddings=post_embeddings,
+                metric_scores=metric_scores, pending_sentiment_scores=pending_sentiment_scores,
+                selected_indices=selected_indices, selected_posts_only=selected_only)
             # metric_scores = torch.tensor(metric_scores)
             # metric_scores = metric_scores.float()
             # metric_scores_reshaped = F.pad(
@@ -431,26 +1027,30 @@ class DepressionClassifier(Model):
                 "Error: context propagation encoding size [%s] does not match the size of input posts [%s]. "
                 % (len(content_tensor_in_batch), len(user_ids)))
 
-        timestamped_print(
-            "done post & metaphor encoding! Padding and normalise sequence tensors for current batch now...")
+        logger.debug("done post & metaphor encoding! Padding and normalise sequence tensors for current batch now...")
 
         content_tensor_in_batch_padded = torch.Tensor()
         batch_content_mask = torch.Tensor()
 
-        content_tensor_in_batch_padded, batch_content_mask = self.padding_and_norm_propagation_tensors(
-            content_tensor_in_batch,
-            maximum_sequence_length=maximum_sequence_length)
-
-        timestamped_print(
-            "Done. propagation tensors after batch normalisation: post content shape [%s]" %
-            (str(content_tensor_in_batch_padded.size())))
-
-        timestamped_print("post masking: content [%s]" % (
-            str(batch_content_mask.shape)))
+        with instrumentation.stage(instrumentation.STAGE_PAD):
+            content_tensor_in_batch_padded, batch_content_mask = self.padding_and_norm_propagation_tensors(
+                content_tensor_in_batch,
+                maximum_sequence_length=maximum_sequence_length)
 
-        print("new tenor size:", content_tensor_in_batch_padded.shape)
+        logger.debug("Done. propagation tensors after batch normalisation: post content shape [%s]",
+                     content_tensor_in_batch_padded.size())
+        logger.debug("post masking: content [%s]", batch_content_mask.shape)
         return content_tensor_in_batch_padded, batch_content_mask, metric_scores_in_batch
 
+    def pad_precomputed_sequences(self, post_sequence: torch.Tensor, post_mask: torch.Tensor,
+                                  maximum_sequence_length=MAXIMUM_POST_SEQ_SIZE) -> (torch.FloatTensor, torch.Tensor):
+        """
+        precomputed post sequences are already padded to the longest sequence in the batch (by the data loader),
+        as `padding_and_norm_propagation_tensors` does for sequences encoded in the model. Batches handed over in
+        shared-memory slots (see shared_batches.py) are views of the slot and are not copied here either.
+        """
+        return post_sequence.float(), post_mask.bool()
+
     @overrides
     def make_output_human_readable(self, output_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """
@@ -468,36 +1068,31 @@ class DepressionClassifier(Model):
         argmax_indices = np.argmax(predictions, axis=-1)
         labels = [self.vocab.get_token_from_index(x, namespace="label")
                   for x in argmax_indices]
-        timestamped_print("labels <- decode: %s" % labels)
+        logger.debug("labels <- decode: %s", labels)
 
         output_dict['label'] = labels
         return output_dict
 
     def padding_and_norm_propagation_tensors(self, list_of_context_seq_tensor: List[torch.FloatTensor],
-                                             maximum_sequence_length=100) -> (torch.FloatTensor, torch.uint8):
+                                             maximum_sequence_length=100) -> (torch.FloatTensor, torch.BoolTensor):
         """
         padding and masking
 
-        :param list_of_context_seq_tensor:
-        :param maximum_cxt_sequence_length:
+        Sequences are copied into one preallocated tensor, padded to the longest sequence in the batch only;
+        padded positions are masked in attention, so the padded length does not change the result.
+
+        :param list_of_context_seq_tensor: (number of posts, 768) sequence tensor per user
+        :param maximum_sequence_length: not used for padding, kept for compatibility
         :return: padded batch context tensor, batch context mask (for attention)
         """
+        sequence_lengths = [context_seq_tensor.shape[0] for context_seq_tensor in list_of_context_seq_tensor]
+        feature_dim = list_of_context_seq_tensor[0].shape[1]
         try:
-
-            batch_cxt_mask = self.creating_batch_context_tensor_mask(
-                list_of_context_seq_tensor, maximum_sequence_length)
-
-            feature_dim = list_of_context_seq_tensor[0].shape[1]
-            # print("length of list: ", feature_dim)
-            # print("tensor shape", list_of_context_seq_tensor[0].shape)
-            list_of_context_seq_tensor.insert(
-                0, torch.zeros(maximum_sequence_length, feature_dim))
-            # zero padding
-            batch_propagation_tensors = torch.nn.utils.rnn.pad_sequence(
-                list_of_context_seq_tensor, batch_first=True)
-            # dummy tensor to make all context seq tensors of same length
-            # remove the dummy tensor
-            batch_propagation_tensors = batch_propagation_tensors[1:]
+            batch_propagation_tensors = torch.zeros(len(list_of_context_seq_tensor), max(sequence_lengths),
+                                                    feature_dim, dtype=torch.float32,
+                                                    device=list_of_context_seq_tensor[0].device)
+            for i, context_seq_tensor in enumerate(list_of_context_seq_tensor):
+                batch_propagation_tensors[i, :sequence_lengths[i]].copy_(context_seq_tensor)
 
         except RuntimeError as err:
             print(err)
@@ -509,76 +1104,57 @@ class DepressionClassifier(Model):
 
             raise err
 
-        timestamped_print("tensor size after padding: %s" % str(
-            batch_propagation_tensors.size()))  # -> (batch_size, padded size of context sequence, dimension of instance reqpresentation)
+        batch_cxt_mask = self.creating_batch_context_tensor_mask(
+            list_of_context_seq_tensor, batch_propagation_tensors.size(1))
+
+        # -> (batch_size, padded size of context sequence, dimension of instance reqpresentation)
+        logger.debug("tensor size after padding: %s", batch_propagation_tensors.size())
 
-        batch_size = batch_propagation_tensors.size()[0]
         if self.bn_input:
-            normalised_propagation_tensor = torch.stack(
-                [self.bn_input(batch_propagation_tensors[i]) for i in range(batch_size)])
-        else:
-            normalised_propagation_tensor = torch.stack(
-                [batch_propagation_tensors[i] for i in range(batch_size)])
+            batch_propagation_tensors = torch.stack(
+                [self.bn_input(batch_propagation_tensors[i]) for i in range(batch_propagation_tensors.size(0))])
 
-        return normalised_propagation_tensor.float(), batch_cxt_mask
+        return batch_propagation_tensors, batch_cxt_mask
 
     def creating_batch_context_tensor_mask(self, list_of_context_seq_tensor: List[torch.FloatTensor],
                                            maximum_sequence_length=300):
         """
         creating mask for attention
-        :param context_tensor_seq:
-        :return: ByteTensor (a Boolean tensor) (torch.uint8)
+        :param list_of_context_seq_tensor: sequence tensor per user
+        :param maximum_sequence_length: padded sequence length
+        :return: (batch, maximum_sequence_length) BoolTensor, True for posts and False for padding, on the device
+            of the sequences
         """
-        vary_cxt_lengths = torch.stack(
-            [torch.as_tensor(tensor_cxt_tensor.shape[0], dtype=torch.float) for tensor_cxt_tensor in
-             list_of_context_seq_tensor])
-
-        idxes = torch.arange(0, maximum_sequence_length,
-                             out=torch.FloatTensor(maximum_sequence_length)).unsqueeze(0)
-
-        if torch.cuda.is_available():
-            idxes = idxes.cuda()
-            vary_cxt_lengths = vary_cxt_lengths.cuda()
-        else:
-            idxes.cpu()
-            vary_cxt_lengths.cpu()
-
-        mask = idxes < vary_cxt_lengths.unsqueeze(1)
-
-        return mask
+        device = list_of_context_seq_tensor[0].device
+        vary_cxt_lengths = torch.tensor([tensor_cxt_tensor.shape[0] for tensor_cxt_tensor in
+                                         list_of_context_seq_tensor], device=device)
+        idxes = torch.arange(maximum_sequence_length, device=device).unsqueeze(0)
+        return idxes < vary_cxt_lengths.unsqueeze(1)
 
     def kmeans_clustering(self, embedding_tensor):
-        # Extract data from embedding_tensor
-        data = np.array([item[0] for item in embedding_tensor])
-        print("called: ", data.shape)
-        # Define the number of clusters (assuming you want 200 clusters)
-        num_clusters = 200
-
-        # Perform K-means clustering
-        kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init=10)
-        cluster_ids = kmeans.fit_predict(data)
-        # Assign each point to its nearest cluster center
-        clusters = [[] for _ in range(num_clusters)]
-        for i, cluster_id in enumerate(cluster_ids):
-            clusters[cluster_id].append(embedding_tensor[i])
-
-        # Return the clusters
-        result = []
-
-        result = []
-
-        for cluster in clusters:
-            if cluster:  # Check if the sublist is not empty
-                result.append(cluster[-1])
-
-        return result
-
-    def _context_sequence_encoding(self, user_id: str, individual_post_set: List[Dict], content_option) -> (
+        return kmeans_clustering(embedding_tensor)
+
+    def _submit_sentiment_scoring(self, individual_post_set: UserPostSet) -> PendingSentimentScores:
+        if len(individual_post_set) <= MIN_POSTS_FOR_METRICS:
+            # too few posts for sentiment features (all 0), nothing to score
+            return PendingSentimentScores(None, np.zeros((len(individual_post_set), 2)), [])
+        return self.get_sentiment_scorer().submit(individual_post_set.texts())
+
+    def _context_sequence_encoding(self, user_id: str, individual_post_set: UserPostSet, content_option,
+                                   post_embeddings: np.ndarray = None,
+                                   metric_scores: torch.FloatTensor = None,
+                                   pending_sentiment_scores: PendingSentimentScores = None,
+                                   selected_indices: np.ndarray = None, selected_posts_only: bool = False) -> (
             torch.FloatTensor, torch.FloatTensor):
         """
         prepare sorted post sequence:
         :param: user ids
         :param: individual_post_set: posts per user
+        :param: post_embeddings: embeddings of the posts if already encoded for the whole batch
+        :param: metric_scores: metric scores if precomputed or stored for the current post set
+        :param: pending_sentiment_scores: sentiment scores of the posts if already submitted for the whole batch
+        :param: selected_indices: representative posts if already selected for the whole batch
+        :param: selected_posts_only: post_embeddings are the embeddings of the selected posts only
         :return:List[torch.FloatTensor], sequence tensor from temporally sorted encodings of posts
         """
         EXPECTED_ENCODER_INPUT_DIM = 768
@@ -595,32 +1171,40 @@ class DepressionClassifier(Model):
             # metric_scores = np.zeroes(10)
         else:
             try:
-                all_post_content_embeddings = []
-                for post in individual_post_set:
-                    post_embedding = encode_content_manual(
-                        self.post_encoder, self.embedding_model, self.embedding_tokenizer, post)
-                    all_post_content_embeddings.append(post_embedding)
-
-                if user_id not in user_metric_scores:
-                    metric_scores = calculate_metrics(individual_post_set)
+                if post_embeddings is None:
+                    # representative posts selected for the same post set in an earlier epoch
+                    if selected_indices is None and len(individual_post_set) > NUM_REPRESENTATIVE_POSTS:
+                        selected_indices = self.selection_store.get(user_id, individual_post_set.fingerprint())
+                        if selected_indices is None and self.proxy_selector is not None:
+                            selected_indices = self.proxy_selector.select(individual_post_set.timestamps,
+                                                                          individual_post_set.texts())
+                            self.selection_store.put(user_id, individual_post_set.fingerprint(), selected_indices)
+                    selected_posts_only = selected_indices is not None
+                    post_embeddings = self._encode_post_sets(
+                        [individual_post_set.subset(selected_indices) if selected_posts_only
+                         else individual_post_set])[0]
+
+                if metric_scores is None:
+                    if pending_sentiment_scores is None:
+                        pending_sentiment_scores = self._submit_sentiment_scoring(individual_post_set)
+                    with instrumentation.stage(instrumentation.STAGE_SENTIMENT):
+                        metric_scores = calculate_metrics(*pending_sentiment_scores.result())
                     metric_scores = torch.tensor(metric_scores)
                     metric_scores = metric_scores.float()
-                    user_metric_scores[user_id] = metric_scores
-
-                # print(len(all_post_content_embeddings))
-
-                if len(all_post_content_embeddings) > 200:
-                    post_embedding_array = [(embedding, post) for embedding, post in zip(
-                        all_post_content_embeddings, individual_post_set)]
-                    post_embedding_array = self.kmeans_clustering(
-                        post_embedding_array)
-                    individual_post_set = [item[1]
-                                           for item in post_embedding_array]
-                    all_post_content_embeddings = [item[0]
-                                                   for item in post_embedding_array]
-
-                post_content_seq_tensor = self.sort_encoding_with_time_sequence(
-                    individual_post_set, all_post_content_embeddings)
+                    self.feature_store.put(user_id, individual_post_set.fingerprint(), metric_scores.numpy())
+
+                post_timestamps = individual_post_set.timestamps
+                if selected_posts_only:
+                    post_timestamps = post_timestamps[selected_indices]
+                    selected_indices = np.arange(len(selected_indices))
+                elif selected_indices is None and len(post_embeddings) > NUM_REPRESENTATIVE_POSTS:
+                    selected_indices = select_representatives(
+                        [user_id], [np.asarray(post_embeddings)], self.post_reducer)[0]
+                    self.selection_store.put(user_id, individual_post_set.fingerprint(), selected_indices)
+
+                # sort posts chronologically with one gather on the embedding array
+                post_content_seq_tensor = reduce_and_sort_post_sequence(
+                    post_timestamps, np.asarray(post_embeddings), selected_indices=selected_indices)
                 # print("size after sorting:", post_content_seq_tensor.shape)
                 # sort posts chronFologically
             except:
@@ -628,33 +1212,29 @@ class DepressionClassifier(Model):
                     "Unexpected error when encoding user [%s]'s posts" % user_id, sys.exc_info()[0])
                 raise
 
-        return post_content_seq_tensor, user_metric_scores[user_id]
+        if metric_scores is None:
+            metric_scores = torch.zeros(NUM_SENTIMENT_FEATURES)
+        return post_content_seq_tensor, metric_scores
 
-    def sort_encoding_with_time_sequence(self, individual_post_set: List[Dict],
-                                         all_post_content_embeddings: List[np.ndarray]) -> (
-            torch.FloatTensor, torch.FloatTensor):
+    def _encode_post_sets(self, post_set_list: List[UserPostSet]) -> List[np.ndarray]:
         """
-        put post representation in temporal order before feeding into LSTM
-        """
-        cxt_size = len(individual_post_set)
-        content_embedding_time_seq = []
-        for i in range(0, cxt_size):
-            post_i = individual_post_set[i]
-            post_embedding_i = all_post_content_embeddings[i]
+        encode the posts of all users in a batch at once, looking up the embedding cache first (if set)
 
-            post_timestamp = datetime.strptime(post_i["timestamp"],
-                                               '%Y-%m-%d %H:%M:%S')  # timestamp
-            content_embedding_time_seq.append(
-                (post_timestamp, post_embedding_i))
+        :param post_set_list: posts per user
+        :return: embedding array (number of posts, 768) per user
+        """
+        all_texts = [text for individual_post_set in post_set_list for text in individual_post_set.texts()]
+        all_post_embeddings = encode_post_texts(self.embedding_model, self.embedding_tokenizer, all_texts,
+                                                batch_size=self.encoding_batch_size,
+                                                embedding_cache=self.embedding_cache)
 
-        content_embedding_time_seq_sorted = sorted(content_embedding_time_seq[:], key=operator.itemgetter(0),
-                                                   reverse=False)
+        post_set_offsets = np.cumsum([0] + [len(individual_post_set) for individual_post_set in post_set_list])
+        return [all_post_embeddings[post_set_offsets[i]:post_set_offsets[i + 1]] for i in range(len(post_set_list))]
 
-        content_seq_representation: List[np.ndarray] = [post_representation[1] for post_representation in
-                                                        content_embedding_time_seq_sorted]
-        content_seq_representation = np.array(content_seq_representation)
-        # print("shape inside sorting:", content_seq_representation.shape)
-        return torch.as_tensor(content_seq_representation, dtype=torch.float32)
+    def sort_encoding_with_time_sequence(self, individual_post_set: List[Dict],
+                                         all_post_content_embeddings: List[np.ndarray]) -> (
+            torch.FloatTensor, torch.FloatTensor):
+        return sort_encoding_with_time_sequence(individual_post_set, all_post_content_embeddings)
 
 
 @Predictor.register('depression_user_tagger')
@@ -687,12 +1267,48 @@ training_losses = []
 
 @TrainerCallback.register("track_epoch_callback_depression")
 class TrackEpochCallback(TrainerCallback):
+    """
+    tracks the training loss and appends the throughput and memory telemetry of every epoch (training and
+    validation) as a json line to a run log:
+        users_per_s, posts_per_s, tokens_per_s -- users, unpadded posts and BERT tokens processed per second
+        peak_rss_mb                             -- peak resident memory of the training process in the epoch
+        torch_peak_allocated_mb                 -- peak memory of the CUDA caching allocator (None on CPU)
+        data_wait_s, compute_s                  -- time waiting for batches (see TimedDataLoader) and the rest
+        stage_seconds                           -- per-stage times (see instrumentation.py)
+
+    Users, posts and tokens are counted in the training process only: posts encoded in data loader workers are
+    counted, their tokens are not. The counters are instrumentation counters: a run log enables the instrumentation,
+    without a run log (and without --instrumentation) the training runs uninstrumented.
+    """
+
+    def __init__(self, serialization_dir: str, run_log_path: str = None, run_info: Dict = None):
+        """
+        :param run_log_path: json lines file the epochs are appended to (no run log if None)
+        :param run_info: settings of the run, written with every epoch (e.g., to compare runs and nodes)
+        """
+        super().__init__(serialization_dir)
+        self.run_log_path = run_log_path
+        self.run_info = run_info or {}
+        self._epoch_start_time = None
+
     def on_start(self, trainer: "GradientDescentTrainer", is_primary: bool = True, **kwargs):
         super().on_start(trainer, is_primary)
         self.train_losses = []
         self.val_losses = []
+        self.run_start_time = datetime.now().isoformat(timespec='seconds')
+        if self.run_log_path:
+            # users, posts and tokens are counted by the instrumentation counters
+            instrumentation.enable()
+            instrumentation.end_epoch()
+        self._reset_peak_memory()
+        self._epoch_start_time = time.perf_counter()
         print("Hello, initialised!!")
 
+    def _reset_peak_memory(self):
+        reset_peak_rss()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
     def on_epoch(
         self,
         trainer: "GradientDescentTrainer",
@@ -703,11 +1319,203 @@ class TrackEpochCallback(TrainerCallback):
     ):
         print(f"Metrics at the end of epoch: {epoch}", metrics)
         training_losses.append(metrics['training_loss'])
+        if data_loader.user_posts_cache is not None:
+            print("user posts cache: ", data_loader.user_posts_cache.stats())
+        if getattr(trainer.model, "sentiment_scorer", None) is not None:
+            print("sentiment scores: ", trainer.model.sentiment_scorer.stats())
+        if instrumentation.is_enabled():
+            # training and validation batches of the epoch
+            epoch_stats = instrumentation.end_epoch()
+            print("pipeline stages: ", instrumentation.summary(epoch_stats))
+            if self.run_log_path and is_primary:
+                self._log_epoch(epoch, metrics, epoch_stats)
+        self._reset_peak_memory()
+        self._epoch_start_time = time.perf_counter()
+
+    def _log_epoch(self, epoch: int, metrics: Dict, epoch_stats: Dict):
+        epoch_seconds = time.perf_counter() - self._epoch_start_time
+        counts, stage_seconds = epoch_stats.get("counts", {}), epoch_stats.get("seconds", {})
+        data_wait_seconds = stage_seconds.get(instrumentation.STAGE_DATA_WAIT, 0.0)
+        torch_peak_allocated_mb = torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else None
+        record = dict(self.run_info)
+        record.update({
+            "run_start": self.run_start_time,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "epoch": epoch,
+            "time": datetime.now().isoformat(timespec='seconds'),
+            "epoch_s": epoch_seconds,
+            "batches": epoch_stats.get("batches", 0),
+            "users": counts.get(instrumentation.COUNT_USERS, 0),
+            "posts": counts.get(instrumentation.COUNT_POSTS, 0),
+            "encoded_tokens": counts.get(instrumentation.COUNT_ENCODED_TOKENS, 0),
+            "users_per_s": counts.get(instrumentation.COUNT_USERS, 0) / max(epoch_seconds, 1e-9),
+            "posts_per_s": counts.get(instrumentation.COUNT_POSTS, 0) / max(epoch_seconds, 1e-9),
+            "tokens_per_s": counts.get(instrumentation.COUNT_ENCODED_TOKENS, 0) / max(epoch_seconds, 1e-9),
+            "peak_rss_mb": memory_status().get("VmHWM", 0) / 1024,
+            "torch_peak_allocated_mb": torch_peak_allocated_mb,
+            "data_wait_s": data_wait_seconds,
+            "compute_s": epoch_seconds - data_wait_seconds,
+            "stage_seconds": stage_seconds,
+            "metrics": {name: value for name, value in metrics.items() if isinstance(value, (int, float, str))},
+        })
+        with open(self.run_log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+@TrainerCallback.register("torch_profiler_depression")
+class TorchProfilerCallback(TrainerCallback):
+    """
+    record torch.profiler profiles over a window of training steps: after `wait` steps, `warmup` steps are
+    profiled and discarded, the next `active` steps are recorded, `repeat` times (0: until training ends).
+
+    For every recorded window, <serialization dir>/profiler/ gets:
+        step_<step>.trace.json   -- Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+        step_<step>.stacks.txt   -- self time per Python/C++ stack, in the collapsed format of flame graph tools
+        step_<step>.summary.txt  -- operators and labelled ranges by self time, grouped by their top 5 frames
+
+    Pipeline stages (see instrumentation.py), every attention block (HAN_block) and per-post encoding
+    (encode_content_manual) are labelled ranges of the profiles.
+    """
+
+    def __init__(self, serialization_dir: str, wait: int = 1, warmup: int = 1, active: int = 3, repeat: int = 1,
+                 record_shapes: bool = False, profile_memory: bool = False, with_stack: bool = True):
+        super().__init__(serialization_dir)
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.repeat = repeat
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.with_stack = with_stack
+        self.profile_dir = os.path.join(serialization_dir, "profiler")
+        self._profiler = None
+
+    def on_start(self, trainer: "GradientDescentTrainer", is_primary: bool = True, **kwargs):
+        super().on_start(trainer, is_primary)
+        if not is_primary:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler_options = {}
+        if self.with_stack and hasattr(torch._C._profiler, "_ExperimentalConfig"):
+            # stacks are only exported with verbose events
+            profiler_options["experimental_config"] = torch._C._profiler._ExperimentalConfig(verbose=True)
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=self.wait, warmup=self.warmup, active=self.active,
+                                             repeat=self.repeat),
+            on_trace_ready=self._export_profile, record_shapes=self.record_shapes,
+            profile_memory=self.profile_memory, with_stack=self.with_stack, **profiler_options)
+        instrumentation.enable_profiling()
+        self._profiler.start()
+        timestamped_print("profiling training steps (wait %s, warmup %s, active %s, repeat %s) into [%s]" % (
+            self.wait, self.warmup, self.active, self.repeat, self.profile_dir))
+
+    def on_batch(self, trainer: "GradientDescentTrainer", batch_inputs: List[TensorDict],
+                 batch_outputs: List[Dict[str, Any]], batch_metrics: Dict[str, Any], epoch: int, batch_number: int,
+                 is_training: bool, is_primary: bool = True, batch_grad_norm: Optional[float] = None, **kwargs):
+        if is_training and self._profiler is not None:
+            self._profiler.step()
+
+    def on_end(self, trainer: "GradientDescentTrainer", metrics: Dict[str, Any] = None, epoch: int = None,
+               is_primary: bool = True, **kwargs):
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+            instrumentation.enable_profiling(False)
+
+    def _export_profile(self, profiler):
+        prefix = os.path.join(self.profile_dir, "step_%s" % profiler.step_num)
+        profiler.export_chrome_trace(prefix + ".trace.json")
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        if self.with_stack:
+            profiler.export_stacks(prefix + ".stacks.txt", sort_by)
+        with open(prefix + ".summary.txt", "w", encoding="utf-8") as f:
+            f.write(profiler.key_averages(group_by_stack_n=5 if self.with_stack else 0).table(
+                sort_by=sort_by, row_limit=100))
+        timestamped_print("profile of training step [%s] written to [%s.*]" % (profiler.step_num, prefix))
+
+
+class TimedDataLoader(AllennlpDataLoader):
+    """
+    wrap a data loader to add the time the trainer waits for every batch to the data wait stage (see
+    instrumentation.py)
+    """
+
+    def __init__(self, data_loader: AllennlpDataLoader):
+        self.data_loader = data_loader
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def __iter__(self) -> Iterator[TensorDict]:
+        batches = iter(self.data_loader)
+        while True:
+            start = time.perf_counter()
+            batch = next(batches, None)
+            instrumentation.add_seconds(instrumentation.STAGE_DATA_WAIT, time.perf_counter() - start)
+            if batch is None:
+                break
+            yield batch
+
+    def iter_instances(self) -> Iterator[Instance]:
+        return self.data_loader.iter_instances()
+
+    def index_with(self, vocab: Vocabulary) -> None:
+        self.data_loader.index_with(vocab)
+
+    def set_target_device(self, device: torch.device) -> None:
+        self.data_loader.set_target_device(device)
+
+
+class PostPrefetchDataLoader(AllennlpDataLoader):
+    """
+    wrap a data loader to start loading the posts of the next batch's users while the current batch is processed
+    """
+
+    def __init__(self, data_loader: AllennlpDataLoader, post_prefetcher: UserPostPrefetcher):
+        self.data_loader = data_loader
+        self.post_prefetcher = post_prefetcher
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def __iter__(self) -> Iterator[TensorDict]:
+        batches = iter(self.data_loader)
+        next_batch = next(batches, None)
+        while next_batch is not None:
+            batch = next_batch
+            next_batch = next(batches, None)
+            if next_batch is not None:
+                self.post_prefetcher.prefetch(next_batch['user_id'])
+            yield batch
+
+    def iter_instances(self) -> Iterator[Instance]:
+        return self.data_loader.iter_instances()
+
+    def index_with(self, vocab: Vocabulary) -> None:
+        self.data_loader.index_with(vocab)
+
+    def set_target_device(self, device: torch.device) -> None:
+        self.data_loader.set_target_device(device)
 
 
 def model_training(train_set_path, validation_set_path, test_set_path, n_gpu: Union[int, List] = -1,
                    train_batch_size: int = 100, model_file_prefix="", num_epochs: int = 2,
-                   max_post_size_option: int = MAXIMUM_POST_SEQ_SIZE):
+                   max_post_size_option: int = MAXIMUM_POST_SEQ_SIZE,
+                   embedding_cache_dir: str = None, embedding_cache_size_mb: float = DEFAULT_CACHE_SIZE_MB,
+                   encoding_batch_size: int = DEFAULT_ENCODING_BATCH_SIZE, embedding_shard_dir: str = None,
+                   head_only: bool = False, post_loader_workers: int = DEFAULT_POST_LOADER_WORKERS,
+                   sentiment_workers: int = DEFAULT_SENTIMENT_WORKERS, feature_store_path: str = None,
+                   post_reducer: str = REDUCER_KMEANS, reducer_projection_dim: int = None,
+                   reducer_warm_start: bool = False,
+                   warm_start_cache_size_mb: float = DEFAULT_WARM_START_CACHE_SIZE_MB,
+                   reducer_workers: int = 0, proxy_selection: str = None,
+                   batch_post_budget: int = None, num_workers: int = 0, shared_batch_slots: int = None,
+                   run_log_path: str = None, profile_schedule: Tuple[int, int, int, int] = None):
     """
     https://guide.allennlp.org/training-and-prediction#1
     :param train_set_path:
@@ -719,8 +1527,39 @@ def model_training(train_set_path, validation_set_path, test_set_path, n_gpu: Un
     :param num_epochs:
     :param post_encoder_option:
     :param max_post_size_option:
+    :param embedding_cache_dir: directory of the persistent post embedding cache (no caching if None)
+    :param embedding_cache_size_mb: size cap of the post embedding cache
+    :param encoding_batch_size: number of posts per forward pass of the embedding model
+    :param embedding_shard_dir: directory of precomputed post embedding shards (see precompute_embeddings.py)
+    :param head_only: train the attention blocks and feedforward only on post sequences read from
+        embedding_shard_dir, without loading the embedding model
+    :param post_loader_workers: number of threads loading user posts, the next batch is prefetched
+    :param sentiment_workers: number of processes scoring post sentiments, 0 to score in the training process
+    :param feature_store_path: SQLite database of metric scores and representative posts per user and post set
+        (kept in memory if None, a temporary database with data loader workers)
+    :param post_reducer: clustering of users with more than 200 posts, one of post_reduction.REDUCERS
+    :param reducer_projection_dim: random projection dimension of the torch reducer (no projection if None)
+    :param reducer_warm_start: initialise the clustering of every user from its previous epoch's centroids (in the
+        training process only, not in data loader workers)
+    :param warm_start_cache_size_mb: memory budget of the centroids kept for warm starts in MB
+    :param reducer_workers: number of processes clustering the users of a batch, 0 to cluster in the training process
+    :param proxy_selection: select representative posts before encoding, one of proxy_selection.PROXY_SELECTIONS
+        (post-encode clustering if None)
+    :param batch_post_budget: batch users of similar numbers of posts, up to this batch size x posts of the
+        heaviest user (batches of train_batch_size users if None)
+    :param num_workers: number of data loader worker processes. Users are loaded, scored and encoded in the workers
+        (on CPU) and streamed to the training process in chunks of a few batches, 0 to encode in the model's forward
+    :param shared_batch_slots: number of shared-memory batch slots the workers write padded batches into (see
+        shared_batches.py), num_workers + 2 if None, 0 to pass batches on the data loader queue
+    :param run_log_path: json lines file the throughput and memory telemetry of every epoch is appended to, enables
+        the instrumentation (no run log if None)
+    :param profile_schedule: (wait, warmup, active, repeat) training steps of torch.profiler profiles written to
+        the profiler directory of the serialization dir (see TorchProfilerCallback), no profiling if None
     :return:
     """
+    if head_only and not embedding_shard_dir:
+        raise ConfigurationError("head-only training requires precomputed embedding shards (embedding_shard_dir)")
+
     timestamped_print(
         "start to train ExplainableDepressionDetection model with training set [%s] and dev set [%s] with gpu [%s] ... " % (
             train_set_path, validation_set_path, n_gpu))
@@ -730,27 +1569,138 @@ def model_training(train_set_path, validation_set_path, test_set_path, n_gpu: Un
     n_gpu = config_gpu_use(n_gpu)
     timestamped_print("training batch size: [%s]" % train_batch_size)
 
+    encoding_in_workers = num_workers > 0 and not head_only
+    temporary_feature_store_dir = None
+    if num_workers > 0 and not feature_store_path:
+        # in-memory stores of the workers are lost when the workers exit every epoch, the metric scores and
+        # representative posts are shared by a temporary store instead, removed after the run
+        temporary_feature_store_dir = tempfile.TemporaryDirectory(prefix="depression_feature_store_")
+        feature_store_path = os.path.join(temporary_feature_store_dir.name, "features.db")
+        timestamped_print("no feature store set, data loader workers share the temporary feature store [%s]" %
+                          feature_store_path)
+    if num_workers > 0 and reducer_workers > 0:
+        # data loader workers are daemon processes, which cannot start a reducer process pool
+        timestamped_print("users are clustered in the data loader workers, reducer workers are not used")
+        reducer_workers = 0
+    post_reduction_engine = PostReductionEngine(
+        new_reducer(post_reducer, projection_dim=reducer_projection_dim,
+                    device="cuda" if torch.cuda.is_available() and reducer_workers == 0 and num_workers == 0
+                    else "cpu"),
+        warm_start=reducer_warm_start, num_workers=reducer_workers, warm_start_cache_size_mb=warm_start_cache_size_mb)
+    if reducer_warm_start and num_workers > 0:
+        # worker copies of the engine and their centroids are discarded every epoch
+        timestamped_print("warning: users are clustered in data loader workers, which are re-created every epoch, "
+                          "clustering is not warm-started")
+    if reducer_warm_start and feature_store_path:
+        timestamped_print("warning: representative posts of unchanged post sets are reused from the feature store "
+                          "[%s], warm starts only apply to users whose posts changed" % feature_store_path)
+
     token_indexer = ELMoTokenCharactersIndexer()
-    train_reader = DepressionDataReader(token_indexers={'elmo': token_indexer})
-    validation_reader = DepressionDataReader(
-        token_indexers={'elmo': token_indexer})
+    if head_only:
+        timestamped_print("head-only training on precomputed post sequences in [%s]" % embedding_shard_dir)
+        # representative posts are selected once and stored with the metric scores (if persisted)
+        selection_store = SelectionStore(feature_store_path, representative_selection_id(
+            EmbeddingShardReader(embedding_shard_dir).encoder_id, post_reduction_engine)) \
+            if feature_store_path else MemorySelectionStore()
+        train_reader = PrecomputedSequenceDataReader(
+            embedding_shard_dir, token_indexers={'elmo': token_indexer}, post_reducer=post_reduction_engine,
+            selection_store=selection_store)
+        validation_reader = PrecomputedSequenceDataReader(
+            embedding_shard_dir, token_indexers={'elmo': token_indexer}, post_reducer=post_reduction_engine,
+            selection_store=selection_store)
+    elif encoding_in_workers:
+        timestamped_print("posts are loaded and encoded in [%s] data loader worker processes" % num_workers)
+        proxy_selector = ProxyPostSelector(proxy_selection) if proxy_selection else None
+        selection_store = SelectionStore(feature_store_path, representative_selection_id(
+            embedding_model_id(AutoConfig.from_pretrained(EMBEDDING_MODEL_NAME)), post_reduction_engine,
+            proxy_selector)) if feature_store_path else None
+        # forked workers encode on CPU, CUDA is not re-initialised in forked processes
+        post_sequence_encoder = PostSequenceEncoder(
+            encoding_batch_size, device="cpu", embedding_cache_dir=embedding_cache_dir,
+            embedding_cache_size_mb=embedding_cache_size_mb, embedding_shard_dir=embedding_shard_dir,
+            feature_store=FeatureStore(feature_store_path) if feature_store_path else None,
+            selection_store=selection_store, post_reducer=post_reduction_engine, proxy_selector=proxy_selector)
+        train_reader = EncodingDataReader(post_sequence_encoder, token_indexers={'elmo': token_indexer})
+        validation_reader = EncodingDataReader(post_sequence_encoder, token_indexers={'elmo': token_indexer})
+    else:
+        train_reader = DepressionDataReader(token_indexers={'elmo': token_indexer})
+        validation_reader = DepressionDataReader(
+            token_indexers={'elmo': token_indexer})
     timestamped_print(
         "loading development dataset and indexing vocabulary  ... ")
-    train_set = list(train_reader.read(train_set_path))
-    validation_set = list(validation_reader.read(validation_set_path))
+    # only labels are indexed, user ids are enough to build the vocabulary
+    vocab_reader = DepressionDataReader(token_indexers={'elmo': token_indexer})
+    train_set = list(vocab_reader.read(train_set_path))
+    validation_set = list(vocab_reader.read(validation_set_path))
     vocab = Vocabulary.from_instances(train_set+validation_set)
-    train_loader = MultiProcessDataLoader(
-        train_reader, train_set_path, batch_size=train_batch_size, shuffle=True)
-    validation_loader = MultiProcessDataLoader(
-        validation_reader, validation_set_path, batch_size=train_batch_size, shuffle=True)
+    # with workers, instances are read (and shuffled) in chunks of a few batches instead of all at once, so that
+    # the encoded sequences of the whole dataset are never held in memory
+    max_instances_in_memory = train_batch_size * 8 if num_workers > 0 else None
+    # padded sequence batches are handed over from the workers in shared-memory slots
+    shared_batch_ring = None
+    if num_workers > 0 and shared_batch_slots != 0:
+        shared_batch_ring = SharedBatchRing(
+            shared_batch_slots or num_workers + 2,
+            max_batch_posts=max(batch_post_budget, NUM_REPRESENTATIVE_POSTS) if batch_post_budget
+            else train_batch_size * NUM_REPRESENTATIVE_POSTS,
+            max_batch_users=train_batch_size, num_metric_scores=NUM_SENTIMENT_FEATURES)
+        timestamped_print("batches are handed over in [%s] shared-memory slots" % shared_batch_ring.num_slots)
+    collate_fn = SharedMemoryBatchCollator(shared_batch_ring) if shared_batch_ring is not None \
+        else DefaultDataCollator()
+    if batch_post_budget:
+        timestamped_print("users are batched by number of posts, [%s] posts per batch" % batch_post_budget)
+        train_loader = MultiProcessDataLoader(
+            train_reader, train_set_path,
+            batch_sampler=new_post_budget_batch_sampler(batch_post_budget, train_batch_size,
+                                                        embedding_shard_dir if head_only else None),
+            num_workers=num_workers, max_instances_in_memory=max_instances_in_memory, collate_fn=collate_fn)
+        validation_loader = MultiProcessDataLoader(
+            validation_reader, validation_set_path,
+            batch_sampler=new_post_budget_batch_sampler(batch_post_budget, train_batch_size,
+                                                        embedding_shard_dir if head_only else None),
+            num_workers=num_workers, max_instances_in_memory=max_instances_in_memory, collate_fn=collate_fn)
+    else:
+        train_loader = MultiProcessDataLoader(
+            train_reader, train_set_path, batch_size=train_batch_size, shuffle=True,
+            num_workers=num_workers, max_instances_in_memory=max_instances_in_memory, collate_fn=collate_fn)
+        validation_loader = MultiProcessDataLoader(
+            validation_reader, validation_set_path, batch_size=train_batch_size, shuffle=True,
+            num_workers=num_workers, max_instances_in_memory=max_instances_in_memory, collate_fn=collate_fn)
     train_loader.index_with(vocab)
     validation_loader.index_with(vocab)
+    if shared_batch_ring is not None:
+        # training and validation batches are never iterated at the same time, so they share the slots
+        train_loader = SharedBatchDataLoader(train_loader, shared_batch_ring)
+        validation_loader = SharedBatchDataLoader(validation_loader, shared_batch_ring)
 
     timestamped_print("done. datasets loaded and vocab indexed completely.")
 
     timestamped_print("initialising ExplainableDepressionDetection model ... ")
-    model = instantiate_model(n_gpu, vocab)
+    model = instantiate_model(n_gpu, vocab, load_embedding_model=not head_only)
     model.set_max_post_size(max_post_size_option)
+    model.set_encoding_batch_size(encoding_batch_size)
+    if embedding_cache_dir and not head_only:
+        model.set_embedding_cache(EmbeddingCache(embedding_cache_dir, model.embedding_model_id,
+                                                 max_size_mb=embedding_cache_size_mb))
+    if embedding_shard_dir and not head_only:
+        model.set_embedding_shards(EmbeddingShardReader(embedding_shard_dir))
+    if encoding_in_workers:
+        # forked workers map the weights of the model's encoder instead of loading their own
+        post_sequence_encoder.set_embedding_model(model.shared_embedding_model())
+    if not head_only:
+        # the model still encodes the users of the final evaluation
+        post_prefetcher = UserPostPrefetcher(post_loader_workers)
+        model.set_post_prefetcher(post_prefetcher)
+        if not encoding_in_workers:
+            train_loader = PostPrefetchDataLoader(train_loader, post_prefetcher)
+            validation_loader = PostPrefetchDataLoader(validation_loader, post_prefetcher)
+        model.set_sentiment_scorer(SentimentScorer(sentiment_workers))
+        model.set_post_reducer(post_reduction_engine)
+        if proxy_selection:
+            model.set_proxy_selector(ProxyPostSelector(proxy_selection))
+        if feature_store_path:
+            model.set_feature_store(FeatureStore(feature_store_path))
+            model.set_selection_store(SelectionStore(feature_store_path, model.selection_id))
 
     total_params = sum(p.numel()
                        for p in model.parameters() if p.requires_grad)
@@ -762,12 +1712,31 @@ def model_training(train_set_path, validation_set_path, test_set_path, n_gpu: Un
     timestamped_print(
         "done. ExplainableDepressionDetection model is initialised completely.")
     timestamped_print("initialising optimiser and dataset iteractor ... ")
-    optimiser = optim.Adam(model.parameters(), lr=1e-4, weight_decay=1e-5)
+    trained_parameters = model.head_parameters() if head_only else model.parameters()
+    optimiser = optim.Adam(trained_parameters, lr=1e-4, weight_decay=1e-5)
 
     timestamped_print("done.")
 
     timestamped_print("training starting now ... ")
-    epoch_callback = TrackEpochCallback(serialization_dir='gradient_descent')
+    serialization_dir = 'gradient_descent'
+    os.makedirs(serialization_dir, exist_ok=True)
+    if run_log_path:
+        # the run log needs the instrumentation counters, it enables them
+        timestamped_print("epoch telemetry is appended to [%s]" % run_log_path)
+    run_info = {"train_set": train_set_path, "train_batch_size": train_batch_size,
+                "batch_post_budget": batch_post_budget, "encoding_batch_size": encoding_batch_size,
+                "head_only": head_only, "num_workers": num_workers, "post_reducer": post_reducer,
+                "proxy_selection": proxy_selection, "cuda": torch.cuda.is_available()}
+    epoch_callback = TrackEpochCallback(serialization_dir=serialization_dir, run_log_path=run_log_path,
+                                        run_info=run_info)
+    callbacks = [epoch_callback]
+    if profile_schedule:
+        profile_wait, profile_warmup, profile_active, profile_repeat = profile_schedule
+        callbacks.append(TorchProfilerCallback(serialization_dir=serialization_dir, wait=profile_wait,
+                                               warmup=profile_warmup, active=profile_active, repeat=profile_repeat))
+    # time waiting for batches, as opposed to computing them
+    train_loader = TimedDataLoader(train_loader)
+    validation_loader = TimedDataLoader(validation_loader)
     trainer = GradientDescentTrainer(
         model=model,
         optimizer=optimiser,
@@ -775,8 +1744,8 @@ def model_training(train_set_path, validation_set_path, test_set_path, n_gpu: Un
         validation_data_loader=validation_loader,
         num_epochs=num_epochs,
         cuda_device=n_gpu,
-        callbacks=[epoch_callback],
-        serialization_dir='gradient_descent',
+        callbacks=callbacks,
+        serialization_dir=serialization_dir,
     )
     trainer.train()
     timestamped_print("done.")
@@ -788,7 +1757,11 @@ def model_training(train_set_path, validation_set_path, test_set_path, n_gpu: Un
     plt.ylabel('Loss')
     plt.title('Training Loss Curve')
     plt.legend()
-    plt.show()
+    # saved instead of shown, training runs on headless servers
+    loss_curve_path = os.path.join(serialization_dir, "training_loss.png")
+    plt.savefig(loss_curve_path)
+    plt.close()
+    timestamped_print("training loss curve saved to [%s]" % loss_curve_path)
     try:
         archive_model_from_memory(model, vocab, model_file_prefix)
     except AttributeError as err:
@@ -796,7 +1769,10 @@ def model_training(train_set_path, validation_set_path, test_set_path, n_gpu: Un
         print(err)
 
     # quick_test(model)
-    evaluation(test_set_path, model, n_gpu)
+    evaluation(test_set_path, model, n_gpu,
+               embedding_shard_dir=embedding_shard_dir if head_only else None, batch_post_budget=batch_post_budget)
+    if temporary_feature_store_dir is not None:
+        temporary_feature_store_dir.cleanup()
 
 
 def encode_content(content_encoder, embedding_model, post_dict):
@@ -836,16 +1812,17 @@ def encode_content_manual(content_encoder, embedding_model, embedding_tokenizer,
         # print("post_dict:", post_dict)
         post_text = post_dict['text']
         if len(post_text) > 0:
-            encoded_input = embedding_tokenizer(
-                post_text, padding=True, truncation=True, return_tensors='pt').to(device)
-            with torch.no_grad():
-                model_output = embedding_model(**encoded_input)
-                # encodes tokenized etxt into tensor of hidden states
-            post_embedding = mean_pooling(
-                model_output, encoded_input['attention_mask'])
-            # masks hidden states and take mean of them into a single tensor
-            post_embedding = F.normalize(post_embedding, p=2, dim=1)
-            post_embedding = post_embedding[0].cpu().data.numpy()
+            with instrumentation.profile_range("encode_content_manual"):
+                encoded_input = embedding_tokenizer(
+                    post_text, padding=True, truncation=True, return_tensors='pt').to(device)
+                with torch.no_grad():
+                    model_output = embedding_model(**encoded_input)
+                    # encodes tokenized etxt into tensor of hidden states
+                post_embedding = mean_pooling(
+                    model_output, encoded_input['attention_mask'])
+                # masks hidden states and take mean of them into a single tensor
+                post_embedding = F.normalize(post_embedding, p=2, dim=1)
+                post_embedding = post_embedding[0].cpu().data.numpy()
 
     else:
         post_embedding = np.zeros(content_encoder.get_input_dim())
@@ -854,6 +1831,90 @@ def encode_content_manual(content_encoder, embedding_model, embedding_tokenizer,
     return post_embedding
 
 
+def encode_contents_batched(embedding_model, embedding_tokenizer, post_dicts: List[Dict],
+                            batch_size: int = DEFAULT_ENCODING_BATCH_SIZE) -> np.ndarray:
+    """
+    batched version of `encode_content_manual`
+
+    :param embedding_model: frozen transformer encoder
+    :param embedding_tokenizer: tokenizer of the encoder
+    :param post_dicts: posts (dict with 'text' key), posts without text are encoded as zero vectors
+    :param batch_size: number of posts per forward pass
+    :return: np.ndarray, (number of posts, hidden size) in the input order
+    """
+    return encode_texts_batched(embedding_model, embedding_tokenizer,
+                                [post_dict.get('text', '') for post_dict in post_dicts], batch_size=batch_size)
+
+
+def encode_texts_batched(embedding_model, embedding_tokenizer, texts: List[str],
+                         batch_size: int = DEFAULT_ENCODING_BATCH_SIZE) -> np.ndarray:
+    """
+    Texts are tokenised once, sorted by token length and encoded in mini-batches padded to the longest text
+    in the mini-batch only. Mean pooling ignores the padding, so the L2-normalised embeddings are the same as
+    the ones encoded post by post.
+
+    :param embedding_model: frozen transformer encoder
+    :param embedding_tokenizer: tokenizer of the encoder
+    :param texts: post texts, empty texts are encoded as zero vectors
+    :param batch_size: number of posts per forward pass
+    :return: np.ndarray, (number of texts, hidden size) in the input order
+    """
+    post_embeddings = np.zeros((len(texts), embedding_model.config.hidden_size), dtype=np.float32)
+    text_positions = [i for i, text in enumerate(texts) if len(text) > 0]
+    if len(text_positions) == 0:
+        return post_embeddings
+
+    with instrumentation.stage(instrumentation.STAGE_ENCODE):
+        device = next(embedding_model.parameters()).device
+        encoded_inputs = embedding_tokenizer([texts[i] for i in text_positions], truncation=True)
+        sorted_by_length = sorted(range(len(text_positions)), key=lambda j: len(encoded_inputs['input_ids'][j]))
+        if instrumentation.is_enabled():
+            instrumentation.count(instrumentation.COUNT_ENCODED_POSTS, len(text_positions))
+            instrumentation.count(instrumentation.COUNT_ENCODED_TOKENS,
+                                  sum(len(input_ids) for input_ids in encoded_inputs['input_ids']))
+
+        for start in range(0, len(sorted_by_length), batch_size):
+            mini_batch = sorted_by_length[start:start + batch_size]
+            encoded_input = embedding_tokenizer.pad(
+                {key: [encoded_inputs[key][j] for j in mini_batch] for key in encoded_inputs.keys()},
+                padding=True, return_tensors='pt').to(device)
+            with torch.no_grad():
+                model_output = embedding_model(**encoded_input)
+            mini_batch_embeddings = F.normalize(mean_pooling(
+                model_output, encoded_input['attention_mask']), p=2, dim=1)
+            post_embeddings[[text_positions[j] for j in mini_batch]] = mini_batch_embeddings.cpu().numpy()
+
+    return post_embeddings
+
+
+def encode_post_texts(embedding_model, embedding_tokenizer, texts: List[str],
+                      batch_size: int = DEFAULT_ENCODING_BATCH_SIZE,
+                      embedding_cache: Optional[EmbeddingCache] = None) -> np.ndarray:
+    """
+    encode post texts, looking up the embedding cache first (if set) and caching the new embeddings
+
+    :param texts: post texts, empty texts are encoded as zero vectors and never cached
+    :return: np.ndarray, (number of texts, hidden size) in the input order
+    """
+    post_embeddings = np.zeros((len(texts), embedding_model.config.hidden_size), dtype=np.float32)
+
+    to_encode = [i for i, text in enumerate(texts) if len(text) > 0]
+    if embedding_cache is not None and to_encode:
+        cached_embeddings = embedding_cache.get_many([texts[i] for i in to_encode])
+        for i, post_embedding in zip(to_encode, cached_embeddings):
+            if post_embedding is not None:
+                post_embeddings[i] = post_embedding
+        to_encode = [i for i, post_embedding in zip(to_encode, cached_embeddings) if post_embedding is None]
+
+    if to_encode:
+        new_embeddings = encode_texts_batched(embedding_model, embedding_tokenizer, [texts[i] for i in to_encode],
+                                              batch_size=batch_size)
+        post_embeddings[to_encode] = new_embeddings
+        if embedding_cache is not None:
+            embedding_cache.put_many([texts[i] for i in to_encode], new_embeddings)
+    return post_embeddings
+
+
 def config_gpu_use(n_gpu: Union[int, List] = -1) -> Union[int, List]:
     """
     set GPU device
@@ -903,16 +1964,44 @@ def quick_test(model_in_memory: DepressionClassifier):
         print(e)
 
 
-def evaluation(test_data_path, model_in_memory: Model, cuda_device=-1):
+def new_post_budget_batch_sampler(batch_post_budget: int, max_batch_size: int, embedding_shard_dir: str = None,
+                                  shuffle: bool = True) -> PostBudgetBatchSampler:
+    """
+    :param max_batch_size: maximum number of users per batch, so that users with a few posts are not packed into
+        a single batch of up to batch_post_budget users
+    :param embedding_shard_dir: count the posts of precomputed sequences (head-only), reduced to at most
+        NUM_REPRESENTATIVE_POSTS, instead of the posts to encode
+    """
+    return PostBudgetBatchSampler(batch_post_budget,
+                                  max_post_count=NUM_REPRESENTATIVE_POSTS if embedding_shard_dir else None,
+                                  max_batch_size=max_batch_size, shuffle=shuffle,
+                                  embedding_shard_dir=embedding_shard_dir)
+
 
+def evaluation(test_data_path, model_in_memory: Model, cuda_device=-1, embedding_shard_dir: str = None,
+               batch_post_budget: int = None):
+    """
+    :param embedding_shard_dir: read precomputed post sequences from embedding shards (for head-only models)
+    :param batch_post_budget: batch users by number of posts (see batch_sampling.py), at most 32 users per batch
+    :return: metrics
+    """
     timestamped_print("evaluating  .... ")
 
     token_indexer = ELMoTokenCharactersIndexer()
-    test_reader = DepressionDataReader(token_indexers={'elmo': token_indexer})
+    if embedding_shard_dir:
+        test_reader = PrecomputedSequenceDataReader(
+            embedding_shard_dir, token_indexers={'elmo': token_indexer})
+    else:
+        test_reader = DepressionDataReader(token_indexers={'elmo': token_indexer})
     test_instances = list(test_reader.read(test_data_path))
     vocab = Vocabulary.from_instances(test_instances)
-    test_loader = MultiProcessDataLoader(
-        test_reader, test_data_path, batch_size=32, shuffle=True)
+    if batch_post_budget:
+        test_loader = MultiProcessDataLoader(
+            test_reader, test_data_path,
+            batch_sampler=new_post_budget_batch_sampler(batch_post_budget, 32, embedding_shard_dir))
+    else:
+        test_loader = MultiProcessDataLoader(
+            test_reader, test_data_path, batch_size=32, shuffle=True)
     test_loader.index_with(vocab)
 
     batch_iterator = iter(test_loader)
@@ -939,6 +2028,7 @@ def evaluation(test_data_path, model_in_memory: Model, cuda_device=-1):
             json.dump(metrics, file, indent=4)
 
     print("completed")
+    return metrics
 
 
 def archive_model_from_memory(model_in_memory: Model, vocab: Vocabulary, file_prefix=""):
@@ -977,7 +2067,7 @@ def archive_model_from_memory(model_in_memory: Model, vocab: Vocabulary, file_pr
         "done. model file and vocab file are archived in [%s]" % (serialization_dir))
 
 
-def instantiate_model(n_gpu, vocab, max_post_size: int = MAXIMUM_POST_SEQ_SIZE):
+def instantiate_model(n_gpu, vocab, max_post_size: int = MAXIMUM_POST_SEQ_SIZE, load_embedding_model: bool = True):
     post_encoder = None
     metaphor_encoder = None
     POST_EMBEDDING_DIM = 768
@@ -1030,7 +2120,8 @@ def instantiate_model(n_gpu, vocab, max_post_size: int = MAXIMUM_POST_SEQ_SIZE):
                                  metaphor_encoder=metaphor_encoder,
                                  classifier_feedforward=classifier_feedforward,
                                  max_post_size=int(max_post_size),
-                                 cuda_device=n_gpu)
+                                 cuda_device=n_gpu,
+                                 load_embedding_model=load_embedding_model)
     model.to(device)
 
     return model
@@ -1063,7 +2154,13 @@ def load_classifier_from_archive(vocab_dir_path: str = None,
     model.set_max_post_size(max_post_size=max_post_size)
 
     with open(model_weight_file, 'rb') as f:
-        model.load_state_dict(torch.load(f))
+        model_state = torch.load(f)
+    # weights of models trained head-only do not include the (frozen, pretrained) embedding model
+    missing_keys, unexpected_keys = model.load_state_dict(model_state, strict=False)
+    missing_keys = [key for key in missing_keys if not key.startswith("embedding_model.")]
+    if missing_keys or unexpected_keys:
+        raise RuntimeError("Error(s) in loading state_dict for %s: missing keys %s, unexpected keys %s" % (
+            type(model).__name__, missing_keys, unexpected_keys))
 
     token_indexer = ELMoTokenCharactersIndexer()
     test_reader = DepressionDataReader(token_indexers={'elmo': token_indexer})
@@ -0,0 +1,262 @@
+# Utility module to cache post embeddings on disk
+#
+# The post encoder (bert-base-uncased) is frozen, so the embedding of a post only depends on its text and
+# on the encoder weights. Embeddings are stored in a fixed-capacity, memory-mapped float32 array and
+# addressed by a hash of (encoder id, post text). An append-only journal maps keys to slots of the array.
+# Writers take an exclusive file lock and readers a shared one, so that several processes (e.g., training
+# and evaluation runs) can use the same cache directory.
+import os
+import json
+import time
+import struct
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, the cache is then only safe for a single process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE_MB = 4096
+CACHE_FORMAT_VERSION = 1
+
+# journal record: sha1 digest of the key and the slot it is stored in. A zero digest frees the slot.
+JOURNAL_RECORD = struct.Struct('<20sq')
+FREED_SLOT_KEY = b'\x00' * 20
+# fraction of the capacity that is evicted at once when the cache is full
+EVICTION_FRACTION = 0.01
+
+
+def embedding_cache_key(encoder_id: str, text: str) -> bytes:
+    """
+    content address of a post embedding
+
+    :param encoder_id: encoder name and revision, e.g., "bert-base-uncased@<commit hash>"
+    :param text: post text
+    :return: sha1 digest
+    """
+    return hashlib.sha1((encoder_id + "\x00" + text).encode('utf-8', errors='surrogatepass')).digest()
+
+
+class EmbeddingCache(object):
+    """
+    persistent embedding store with a size cap and (approximate) least-recently-used eviction
+
+    files in cache_dir:
+        embeddings.f32  -- memory-mapped float32 array of shape (capacity, embedding_dim)
+        access.i64      -- memory-mapped last access time per slot (0 for a free slot)
+        journal.bin     -- append-only log of (key digest, slot) assignments
+        meta.json       -- cache settings
+        .lock           -- lock file for inter-process synchronisation
+    """
+    DATA_FILE_NAME = "embeddings.f32"
+    ACCESS_FILE_NAME = "access.i64"
+    JOURNAL_FILE_NAME = "journal.bin"
+    META_FILE_NAME = "meta.json"
+    LOCK_FILE_NAME = ".lock"
+
+    def __init__(self, cache_dir: str, encoder_id: str, embedding_dim: int = 768,
+                 max_size_mb: float = DEFAULT_CACHE_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.encoder_id = encoder_id
+        self.embedding_dim = int(embedding_dim)
+        self.capacity = max(1, int(max_size_mb * 1024 * 1024) // (self.embedding_dim * 4))
+
+        self.data_path = os.path.join(cache_dir, self.DATA_FILE_NAME)
+        self.access_path = os.path.join(cache_dir, self.ACCESS_FILE_NAME)
+        self.journal_path = os.path.join(cache_dir, self.JOURNAL_FILE_NAME)
+        self.meta_path = os.path.join(cache_dir, self.META_FILE_NAME)
+        self.lock_path = os.path.join(cache_dir, self.LOCK_FILE_NAME)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: Dict[bytes, int] = {}
+        self._slot_keys: Dict[int, bytes] = {}
+        self._journal_inode = None
+        self._journal_offset = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._lock(exclusive=True):
+            self._open()
+
+    @contextmanager
+    def _lock(self, exclusive: bool):
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _meta(self) -> Dict:
+        return {"version": CACHE_FORMAT_VERSION, "embedding_dim": self.embedding_dim, "capacity": self.capacity}
+
+    def _open(self):
+        """
+        open the cache files, re-creating them if they are missing or were written with different settings
+        (needs the exclusive lock)
+        """
+        stored_meta = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as meta_file:
+                stored_meta = json.load(meta_file)
+
+        if stored_meta != self._meta() or not all(os.path.exists(path) for path in
+                                                  [self.data_path, self.access_path, self.journal_path]):
+            if stored_meta is not None:
+                logger.warning("embedding cache [%s] was created with different settings (%s). Reset it.",
+                               self.cache_dir, stored_meta)
+            np.memmap(self.data_path, dtype=np.float32, mode='w+',
+                      shape=(self.capacity, self.embedding_dim)).flush()
+            np.memmap(self.access_path, dtype=np.int64, mode='w+', shape=(self.capacity,)).flush()
+            open(self.journal_path, 'wb').close()
+            with open(self.meta_path, 'w') as meta_file:
+                json.dump(self._meta(), meta_file)
+
+        self._data = np.memmap(self.data_path, dtype=np.float32, mode='r+',
+                               shape=(self.capacity, self.embedding_dim))
+        self._access = np.memmap(self.access_path, dtype=np.int64, mode='r+', shape=(self.capacity,))
+        self._refresh()
+
+    def _refresh(self):
+        """
+        replay journal records appended by other processes since the last refresh (needs a lock)
+        """
+        stat = os.stat(self.journal_path)
+        if stat.st_ino != self._journal_inode:
+            # journal was compacted (or first load), replay it from the start
+            self._entries = {}
+            self._slot_keys = {}
+            self._journal_inode = stat.st_ino
+            self._journal_offset = 0
+
+        if stat.st_size <= self._journal_offset:
+            return
+
+        with open(self.journal_path, 'rb') as journal_file:
+            journal_file.seek(self._journal_offset)
+            buffer = journal_file.read(stat.st_size - self._journal_offset)
+        usable_size = len(buffer) - len(buffer) % JOURNAL_RECORD.size
+        for key, slot in JOURNAL_RECORD.iter_unpack(buffer[:usable_size]):
+            self._assign(key, slot)
+        self._journal_offset += usable_size
+
+    def _assign(self, key: bytes, slot: int):
+        previous_key = self._slot_keys.pop(slot, None)
+        if previous_key is not None:
+            self._entries.pop(previous_key, None)
+        if key != FREED_SLOT_KEY:
+            self._entries[key] = slot
+            self._slot_keys[slot] = key
+
+    def _append_journal(self, records: List[tuple]):
+        buffer = b''.join(JOURNAL_RECORD.pack(key, slot) for key, slot in records)
+        with open(self.journal_path, 'ab') as journal_file:
+            journal_file.write(buffer)
+        for key, slot in records:
+            self._assign(key, slot)
+        self._journal_offset += len(buffer)
+
+    def _compact_journal(self):
+        """ rewrite the journal with live entries only once it is much larger than the cache """
+        if self._journal_offset < 4 * self.capacity * JOURNAL_RECORD.size:
+            return
+        tmp_journal_path = "%s.%s.tmp" % (self.journal_path, os.getpid())
+        with open(tmp_journal_path, 'wb') as journal_file:
+            journal_file.write(b''.join(JOURNAL_RECORD.pack(key, slot) for key, slot in self._entries.items()))
+        os.replace(tmp_journal_path, self.journal_path)
+        stat = os.stat(self.journal_path)
+        self._journal_inode = stat.st_ino
+        self._journal_offset = stat.st_size
+
+    def keys(self, texts: Sequence[str]) -> List[bytes]:
+        return [embedding_cache_key(self.encoder_id, text) for text in texts]
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        look up embeddings of post texts
+
+        :param texts: post texts
+        :return: list aligned to texts, with an embedding (np.ndarray) for every hit and None for every miss
+        """
+        keys = self.keys(texts)
+        results: List[Optional[np.ndarray]] = [None] * len(keys)
+        hit_positions = []
+        with self._lock(exclusive=False):
+            self._refresh()
+            hit_slots = []
+            for position, key in enumerate(keys):
+                slot = self._entries.get(key)
+                if slot is not None:
+                    hit_positions.append(position)
+                    hit_slots.append(slot)
+            if hit_slots:
+                # copy out of the memory map while holding the lock, slots are reused after eviction
+                rows = np.array(self._data[hit_slots])
+                self._access[hit_slots] = time.time_ns() // 1000
+                for row_idx, position in enumerate(hit_positions):
+                    results[position] = rows[row_idx]
+
+        self.hits += len(hit_positions)
+        self.misses += len(keys) - len(hit_positions)
+        return results
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[np.ndarray]):
+        """
+        store embeddings of post texts, evicting least recently used entries when the cache is full
+
+        :param texts: post texts
+        :param embeddings: embeddings aligned to texts
+        """
+        new_items = dict(zip(self.keys(texts), embeddings))
+        if len(new_items) == 0:
+            return
+        with self._lock(exclusive=True):
+            self._refresh()
+            new_keys = [key for key in new_items if key not in self._entries][-self.capacity:]
+            if not new_keys:
+                return
+
+            free_slots = self._free_slots(len(new_keys))
+            self._data[free_slots] = np.stack([np.asarray(new_items[key], dtype=np.float32) for key in new_keys])
+            self._access[free_slots] = time.time_ns() // 1000
+            # embeddings must be on disk before the journal points at them
+            self._data.flush()
+            self._access.flush()
+            self._append_journal(list(zip(new_keys, free_slots)))
+            self._compact_journal()
+
+    def _free_slots(self, num_slots: int) -> List[int]:
+        free_slots = np.flatnonzero(self._access == 0)
+        if len(free_slots) < num_slots:
+            # evict a chunk of the least recently used entries at once to amortise the scan
+            used_slots = np.flatnonzero(self._access != 0)
+            num_evicted = min(len(used_slots),
+                              max(num_slots - len(free_slots), int(self.capacity * EVICTION_FRACTION)))
+            if num_evicted < len(used_slots):
+                lru_positions = np.argpartition(self._access[used_slots], num_evicted - 1)[:num_evicted]
+                evicted_slots = used_slots[lru_positions]
+            else:
+                evicted_slots = used_slots
+            self._access[evicted_slots] = 0
+            self._append_journal([(FREED_SLOT_KEY, int(slot)) for slot in evicted_slots])
+            self.evictions += len(evicted_slots)
+            free_slots = np.flatnonzero(self._access == 0)
+        return [int(slot) for slot in free_slots[:num_slots]]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "capacity": self.capacity,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,160 @@
+# Utility module to write and read precomputed post embedding shards
+#
+# A shard holds the post embeddings of a fixed number of users:
+#     shard_<id>.npy   -- float32 array (posts of all users in the shard, embedding dim), memory-mapped on read
+#     shard_<id>.json  -- user ids, row offsets of every user, post timestamps (seconds past Epoch) and
+#                         sentiment metric scores
+# manifest.json lists the completed shards and the users that failed to encode.
+#
+# Format versions:
+#     1 -- sentiment metric scores of the post dict keys instead of the post texts (all-zero metric features)
+#     2 -- sentiment metric scores of the post texts
+# Shards of an older version are refused, they have to be re-encoded (into a new shard directory).
+import os
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "manifest.json"
+SHARD_FORMAT_VERSION = 2
+
+
+def shard_file_prefix(shard_dir: str, shard_id: int) -> str:
+    return os.path.join(shard_dir, "shard_%05d" % shard_id)
+
+
+def _atomic_json_dump(obj, path: str):
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(shard_dir: str) -> Optional[Dict]:
+    manifest_path = os.path.join(shard_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(shard_dir: str, manifest: Dict):
+    _atomic_json_dump(manifest, os.path.join(shard_dir, MANIFEST_FILE_NAME))
+
+
+def check_manifest_version(shard_dir: str, manifest: Dict):
+    """
+    :raise ValueError: if the shards were written in another format version
+    """
+    version = manifest.get("version", 1)
+    if version != SHARD_FORMAT_VERSION:
+        raise ValueError("shards in [%s] have format version [%s], not [%s]: re-encode them into a new shard "
+                         "directory with precompute_embeddings.py" % (shard_dir, version, SHARD_FORMAT_VERSION))
+
+
+def new_manifest(encoder_id: str, embedding_dim: int, users_per_shard: int) -> Dict:
+    return {"version": SHARD_FORMAT_VERSION,
+            "encoder_id": encoder_id,
+            "embedding_dim": embedding_dim,
+            "users_per_shard": users_per_shard,
+            "shards": {},
+            "failures": {}}
+
+
+def write_shard(shard_dir: str, shard_id: int, user_ids: List[str], user_embeddings: List[np.ndarray],
+                user_timestamps: List[List], user_metric_scores: List[List[float]], embedding_dim: int):
+    """
+    write a shard; the embedding array is renamed into place before the index, so a shard with an index file
+    is always complete
+    """
+    prefix = shard_file_prefix(shard_dir, shard_id)
+    offsets = np.cumsum([0] + [len(embeddings) for embeddings in user_embeddings]).tolist()
+    embeddings = np.concatenate(user_embeddings).astype(np.float32) if user_embeddings and offsets[-1] > 0 \
+        else np.zeros((0, embedding_dim), dtype=np.float32)
+
+    tmp_embeddings_path = "%s.%s.tmp.npy" % (prefix, os.getpid())
+    np.save(tmp_embeddings_path, embeddings)
+    os.replace(tmp_embeddings_path, prefix + ".npy")
+
+    _atomic_json_dump({"user_ids": user_ids,
+                       "offsets": offsets,
+                       "timestamps": user_timestamps,
+                       "metric_scores": user_metric_scores}, prefix + ".json")
+
+
+class EmbeddingShardReader(object):
+    """
+    look up precomputed post embeddings of a user from completed shards
+    """
+
+    def __init__(self, shard_dir: str, max_open_shards: int = 8):
+        self.shard_dir = shard_dir
+        self.max_open_shards = max_open_shards
+        manifest = load_manifest(shard_dir)
+        if manifest is None:
+            raise FileNotFoundError("no shard manifest found in [%s]" % shard_dir)
+        check_manifest_version(shard_dir, manifest)
+        self.encoder_id = manifest["encoder_id"]
+        self.embedding_dim = manifest["embedding_dim"]
+        self._user_shards: Dict[str, int] = {}
+        for shard_id, shard_info in manifest["shards"].items():
+            for user_id in shard_info["users"]:
+                self._user_shards[user_id] = int(shard_id)
+        self._open_shards = OrderedDict()
+        logger.info("%s users in %s precomputed embedding shards", len(self._user_shards),
+                    len(manifest["shards"]))
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self._user_shards
+
+    def __len__(self):
+        return len(self._user_shards)
+
+    def user_ids(self) -> List[str]:
+        return list(self._user_shards.keys())
+
+    def _open_shard(self, shard_id: int):
+        if shard_id in self._open_shards:
+            self._open_shards.move_to_end(shard_id)
+            return self._open_shards[shard_id]
+
+        prefix = shard_file_prefix(self.shard_dir, shard_id)
+        with open(prefix + ".json", encoding='utf-8') as f:
+            shard_index = json.load(f)
+        shard_index["positions"] = {user_id: i for i, user_id in enumerate(shard_index["user_ids"])}
+        embeddings = np.load(prefix + ".npy", mmap_mode='r')
+        self._open_shards[shard_id] = (shard_index, embeddings)
+        if len(self._open_shards) > self.max_open_shards:
+            self._open_shards.popitem(last=False)
+        return self._open_shards[shard_id]
+
+    def num_posts(self, user_id) -> int:
+        """
+        :return: number of precomputed post embeddings of the user, 0 if the user is not in any completed shard
+        """
+        user_id = str(user_id)
+        if user_id not in self._user_shards:
+            return 0
+        shard_index, _ = self._open_shard(self._user_shards[user_id])
+        position = shard_index["positions"][user_id]
+        return shard_index["offsets"][position + 1] - shard_index["offsets"][position]
+
+    def load_user(self, user_id) -> Optional[Tuple[np.ndarray, List, List[float]]]:
+        """
+        :param user_id: user id
+        :return: (post embeddings (number of posts, embedding dim), post timestamps, metric scores)
+            or None if the user is not in any completed shard
+        """
+        user_id = str(user_id)
+        if user_id not in self._user_shards:
+            return None
+        shard_index, embeddings = self._open_shard(self._user_shards[user_id])
+        position = shard_index["positions"][user_id]
+        start, end = shard_index["offsets"][position], shard_index["offsets"][position + 1]
+        return (np.asarray(embeddings[start:end]), shard_index["timestamps"][position],
+                shard_index["metric_scores"][position])
@@ -0,0 +1,336 @@
+"""
+Persistent per-user store of the sentiment metric features (the 10-dim output of `calculate_metrics`)
+
+Features are keyed by user id and a fingerprint of the user's post set (data_loader.UserPostSet.fingerprint),
+so features of a changed post set are never returned. The store is a SQLite database in WAL mode: writes are
+atomic transactions and concurrent readers (threads, DataLoader workers, evaluation or scoring jobs) never see
+partial writes. Features can be exported to and imported from json lines, e.g., to reuse features computed
+during training in a scoring job.
+
+The representative posts selected by clustering (see post_reduction.py) are stored in the same way in a second
+table, keyed by user id and the encoder and reducer configuration (selection id), so that configurations sharing a
+database (e.g., training and scoring) keep their own selections, and checked against the post set fingerprint.
+
+usage:
+    python feature_store.py --db features.db --export features.jsonl
+    python feature_store.py --db features.db --import features.jsonl
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# version of the feature computation, features of other versions are ignored
+# (2: VADER scores of the post texts, see sentiment_scoring.py)
+FEATURE_VERSION = 2
+NUM_FEATURES = 10
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS user_features (
+    user_id TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    feature_version INTEGER NOT NULL,
+    features BLOB NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+_CREATE_SELECTION_TABLE = """
+CREATE TABLE IF NOT EXISTS user_selections (
+    user_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    selection_id TEXT NOT NULL,
+    indices BLOB NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (user_id, selection_id)
+)
+"""
+
+
+
+def _features_to_blob(features) -> bytes:
+    return np.asarray(features, dtype=np.float32).tobytes()
+
+
+def _blob_to_features(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32).copy()
+
+
+def _indices_to_blob(indices) -> bytes:
+    return np.asarray(indices, dtype=np.int32).tobytes()
+
+
+def _blob_to_indices(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.int32).astype(np.int64)
+
+
+class _SQLiteStore(object):
+    """
+    SQLite database in WAL mode, one connection per thread and process
+    """
+    _create_table = None
+
+    def __init__(self, db_path: str, timeout: float = 30.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        connection = self._connection()
+        with connection:
+            connection.execute(self._create_table)
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections are not shared with threads or forked processes
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def __getstate__(self):
+        # picklable for DataLoader workers, connections are re-opened
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _fetch_by_user_ids(self, query: str, query_parameters: List, user_ids) -> Dict[str, Tuple[str, bytes]]:
+        """
+        :param query: SELECT of (user id, fingerprint, blob) rows with an `IN (%s)` placeholder for the user ids
+        :return: (fingerprint, blob) per stored user id
+        """
+        stored = {}
+        connection = self._connection()
+        user_ids = list(set(str(user_id) for user_id in user_ids))
+        # stay under SQLite's limit of host parameters per statement
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows = connection.execute(query % ",".join("?" * len(chunk)), query_parameters + chunk).fetchall()
+            stored.update((user_id, (fingerprint, blob)) for user_id, fingerprint, blob in rows)
+        return stored
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class FeatureStore(_SQLiteStore):
+    """
+    SQLite-backed feature store, one connection per thread and process
+    """
+    _create_table = _CREATE_TABLE
+
+    def __init__(self, db_path: str, feature_version: int = FEATURE_VERSION, timeout: float = 30.0):
+        self.feature_version = feature_version
+        super().__init__(db_path, timeout=timeout)
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM user_features WHERE feature_version = ?",
+                                          (self.feature_version,)).fetchone()[0]
+
+    def get(self, user_id: str, fingerprint: str) -> Optional[np.ndarray]:
+        return self.get_many([(user_id, fingerprint)])[0]
+
+    def get_many(self, keys: List[Tuple[str, str]]) -> List[Optional[np.ndarray]]:
+        """
+        :param keys: (user id, post set fingerprint) pairs
+        :return: float32 features per key, None if not stored or stored for another post set
+        """
+        if not keys:
+            return []
+        stored = self._fetch_by_user_ids(
+            "SELECT user_id, fingerprint, features FROM user_features WHERE feature_version = ? AND user_id IN (%s)",
+            [self.feature_version], [user_id for user_id, _ in keys])
+        results = []
+        for user_id, fingerprint in keys:
+            entry = stored.get(str(user_id))
+            results.append(_blob_to_features(entry[1]) if entry is not None and entry[0] == fingerprint else None)
+        return results
+
+    def put(self, user_id: str, fingerprint: str, features):
+        self.put_many([(user_id, fingerprint, features)])
+
+    def put_many(self, entries: List[Tuple[str, str, object]]):
+        """
+        store features of users in one transaction, replacing features of previous post sets
+
+        :param entries: (user id, post set fingerprint, features) triples
+        """
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO user_features (user_id, fingerprint, feature_version, features, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(str(user_id), fingerprint, self.feature_version, _features_to_blob(features), now)
+                 for user_id, fingerprint, features in entries])
+
+    def export_jsonl(self, jsonl_path: str) -> int:
+        """
+        :return: number of exported users
+        """
+        tmp_path = "%s.%s.tmp" % (jsonl_path, os.getpid())
+        num_exported = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for user_id, fingerprint, features in self._connection().execute(
+                    "SELECT user_id, fingerprint, features FROM user_features WHERE feature_version = ?",
+                    (self.feature_version,)):
+                f.write(json.dumps({"user_id": user_id, "fingerprint": fingerprint,
+                                    "feature_version": self.feature_version,
+                                    "features": _blob_to_features(features).tolist()}) + "\n")
+                num_exported += 1
+        os.replace(tmp_path, jsonl_path)
+        return num_exported
+
+    def import_jsonl(self, jsonl_path: str, batch_size: int = 10000) -> int:
+        """
+        import exported features, features of other versions are skipped
+
+        :return: number of imported users
+        """
+        num_imported = 0
+        entries = []
+        with open(jsonl_path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("feature_version") != self.feature_version:
+                    continue
+                entries.append((record["user_id"], record["fingerprint"], record["features"]))
+                if len(entries) >= batch_size:
+                    self.put_many(entries)
+                    num_imported += len(entries)
+                    entries = []
+        self.put_many(entries)
+        return num_imported + len(entries)
+
+
+class SelectionStore(_SQLiteStore):
+    """
+    representative posts of users (indices into the post set, see post_reduction.py) per post set and selection
+    configuration (encoder and reducer), e.g., in the database of the feature store
+    """
+    _create_table = _CREATE_SELECTION_TABLE
+
+    def __init__(self, db_path: str, selection_id: str, timeout: float = 30.0):
+        """
+        :param selection_id: encoder and reducer configuration, selections of other configurations are ignored
+        """
+        self.selection_id = selection_id
+        super().__init__(db_path, timeout=timeout)
+        # selections were keyed by user id only (one configuration per database), they are recomputed
+        connection = self._connection()
+        primary_key = [row[1] for row in connection.execute("PRAGMA table_info(user_selections)") if row[5]]
+        if primary_key == ["user_id"]:
+            with connection:
+                connection.execute("DROP TABLE user_selections")
+                connection.execute(self._create_table)
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM user_selections WHERE selection_id = ?",
+                                          (self.selection_id,)).fetchone()[0]
+
+    def get(self, user_id: str, fingerprint: str) -> Optional[np.ndarray]:
+        return self.get_many([(user_id, fingerprint)])[0]
+
+    def get_many(self, keys: List[Tuple[str, str]]) -> List[Optional[np.ndarray]]:
+        """
+        :param keys: (user id, post set fingerprint) pairs
+        :return: int64 indices of the selected posts per key, None if not stored for the post set
+        """
+        if not keys:
+            return []
+        stored = self._fetch_by_user_ids(
+            "SELECT user_id, fingerprint, indices FROM user_selections WHERE selection_id = ? AND user_id IN (%s)",
+            [self.selection_id], [user_id for user_id, _ in keys])
+        results = []
+        for user_id, fingerprint in keys:
+            entry = stored.get(str(user_id))
+            results.append(_blob_to_indices(entry[1]) if entry is not None and entry[0] == fingerprint else None)
+        return results
+
+    def put(self, user_id: str, fingerprint: str, indices):
+        self.put_many([(user_id, fingerprint, indices)])
+
+    def put_many(self, entries: List[Tuple[str, str, object]]):
+        """
+        :param entries: (user id, post set fingerprint, indices of the selected posts) triples
+        """
+        if not entries:
+            return
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO user_selections (user_id, fingerprint, selection_id, indices, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(str(user_id), fingerprint, self.selection_id, _indices_to_blob(indices), now)
+                 for user_id, fingerprint, indices in entries])
+
+
+class MemoryFeatureStore(object):
+    """
+    in-process feature store with the same interface, used when no feature store path is configured
+    """
+
+    def __init__(self):
+        self._features: Dict[str, Tuple[str, np.ndarray]] = {}
+
+    def __len__(self):
+        return len(self._features)
+
+    def get(self, user_id: str, fingerprint: str) -> Optional[np.ndarray]:
+        entry = self._features.get(str(user_id))
+        return entry[1] if entry is not None and entry[0] == fingerprint else None
+
+    def get_many(self, keys: List[Tuple[str, str]]) -> List[Optional[np.ndarray]]:
+        return [self.get(user_id, fingerprint) for user_id, fingerprint in keys]
+
+    def put(self, user_id: str, fingerprint: str, features):
+        self._features[str(user_id)] = (fingerprint, np.asarray(features, dtype=np.float32))
+
+    def put_many(self, entries: List[Tuple[str, str, object]]):
+        for user_id, fingerprint, features in entries:
+            self.put(user_id, fingerprint, features)
+
+
+class MemorySelectionStore(MemoryFeatureStore):
+    """
+    in-process selection store with the same interface, used when no feature store path is configured
+    """
+
+    def put(self, user_id: str, fingerprint: str, indices):
+        self._features[str(user_id)] = (fingerprint, np.asarray(indices, dtype=np.int64))
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('--db', dest="db_path", help="feature store database", default=None)
+    parser.add_option('--export', dest="export_path", help="export features to a json lines file", default=None)
+    parser.add_option('--import', dest="import_path", help="import features from a json lines file", default=None)
+    options, args = parser.parse_args()
+
+    if options.db_path is None or (options.export_path is None and options.import_path is None):
+        parser.error("--db and one of --export or --import are required")
+
+    feature_store = FeatureStore(options.db_path)
+    if options.import_path:
+        print("%s users imported from [%s]" % (feature_store.import_jsonl(options.import_path), options.import_path))
+    if options.export_path:
+        print("%s users exported to [%s]" % (feature_store.export_jsonl(options.export_path), options.export_path))
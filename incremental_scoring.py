@@ -0,0 +1,323 @@
+"""
+Incremental re-scoring of users as new posts arrive
+
+`IncrementalUserScorer` keeps per-user state on top of a trained classifier (see DepressionUserTaggerPredictor):
+post embeddings, running sentiment features (temporal_features.OnlineSentimentFeatures) and the K-means
+centroids and representatives of the last clustering. New posts are encoded and sentiment-scored alone,
+assigned to the nearest centroid and the classifier head (HAN blocks + feedforward) is re-run on the updated
+representatives. Users are re-clustered from scratch once their posts grew by `recluster_fraction` since the
+last clustering.
+
+New posts come from a local drop directory (`PostDropWatcher`, files {"user_id": ..., "posts": [[timestamp,
+text], ...]}, written to a temporary name and renamed into the directory) or from an in-process queue
+(`PostQueueConsumer`).
+
+usage:
+    python incremental_scoring.py --vocab_dir <vocabulary dir> --model_weights <weights file> \\
+        --post_dir <post dir> --drop_dir <drop dir>
+"""
+import os
+import json
+import time
+import queue
+import shutil
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import data_loader
+from data_loader import UserPostSet, load_user_post_set
+from temporal_features import OnlineSentimentFeatures
+from depression_classifier_778_clustering import DepressionClassifier, DepressionUserTaggerPredictor, \
+    kmeans_last_post_per_cluster, reduce_and_sort_post_sequence, timestamped_print
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECLUSTER_FRACTION = 0.2
+# number of clusters (and representatives) of users with many posts, as in reduce_and_sort_post_sequence
+NUM_CLUSTERS = 200
+
+
+class _GrowingArray(object):
+    """
+    rows appended in amortised O(1), backed by a buffer of doubling capacity
+    """
+
+    def __init__(self, row_shape: tuple, dtype):
+        self._buffer = np.zeros((16,) + row_shape, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, rows: np.ndarray):
+        required_size = self._size + len(rows)
+        if required_size > len(self._buffer):
+            capacity = max(required_size, 2 * len(self._buffer))
+            buffer = np.zeros((capacity,) + self._buffer.shape[1:], dtype=self._buffer.dtype)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+        self._buffer[self._size:required_size] = rows
+        self._size = required_size
+
+    def view(self) -> np.ndarray:
+        return self._buffer[:self._size]
+
+
+class UserScoringState(object):
+    """
+    scoring state of a user: post timestamps and embeddings, running sentiment features and clustering
+    """
+
+    def __init__(self, user_id: str, embedding_dim: int):
+        self.user_id = user_id
+        self.timestamps = _GrowingArray((), np.int64)
+        self.embeddings = _GrowingArray((embedding_dim,), np.float32)
+        self.sentiment_features = OnlineSentimentFeatures()
+        # K-means state of users with more than NUM_CLUSTERS posts
+        self.centroids: Optional[np.ndarray] = None
+        self.last_post_per_cluster: Optional[np.ndarray] = None
+        self.num_posts_at_clustering = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class IncrementalUserScorer(object):
+    """
+    score users from their full history once and re-score them from new posts only afterwards
+    """
+
+    def __init__(self, predictor: DepressionUserTaggerPredictor,
+                 recluster_fraction: float = DEFAULT_RECLUSTER_FRACTION, max_users: int = 100000):
+        """
+        :param predictor: predictor of a trained DepressionClassifier (with its embedding model)
+        :param recluster_fraction: re-cluster a user once its posts grew by this fraction since the last clustering
+        :param max_users: maximum number of user states kept in memory, least recently scored users are dropped
+        """
+        self.predictor = predictor
+        self.model: DepressionClassifier = predictor._model
+        self.recluster_fraction = recluster_fraction
+        self.max_users = max_users
+        self._states: Dict[str, UserScoringState] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self._states
+
+    def _encode_and_score(self, user_post_set: UserPostSet):
+        post_embeddings = self.model._encode_post_sets([user_post_set])[0]
+        pos_scores, neg_scores = self.model.get_sentiment_scorer().score(user_post_set.texts())
+        return post_embeddings, pos_scores, neg_scores
+
+    def _update_clustering(self, state: UserScoringState, num_new_posts: int):
+        num_posts = len(state)
+        if num_posts <= NUM_CLUSTERS:
+            return
+        if state.centroids is None or \
+                num_posts - state.num_posts_at_clustering > self.recluster_fraction * state.num_posts_at_clustering:
+            state.last_post_per_cluster, state.centroids = kmeans_last_post_per_cluster(
+                state.embeddings.view(), NUM_CLUSTERS)
+            state.num_posts_at_clustering = num_posts
+            return
+        # new posts join their nearest cluster and become its last post
+        new_embeddings = state.embeddings.view()[num_posts - num_new_posts:]
+        squared_distances = (np.square(new_embeddings).sum(axis=1)[:, None]
+                             - 2 * new_embeddings @ state.centroids.T
+                             + np.square(state.centroids).sum(axis=1)[None, :])
+        state.last_post_per_cluster[squared_distances.argmin(axis=1)] = np.arange(num_posts - num_new_posts,
+                                                                                  num_posts)
+
+    def _representative_indices(self, state: UserScoringState) -> np.ndarray:
+        if state.last_post_per_cluster is None or len(state) <= NUM_CLUSTERS:
+            return np.arange(len(state))
+        return state.last_post_per_cluster[state.last_post_per_cluster >= 0]
+
+    def _run_head(self, state: UserScoringState) -> Dict:
+        if len(state) == 0:
+            post_sequence = torch.zeros(1, state.embeddings.view().shape[1])
+        else:
+            representative_indices = self._representative_indices(state)
+            post_sequence = reduce_and_sort_post_sequence(state.timestamps.view()[representative_indices],
+                                                          state.embeddings.view()[representative_indices],
+                                                          max_post_size=None)
+        metric_scores = torch.tensor(state.sentiment_features.features()).float()
+        device = next(self.model.parameters()).device
+        self.model.eval()
+        with torch.no_grad():
+            output_dict = self.model(user_id=[state.user_id],
+                                     post_sequence=post_sequence.unsqueeze(0).to(device),
+                                     post_mask=torch.ones(1, len(post_sequence), dtype=torch.bool, device=device),
+                                     metric_scores=metric_scores.unsqueeze(0).to(device))
+        logits = output_dict["logits"][0]
+        class_probabilities = F.softmax(logits, dim=-1)
+        label_index = int(class_probabilities.argmax())
+        return {"user_id": state.user_id,
+                "num_posts": len(state),
+                "logits": logits.cpu().tolist(),
+                "class_probabilities": class_probabilities.cpu().tolist(),
+                "label": self.model.vocab.get_token_from_index(label_index, namespace="label"),
+                "metric_scores": metric_scores.tolist()}
+
+    def _add_to_state(self, state: UserScoringState, user_post_set: UserPostSet):
+        if len(user_post_set) == 0:
+            return
+        post_embeddings, pos_scores, neg_scores = self._encode_and_score(user_post_set)
+        state.timestamps.extend(np.asarray(user_post_set.timestamps, dtype=np.int64))
+        state.embeddings.extend(post_embeddings)
+        state.sentiment_features.update(pos_scores, neg_scores)
+        self._update_clustering(state, len(user_post_set))
+
+    def _new_state(self, user_id: str) -> UserScoringState:
+        if len(self._states) >= self.max_users:
+            # dicts keep insertion order, re-scored users are re-inserted at the end
+            del self._states[next(iter(self._states))]
+        state = UserScoringState(user_id, self.model.embedding_model.config.hidden_size)
+        self._states[user_id] = state
+        return state
+
+    def score_user(self, user_id) -> Dict:
+        """
+        (re-)build the state of a user from all its posts (see data_loader.load_user_post_set) and score it
+        """
+        user_id = str(user_id)
+        with self._lock:
+            self._states.pop(user_id, None)
+            state = self._new_state(user_id)
+            self._add_to_state(state, load_user_post_set(user_id))
+            result = self._run_head(state)
+        result["num_new_posts"] = result["num_posts"]
+        return result
+
+    def add_posts(self, user_id, posts: List) -> Dict:
+        """
+        add new posts of a user and re-score it, users without state are scored from their full history first
+
+        :param user_id: user id
+        :param posts: new posts, [timestamp, text] pairs as in the posts json files
+        :return: {'user_id', 'num_posts', 'num_new_posts', 'logits', 'class_probabilities', 'label', 'metric_scores'}
+        """
+        user_id = str(user_id)
+        new_post_set = UserPostSet.from_posts([post[0] for post in posts], [post[1] for post in posts])
+        with self._lock:
+            # looked up under the lock, the user may have been evicted by another thread
+            state = self._states.pop(user_id, None)
+            if state is None:
+                state = self._new_state(user_id)
+                self._add_to_state(state, load_user_post_set(user_id))
+            else:
+                self._states[user_id] = state
+            self._add_to_state(state, new_post_set)
+            result = self._run_head(state)
+        result["num_new_posts"] = len(new_post_set)
+        return result
+
+
+class PostQueueConsumer(threading.Thread):
+    """
+    re-score users from (user id, posts) items of an in-process queue, None stops the consumer
+    """
+
+    def __init__(self, scorer: IncrementalUserScorer, post_queue: queue.Queue,
+                 on_result: Callable[[Dict], None] = None):
+        super().__init__(daemon=True, name="post_queue_consumer")
+        self.scorer = scorer
+        self.post_queue = post_queue
+        self.on_result = on_result or (lambda result: timestamped_print("user [%s] scored: %s" % (
+            result["user_id"], result["label"])))
+
+    def run(self):
+        while True:
+            item = self.post_queue.get()
+            try:
+                if item is None:
+                    return
+                user_id, posts = item
+                try:
+                    self.on_result(self.scorer.add_posts(user_id, posts))
+                except Exception as err:
+                    logger.exception("failed to re-score user [%s]: %s", user_id, err)
+            finally:
+                self.post_queue.task_done()
+
+
+class PostDropWatcher(object):
+    """
+    re-score users from json files dropped into a directory
+
+    Every file {"user_id": ..., "posts": [[timestamp, text], ...]} is moved to <drop dir>/processed (or
+    <drop dir>/failed) once handled, and the scoring result is written to <drop dir>/results.
+    Files starting with '.' (e.g., being written) are ignored.
+    """
+
+    def __init__(self, scorer: IncrementalUserScorer, drop_dir: str, poll_seconds: float = 1.0):
+        self.scorer = scorer
+        self.drop_dir = drop_dir
+        self.poll_seconds = poll_seconds
+        for sub_dir in ("processed", "failed", "results"):
+            os.makedirs(os.path.join(drop_dir, sub_dir), exist_ok=True)
+
+    def poll_once(self) -> int:
+        """
+        :return: number of handled files
+        """
+        file_names = sorted(file_name for file_name in os.listdir(self.drop_dir)
+                            if file_name.endswith(".json") and not file_name.startswith("."))
+        for file_name in file_names:
+            file_path = os.path.join(self.drop_dir, file_name)
+            try:
+                with open(file_path, encoding='utf-8') as f:
+                    dropped = json.load(f)
+                result = self.scorer.add_posts(dropped["user_id"], dropped["posts"])
+            except Exception as err:
+                logger.exception("failed to handle dropped posts [%s]: %s", file_path, err)
+                with open(os.path.join(self.drop_dir, "failed", file_name + ".error"), 'w') as f:
+                    f.write("%s: %s\n" % (type(err).__name__, err))
+                shutil.move(file_path, os.path.join(self.drop_dir, "failed", file_name))
+                continue
+            result_path = os.path.join(self.drop_dir, "results", file_name)
+            with open(result_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            os.replace(result_path + ".tmp", result_path)
+            shutil.move(file_path, os.path.join(self.drop_dir, "processed", file_name))
+            timestamped_print("user [%s] re-scored with [%s] new posts: %s" % (
+                result["user_id"], result["num_new_posts"], result["label"]))
+        return len(file_names)
+
+    def run_forever(self):
+        while True:
+            if self.poll_once() == 0:
+                time.sleep(self.poll_seconds)
+
+
+if __name__ == '__main__':
+    import optparse
+    from depression_classifier_778_clustering import load_classifier_from_archive
+
+    parser = optparse.OptionParser()
+    parser.add_option('--vocab_dir', dest="vocab_dir", help="vocabulary directory of the trained model",
+                      default=None)
+    parser.add_option('--model_weights', dest="model_weights", help="weights file of the trained model",
+                      default=None)
+    parser.add_option('--post_dir', dest="postdir", help="directory where posts are saved", default=None)
+    parser.add_option('--drop_dir', dest="drop_dir", help="directory watched for dropped new posts", default=None)
+    parser.add_option('--poll_seconds', dest="poll_seconds", help="polling interval of the drop directory",
+                      default=1.0)
+    parser.add_option('--recluster_fraction', dest="recluster_fraction",
+                      help="re-cluster a user once its posts grew by this fraction (default 0.2)",
+                      default=DEFAULT_RECLUSTER_FRACTION)
+    options, args = parser.parse_args()
+
+    if options.drop_dir is None:
+        parser.error("--drop_dir is required")
+
+    data_loader.post_data_dir = options.postdir
+    _, dnn_predictor = load_classifier_from_archive(vocab_dir_path=options.vocab_dir,
+                                                    model_weight_file=options.model_weights)
+    user_scorer = IncrementalUserScorer(dnn_predictor, recluster_fraction=float(options.recluster_fraction))
+    timestamped_print("watching [%s] for new posts ..." % options.drop_dir)
+    PostDropWatcher(user_scorer, options.drop_dir, poll_seconds=float(options.poll_seconds)).run_forever()
@@ -0,0 +1,193 @@
+"""
+Named stage timers and counters of the training and scoring pipeline
+
+Stages of the forward pipeline are timed with `stage(name)` and quantities (users, posts, tokens) are counted with
+`count(name, value)`. Timings and counts are summed per batch (`end_batch`) and per epoch (`end_epoch`).
+
+Instrumentation is disabled by default: `stage` then returns a shared no-op context manager and `count` returns
+at once, so the hot path pays a global lookup per call. Stages run in data loader worker processes are recorded in
+the workers, not in the training process.
+
+While torch.profiler runs (`enable_profiling`, see TorchProfilerCallback), every stage is also a labelled range
+(`torch.profiler.record_function`) of the profile, and finer ranges (e.g., every attention block) are added with
+`profile_range(name)`, a no-op otherwise.
+
+usage:
+    instrumentation.enable()
+    with instrumentation.stage(instrumentation.STAGE_ENCODE):
+        ...
+    instrumentation.count(instrumentation.COUNT_POSTS, len(texts))
+"""
+import time
+import threading
+from collections import defaultdict
+from typing import Dict
+
+STAGE_DATA_WAIT = "data_wait"
+STAGE_POST_LOAD = "post_load"
+STAGE_SENTIMENT = "sentiment_scoring"
+STAGE_ENCODE = "bert_encode"
+STAGE_CLUSTERING = "clustering"
+STAGE_SORT = "sort"
+STAGE_PAD = "pad"
+STAGE_HAN = "han"
+STAGE_FEEDFORWARD = "feedforward"
+STAGES = [STAGE_DATA_WAIT, STAGE_POST_LOAD, STAGE_SENTIMENT, STAGE_ENCODE, STAGE_CLUSTERING, STAGE_SORT, STAGE_PAD,
+          STAGE_HAN, STAGE_FEEDFORWARD]
+
+COUNT_USERS = "users"
+COUNT_POSTS = "posts"
+COUNT_ENCODED_POSTS = "encoded_posts"
+COUNT_ENCODED_TOKENS = "encoded_tokens"
+
+_enabled = False
+_profiling = False
+_record_function = None
+_lock = threading.Lock()
+_batch_seconds = defaultdict(float)
+_batch_counts = defaultdict(int)
+_epoch_seconds = defaultdict(float)
+_epoch_counts = defaultdict(int)
+_epoch_batches = 0
+
+
+class _NoOpStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_OP_STAGE = _NoOpStage()
+
+
+class _Stage(object):
+    __slots__ = ("name", "start", "profile_range")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+        self.profile_range = None
+
+    def __enter__(self):
+        if _profiling:
+            self.profile_range = _record_function(self.name)
+            self.profile_range.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_seconds(self.name, time.perf_counter() - self.start)
+        if self.profile_range is not None:
+            self.profile_range.__exit__(exc_type, exc_value, traceback)
+            self.profile_range = None
+        return False
+
+
+def enable(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable_profiling(enabled: bool = True):
+    """
+    label stages and profile ranges in the torch.profiler profile being recorded
+    """
+    global _profiling, _record_function
+    if enabled and _record_function is None:
+        from torch.profiler import record_function
+        _record_function = record_function
+    _profiling = enabled
+
+
+def stage(name: str):
+    """
+    :return: context manager adding its wall time to the stage `name` and labelling it in the profile, if
+        enabled (no-op otherwise)
+    """
+    if not _enabled and not _profiling:
+        return _NO_OP_STAGE
+    return _Stage(name)
+
+
+def profile_range(name: str):
+    """
+    :return: context manager labelling a range `name` in the profile while profiling (no-op otherwise)
+    """
+    if not _profiling:
+        return _NO_OP_STAGE
+    return _record_function(name)
+
+
+def add_seconds(name: str, seconds: float):
+    if not _enabled:
+        return
+    with _lock:
+        _batch_seconds[name] += seconds
+
+
+def count(name: str, value: int = 1):
+    if not _enabled:
+        return
+    with _lock:
+        _batch_counts[name] += value
+
+
+def _fold_batch() -> Dict[str, Dict[str, float]]:
+    # under _lock
+    batch = {"seconds": dict(_batch_seconds), "counts": dict(_batch_counts)}
+    for name, seconds in _batch_seconds.items():
+        _epoch_seconds[name] += seconds
+    for name, value in _batch_counts.items():
+        _epoch_counts[name] += value
+    _batch_seconds.clear()
+    _batch_counts.clear()
+    return batch
+
+
+def end_batch() -> Dict[str, Dict[str, float]]:
+    """
+    fold the timings and counts of the current batch into the epoch totals
+
+    :return: {"seconds": {stage: seconds}, "counts": {counter: value}} of the batch, empty if disabled
+    """
+    global _epoch_batches
+    if not _enabled:
+        return {}
+    with _lock:
+        _epoch_batches += 1
+        return _fold_batch()
+
+
+def end_epoch() -> Dict[str, Dict[str, float]]:
+    """
+    :return: {"seconds": {stage: seconds}, "counts": {counter: value}, "batches": number of batches} of the epoch,
+        empty if disabled. Timings and counts of an unfinished batch are included.
+    """
+    global _epoch_batches
+    if not _enabled:
+        return {}
+    with _lock:
+        _fold_batch()
+        epoch = {"seconds": dict(_epoch_seconds), "counts": dict(_epoch_counts), "batches": _epoch_batches}
+        _epoch_seconds.clear()
+        _epoch_counts.clear()
+        _epoch_batches = 0
+    return epoch
+
+
+def summary(stats: Dict) -> str:
+    """
+    one line of stage seconds (in pipeline order) and counts of `end_batch` or `end_epoch` stats
+    """
+    seconds = stats.get("seconds", {})
+    stage_names = [name for name in STAGES if name in seconds] + sorted(set(seconds) - set(STAGES))
+    return ", ".join(["%s %.3fs" % (name, seconds[name]) for name in stage_names] +
+                     ["%s %s" % (name, value) for name, value in sorted(stats.get("counts", {}).items())])
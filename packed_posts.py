@@ -0,0 +1,151 @@
+"""
+Packed columnar post store
+
+The per-user json files ({user_id}.json, a list of [timestamp, text]) are converted once into columns:
+    users.json        -- user ids in store order
+    user_offsets.npy  -- int64 (number of users + 1), posts of user i are rows user_offsets[i]:user_offsets[i + 1]
+    timestamps.npy    -- int64 (number of posts), seconds past Epoch (UTC)
+    text_offsets.npy  -- int64 (number of posts + 1), byte offsets of the post texts in text.bin
+    text.bin          -- UTF-8 encoded post texts
+All columns are memory-mapped on read, so a user's posts are returned as zero-copy slices (data_loader.UserPostSet).
+
+usage:
+    python packed_posts.py --post_dir <post dir> --packed_dir <output dir>
+"""
+import os
+import json
+import logging
+from array import array
+from typing import List, Optional
+
+import numpy as np
+
+import data_loader
+from data_loader import UserPostSet, load_post_json, load_posts_dataset_index, to_epoch_seconds
+
+logger = logging.getLogger(__name__)
+
+PACKED_FORMAT_VERSION = 1
+USERS_FILE_NAME = "users.json"
+USER_OFFSETS_FILE_NAME = "user_offsets.npy"
+TIMESTAMPS_FILE_NAME = "timestamps.npy"
+TEXT_OFFSETS_FILE_NAME = "text_offsets.npy"
+TEXT_FILE_NAME = "text.bin"
+META_FILE_NAME = "meta.json"
+
+
+def convert_posts_to_packed(post_data_dir: str, packed_dir: str, user_ids: List[str] = None) -> int:
+    """
+    convert the per-user post json files into a packed post store
+
+    :param post_data_dir: directory where posts are saved
+    :param packed_dir: output directory of the packed post store
+    :param user_ids: users to convert, all users under post_data_dir if None
+    :return: number of converted posts
+    """
+    os.makedirs(packed_dir, exist_ok=True)
+    posts_dataset_index = load_posts_dataset_index(post_data_dir)
+    if user_ids is None:
+        user_ids = sorted(posts_dataset_index.keys())
+
+    packed_user_ids = []
+    user_offsets = array('q', [0])
+    timestamps = array('q')
+    text_offsets = array('q', [0])
+    with open(os.path.join(packed_dir, TEXT_FILE_NAME), 'wb') as text_file:
+        for user_id in user_ids:
+            user_entry = posts_dataset_index.get(str(user_id))
+            if user_entry is None or user_entry['size'] < 0:
+                logger.warning("no posts json found for user [%s]", user_id)
+                continue
+            user_objs = load_post_json(os.path.join(user_entry['dir'], '{}.json'.format(user_id)))
+            for obj in user_objs:
+                encoded_text = obj[1].encode('utf-8', errors='surrogatepass')
+                text_file.write(encoded_text)
+                timestamps.append(to_epoch_seconds(obj[0]))
+                text_offsets.append(text_offsets[-1] + len(encoded_text))
+            packed_user_ids.append(str(user_id))
+            user_offsets.append(len(timestamps))
+
+    np.save(os.path.join(packed_dir, USER_OFFSETS_FILE_NAME), np.frombuffer(user_offsets, dtype=np.int64))
+    np.save(os.path.join(packed_dir, TIMESTAMPS_FILE_NAME), np.frombuffer(timestamps, dtype=np.int64))
+    np.save(os.path.join(packed_dir, TEXT_OFFSETS_FILE_NAME), np.frombuffer(text_offsets, dtype=np.int64))
+    with open(os.path.join(packed_dir, USERS_FILE_NAME), 'w') as f:
+        json.dump(packed_user_ids, f)
+    # meta file is written last, a store without it is incomplete
+    with open(os.path.join(packed_dir, META_FILE_NAME), 'w') as f:
+        json.dump({"version": PACKED_FORMAT_VERSION, "num_users": len(packed_user_ids),
+                   "num_posts": len(timestamps), "post_data_dir": os.path.abspath(post_data_dir)}, f)
+    return len(timestamps)
+
+
+class PackedPostStore(object):
+    """
+    memory-mapped reader of a packed post store
+    """
+
+    def __init__(self, packed_dir: str):
+        self.packed_dir = packed_dir
+        meta_path = os.path.join(packed_dir, META_FILE_NAME)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError("no complete packed post store found in [%s]" % packed_dir)
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(packed_dir, USERS_FILE_NAME)) as f:
+            self._user_positions = {user_id: i for i, user_id in enumerate(json.load(f))}
+
+        self.user_offsets = np.load(os.path.join(packed_dir, USER_OFFSETS_FILE_NAME), mmap_mode='r')
+        self.timestamps = np.load(os.path.join(packed_dir, TIMESTAMPS_FILE_NAME), mmap_mode='r')
+        self.text_offsets = np.load(os.path.join(packed_dir, TEXT_OFFSETS_FILE_NAME), mmap_mode='r')
+        text_path = os.path.join(packed_dir, TEXT_FILE_NAME)
+        # empty files can not be memory-mapped
+        self.text_buffer = np.memmap(text_path, dtype=np.uint8, mode='r') if os.path.getsize(text_path) > 0 \
+            else np.zeros(0, dtype=np.uint8)
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self._user_positions
+
+    def __len__(self):
+        return len(self._user_positions)
+
+    def user_ids(self) -> List[str]:
+        return list(self._user_positions.keys())
+
+    def num_posts(self, user_id) -> int:
+        position = self._user_positions.get(str(user_id))
+        if position is None:
+            return 0
+        return int(self.user_offsets[position + 1] - self.user_offsets[position])
+
+    def load_user_post_set(self, user_id) -> Optional[UserPostSet]:
+        """
+        :return: posts of the user as views on the memory-mapped columns, None if the user is not in the store
+        """
+        position = self._user_positions.get(str(user_id))
+        if position is None:
+            return None
+        start, end = int(self.user_offsets[position]), int(self.user_offsets[position + 1])
+        return UserPostSet(self.timestamps[start:end], self.text_buffer, self.text_offsets[start:end + 1])
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--post_dir',
+                      dest="postdir",
+                      help="directory where posts are saved", default=None)
+
+    parser.add_option('--packed_dir',
+                      dest="packed_dir",
+                      help="output directory of the packed post store", default=None)
+
+    options, args = parser.parse_args()
+
+    if options.postdir is None or options.packed_dir is None:
+        parser.error("--post_dir and --packed_dir are required")
+
+    data_loader.post_data_dir = options.postdir
+    num_posts = convert_posts_to_packed(options.postdir, options.packed_dir)
+    print("done. %s posts packed into [%s]" % (num_posts, options.packed_dir))
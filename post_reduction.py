@@ -0,0 +1,298 @@
+"""
+Pluggable reduction of a user's post embeddings to cluster representatives
+
+Every reducer clusters the post embeddings of a user into `num_clusters` clusters and keeps the last post of
+every non-empty cluster (in cluster order), as `kmeans_clustering` does. Reducers:
+
+    kmeans     -- scikit-learn KMeans(n_init=10, random_state=42), the original implementation
+    minibatch  -- scikit-learn MiniBatchKMeans
+    torch      -- k-means++ and Lloyd iterations vectorised in torch, optionally on a random projection
+                  of the embeddings
+
+`PostReductionEngine` adds warm starts (the centroids of a user's previous clustering, e.g. from the previous
+epoch, initialise the next one, kept under a memory budget in the training process only) and clusters the users
+of a batch in parallel on a process pool.
+"""
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NUM_REPRESENTATIVE_POSTS = 200
+REDUCER_KMEANS = "kmeans"
+REDUCER_MINIBATCH = "minibatch"
+REDUCER_TORCH = "torch"
+REDUCERS = [REDUCER_KMEANS, REDUCER_MINIBATCH, REDUCER_TORCH]
+# centroids of 200 clusters x 768 dims take ~0.6 MB per user
+DEFAULT_WARM_START_CACHE_SIZE_MB = 128
+
+
+def last_post_per_cluster(cluster_ids: np.ndarray, num_clusters: int) -> np.ndarray:
+    """
+    :return: index of the last post assigned to each cluster, -1 for empty clusters
+    """
+    last_post_indices = np.full(num_clusters, -1, dtype=np.int64)
+    # the order of repeated fancy-index writes is not guaranteed, the maximum is the last post
+    np.maximum.at(last_post_indices, cluster_ids, np.arange(len(cluster_ids)))
+    return last_post_indices
+
+
+class KMeansReducer(object):
+    """
+    scikit-learn KMeans, ten k-means++ initialisations or a single run from given centroids
+    """
+    name = REDUCER_KMEANS
+
+    def __init__(self, n_init: int = 10, random_state: int = 42):
+        self.n_init = n_init
+        self.random_state = random_state
+
+    def fit(self, post_embeddings: np.ndarray, num_clusters: int,
+            init_centroids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param post_embeddings: (number of posts, embedding dim)
+        :param num_clusters: number of clusters
+        :param init_centroids: (num_clusters, embedding dim) initial centroids (warm start), k-means++ if None
+        :return: last post index of every cluster (-1 for empty clusters), centroids
+        """
+        from sklearn.cluster import KMeans
+        if init_centroids is not None:
+            kmeans = KMeans(n_clusters=num_clusters, init=init_centroids, n_init=1, random_state=self.random_state)
+        else:
+            kmeans = KMeans(n_clusters=num_clusters, random_state=self.random_state, n_init=self.n_init)
+        cluster_ids = kmeans.fit_predict(post_embeddings)
+        return last_post_per_cluster(cluster_ids, num_clusters), kmeans.cluster_centers_
+
+
+class MiniBatchKMeansReducer(object):
+    """
+    scikit-learn MiniBatchKMeans
+    """
+    name = REDUCER_MINIBATCH
+
+    def __init__(self, batch_size: int = 1024, n_init: int = 3, random_state: int = 42):
+        self.batch_size = batch_size
+        self.n_init = n_init
+        self.random_state = random_state
+
+    def fit(self, post_embeddings: np.ndarray, num_clusters: int,
+            init_centroids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        from sklearn.cluster import MiniBatchKMeans
+        if init_centroids is not None:
+            kmeans = MiniBatchKMeans(n_clusters=num_clusters, init=init_centroids, n_init=1,
+                                     batch_size=self.batch_size, random_state=self.random_state)
+        else:
+            kmeans = MiniBatchKMeans(n_clusters=num_clusters, n_init=self.n_init, batch_size=self.batch_size,
+                                     random_state=self.random_state)
+        cluster_ids = kmeans.fit_predict(post_embeddings)
+        return last_post_per_cluster(cluster_ids, num_clusters), kmeans.cluster_centers_
+
+
+class TorchKMeansReducer(object):
+    """
+    k-means++ initialisation and Lloyd iterations in torch (CPU or GPU), optionally on a Gaussian random
+    projection of the embeddings to projection_dim dimensions. Centroids are in the projected space.
+    """
+    name = REDUCER_TORCH
+
+    def __init__(self, projection_dim: int = None, max_iter: int = 100, tol: float = 1e-4, seed: int = 42,
+                 device: str = "cpu"):
+        self.projection_dim = projection_dim
+        self.max_iter = max_iter
+        self.tol = tol
+        self.seed = seed
+        self.device = device
+        self._projection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_projection"] = None
+        return state
+
+    def _project(self, embeddings):
+        import torch
+        if self.projection_dim is None or self.projection_dim >= embeddings.shape[1]:
+            return embeddings
+        if self._projection is None or self._projection.shape[0] != embeddings.shape[1]:
+            generator = torch.Generator().manual_seed(self.seed)
+            self._projection = (torch.randn(embeddings.shape[1], self.projection_dim, generator=generator)
+                                / np.sqrt(self.projection_dim)).to(self.device)
+        return embeddings @ self._projection
+
+    def _kmeans_plus_plus(self, points, num_clusters: int, generator):
+        import torch
+        num_points = points.shape[0]
+        centroids = torch.empty(num_clusters, points.shape[1], dtype=points.dtype, device=points.device)
+        first_index = torch.randint(num_points, (1,), generator=generator).item()
+        centroids[0] = points[first_index]
+        closest_squared_distances = ((points - centroids[0]) ** 2).sum(dim=1)
+        for c in range(1, num_clusters):
+            total = closest_squared_distances.sum()
+            if total <= 0:
+                # fewer distinct points than clusters
+                index = torch.randint(num_points, (1,), generator=generator).item()
+            else:
+                index = torch.multinomial((closest_squared_distances / total).cpu(), 1, generator=generator).item()
+            centroids[c] = points[index]
+            closest_squared_distances = torch.minimum(closest_squared_distances,
+                                                      ((points - centroids[c]) ** 2).sum(dim=1))
+        return centroids
+
+    @staticmethod
+    def _assign(points, centroids, point_norms):
+        squared_distances = point_norms[:, None] - 2 * points @ centroids.T + (centroids ** 2).sum(dim=1)[None, :]
+        return squared_distances.argmin(dim=1)
+
+    def fit(self, post_embeddings: np.ndarray, num_clusters: int,
+            init_centroids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        import torch
+        with torch.no_grad():
+            points = self._project(torch.as_tensor(np.asarray(post_embeddings, dtype=np.float32),
+                                                   device=self.device))
+            point_norms = (points ** 2).sum(dim=1)
+            generator = torch.Generator().manual_seed(self.seed)
+            if init_centroids is not None and tuple(init_centroids.shape) == (num_clusters, points.shape[1]):
+                centroids = torch.as_tensor(init_centroids, dtype=points.dtype, device=self.device)
+            else:
+                centroids = self._kmeans_plus_plus(points, num_clusters, generator)
+            # convergence threshold relative to the data variance, as in scikit-learn
+            tolerance = self.tol * points.var(dim=0).mean()
+            cluster_ids = self._assign(points, centroids, point_norms)
+            for _ in range(self.max_iter):
+                sums = torch.zeros_like(centroids).index_add_(0, cluster_ids, points)
+                counts = torch.bincount(cluster_ids, minlength=num_clusters).to(points.dtype)
+                new_centroids = torch.where(counts[:, None] > 0, sums / counts.clamp(min=1)[:, None], centroids)
+                shift = ((new_centroids - centroids) ** 2).sum()
+                centroids = new_centroids
+                cluster_ids = self._assign(points, centroids, point_norms)
+                if shift <= tolerance:
+                    break
+        return last_post_per_cluster(cluster_ids.cpu().numpy(), num_clusters), centroids.cpu().numpy()
+
+
+def reducer_id(reducer) -> str:
+    """
+    name and parameters of a reducer, identifies its selections (e.g., in a feature_store.SelectionStore)
+    """
+    parameters = ",".join("%s=%s" % (name, value) for name, value in sorted(vars(reducer).items())
+                          if not name.startswith("_") and name != "device")
+    return "%s(%s)" % (reducer.name, parameters)
+
+
+def new_reducer(reducer_name: str = REDUCER_KMEANS, projection_dim: int = None, device: str = "cpu"):
+    if reducer_name == REDUCER_KMEANS:
+        return KMeansReducer()
+    if reducer_name == REDUCER_MINIBATCH:
+        return MiniBatchKMeansReducer()
+    if reducer_name == REDUCER_TORCH:
+        return TorchKMeansReducer(projection_dim=projection_dim, device=device)
+    raise ValueError("unknown post reducer [%s], expected one of %s" % (reducer_name, REDUCERS))
+
+
+def _init_reduction_worker():
+    # one BLAS/torch thread per worker process, users are clustered in parallel instead
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+def _fit_task(reducer, post_embeddings: np.ndarray, num_clusters: int, init_centroids: Optional[np.ndarray]):
+    return reducer.fit(post_embeddings, num_clusters, init_centroids)
+
+
+class PostReductionEngine(object):
+    """
+    select cluster representatives of users with a reducer, with optional warm starts and a process pool
+    """
+
+    def __init__(self, reducer=None, warm_start: bool = False, num_workers: int = 0,
+                 warm_start_cache_size_mb: float = DEFAULT_WARM_START_CACHE_SIZE_MB):
+        """
+        :param reducer: KMeansReducer (default), MiniBatchKMeansReducer or TorchKMeansReducer
+        :param warm_start: initialise the clustering of a user from the centroids of its previous clustering
+        :param num_workers: number of processes clustering the users of a batch in parallel, 0 for in-process
+        :param warm_start_cache_size_mb: memory budget of the centroids kept for warm starts in MB (LRU)
+        """
+        self.reducer = reducer if reducer is not None else KMeansReducer()
+        self.warm_start = warm_start
+        self.num_workers = num_workers
+        self.max_warm_start_bytes = int(warm_start_cache_size_mb * 1024 * 1024)
+        self._centroids: Dict[str, np.ndarray] = OrderedDict()
+        self._centroids_bytes = 0
+        self._executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_reduction_worker) \
+            if num_workers > 0 else None
+
+    def __getstate__(self):
+        # picklable for DataLoader workers, which cluster in-process. Workers are re-created every epoch, so their
+        # centroids would be discarded: warm starts are kept in the training process only
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["num_workers"] = 0
+        state["warm_start"] = False
+        state["_centroids"] = OrderedDict()
+        state["_centroids_bytes"] = 0
+        return state
+
+    def _initial_centroids(self, user_id) -> Optional[np.ndarray]:
+        if not self.warm_start or user_id is None:
+            return None
+        return self._centroids.get(str(user_id))
+
+    def _keep_centroids(self, user_id, centroids: np.ndarray):
+        if not self.warm_start or user_id is None:
+            return
+        centroids = np.asarray(centroids)
+        previous_centroids = self._centroids.pop(str(user_id), None)
+        if previous_centroids is not None:
+            self._centroids_bytes -= previous_centroids.nbytes
+        self._centroids[str(user_id)] = centroids
+        self._centroids_bytes += centroids.nbytes
+        while self._centroids_bytes > self.max_warm_start_bytes and self._centroids:
+            _, evicted_centroids = self._centroids.popitem(last=False)
+            self._centroids_bytes -= evicted_centroids.nbytes
+
+    def select(self, post_embeddings: np.ndarray, num_clusters: int = NUM_REPRESENTATIVE_POSTS,
+               user_id: str = None) -> np.ndarray:
+        """
+        :return: indices of the representative posts, in cluster order (all posts if there are num_clusters or
+            fewer)
+        """
+        return self.select_batch([user_id], [post_embeddings], num_clusters)[0]
+
+    def select_batch(self, user_ids: List, post_embeddings_list: List[np.ndarray],
+                     num_clusters: int = NUM_REPRESENTATIVE_POSTS) -> List[np.ndarray]:
+        """
+        select the representatives of the users of a batch, in parallel if the engine has worker processes
+        """
+        selections = [np.arange(len(post_embeddings)) for post_embeddings in post_embeddings_list]
+        to_cluster = [i for i, post_embeddings in enumerate(post_embeddings_list)
+                      if len(post_embeddings) > num_clusters]
+        if self._executor is not None and len(to_cluster) > 1:
+            futures = [self._executor.submit(_fit_task, self.reducer, np.asarray(post_embeddings_list[i]),
+                                             num_clusters, self._initial_centroids(user_ids[i]))
+                       for i in to_cluster]
+            results = [future.result() for future in futures]
+        else:
+            results = [self.reducer.fit(np.asarray(post_embeddings_list[i]), num_clusters,
+                                        self._initial_centroids(user_ids[i])) for i in to_cluster]
+        for i, (last_post_indices, centroids) in zip(to_cluster, results):
+            self._keep_centroids(user_ids[i], centroids)
+            selections[i] = last_post_indices[last_post_indices >= 0]
+        return selections
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,218 @@
+"""
+Offline precomputation of post embeddings into shards (see embedding_shards.py)
+
+Every user found under --post_dir is encoded with the frozen embedding model (same BERT + mean pooling recipe
+as the classifier) in a pool of worker processes, each limited to --threads_per_worker threads. The model is
+loaded once and its weights are shared by the workers (see shared_encoder.py).
+The run is resumable: users in completed shards are skipped, failed users are recorded in the manifest and
+retried by the next run.
+
+usage:
+    python precompute_embeddings.py --post_dir <post dir> --shard_dir <output dir> --num_workers 8
+"""
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import data_loader
+from embedding_shards import load_manifest, save_manifest, new_manifest, write_shard, check_manifest_version
+from shared_encoder import MemoryStatus, share_memory_encoder
+
+# per-process state of the pool workers
+_worker_tokenizer = None
+_worker_model = None
+_worker_encoding_batch_size = None
+_worker_memory_status = None
+
+THREAD_ENV_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+
+def _init_worker(post_data_dir: str, threads_per_worker: int, encoding_batch_size: int, embedding_model):
+    """
+    :param embedding_model: encoder with its weights in shared memory, received by handle (torch.multiprocessing)
+    """
+    global _worker_tokenizer, _worker_model, _worker_encoding_batch_size, _worker_memory_status
+    import torch
+    from transformers import AutoTokenizer
+    from depression_classifier_778_clustering import EMBEDDING_MODEL_NAME
+
+    _worker_memory_status = MemoryStatus()
+    torch.set_num_threads(threads_per_worker)
+    data_loader.post_data_dir = post_data_dir
+    _worker_tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+    _worker_model = embedding_model
+    _worker_encoding_batch_size = encoding_batch_size
+
+
+def _encode_shard(shard_dir: str, shard_id: int, user_ids: list, embedding_dim: int):
+    """
+    encode all users of a shard and write it
+
+    :return: shard id, encoded user ids, {user id: error message} of failed users, number of encoded posts,
+        memory added by the worker process since it started
+    """
+    from depression_classifier_778_clustering import encode_texts_batched, calculate_metrics
+    from sentiment_scoring import score_texts
+
+    encoded_user_ids, user_embeddings, user_timestamps, user_metric_scores = [], [], [], []
+    failures = {}
+    for user_id in user_ids:
+        try:
+            individual_post_set = data_loader.load_user_post_set(user_id)
+            texts = individual_post_set.texts()
+            post_embeddings = encode_texts_batched(_worker_model, _worker_tokenizer, texts,
+                                                   batch_size=_worker_encoding_batch_size)
+            sentiment_scores = score_texts(texts)
+            metric_scores = [float(score) for score in calculate_metrics(
+                sentiment_scores[:, 0], sentiment_scores[:, 1])]
+        except Exception as err:
+            failures[user_id] = "%s: %s" % (type(err).__name__, err)
+            continue
+        encoded_user_ids.append(user_id)
+        user_embeddings.append(post_embeddings)
+        user_timestamps.append(individual_post_set.timestamps.tolist())
+        user_metric_scores.append(metric_scores)
+
+    write_shard(shard_dir, shard_id, encoded_user_ids, user_embeddings, user_timestamps, user_metric_scores,
+                embedding_dim)
+    return shard_id, encoded_user_ids, failures, sum(len(embeddings) for embeddings in user_embeddings), \
+        _worker_memory_status.report()
+
+
+def precompute_embeddings(post_data_dir: str, shard_dir: str, user_ids: list = None, users_per_shard: int = 64,
+                          num_workers: int = 1, threads_per_worker: int = 1, encoding_batch_size: int = 64):
+    """
+    encode the posts of all (or the given) users into shards, skipping users in already completed shards
+
+    :param post_data_dir: directory where posts are saved
+    :param shard_dir: output directory of shards and manifest
+    :param user_ids: users to encode, all users under post_data_dir if None
+    :param users_per_shard: number of users per shard
+    :param num_workers: number of worker processes
+    :param threads_per_worker: number of torch/BLAS threads per worker process
+    :param encoding_batch_size: number of posts per forward pass of the embedding model
+    :return: manifest
+    """
+    from transformers import AutoConfig, AutoModel
+    from depression_classifier_778_clustering import EMBEDDING_MODEL_NAME, embedding_model_id, timestamped_print
+
+    os.makedirs(shard_dir, exist_ok=True)
+    encoder_config = AutoConfig.from_pretrained(EMBEDDING_MODEL_NAME)
+    encoder_id = embedding_model_id(encoder_config)
+    embedding_dim = encoder_config.hidden_size
+
+    manifest = load_manifest(shard_dir)
+    if manifest is None:
+        manifest = new_manifest(encoder_id, embedding_dim, users_per_shard)
+        save_manifest(shard_dir, manifest)
+    else:
+        check_manifest_version(shard_dir, manifest)
+    if manifest["encoder_id"] != encoder_id or manifest["embedding_dim"] != embedding_dim:
+        raise ValueError("shards in [%s] were encoded with [%s], not with current encoder [%s]" % (
+            shard_dir, manifest["encoder_id"], encoder_id))
+
+    if user_ids is None:
+        data_loader.post_data_dir = post_data_dir
+        user_ids = sorted(data_loader.load_posts_dataset_dir(post_data_dir).keys())
+    user_ids = [str(user_id) for user_id in user_ids]
+
+    completed_user_ids = set(user_id for shard_info in manifest["shards"].values() for user_id in shard_info["users"])
+    pending_user_ids = [user_id for user_id in user_ids if user_id not in completed_user_ids]
+    next_shard_id = max([int(shard_id) for shard_id in manifest["shards"]], default=-1) + 1
+    shard_tasks = {next_shard_id + i: pending_user_ids[start:start + users_per_shard]
+                   for i, start in enumerate(range(0, len(pending_user_ids), users_per_shard))}
+    timestamped_print("%s users in total, %s already encoded, %s shards to encode with %s workers" % (
+        len(user_ids), len(completed_user_ids), len(shard_tasks), num_workers))
+
+    # limit BLAS/OpenMP threads of the worker processes (inherited environment of spawned processes)
+    for env_variable in THREAD_ENV_VARIABLES:
+        os.environ[env_variable] = str(threads_per_worker)
+
+    # loaded once, the workers map the same shared-memory weights
+    embedding_model = share_memory_encoder(AutoModel.from_pretrained(EMBEDDING_MODEL_NAME))
+
+    start_time = time.time()
+    encoded_posts = 0
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(post_data_dir, threads_per_worker, encoding_batch_size,
+                                       embedding_model)) as executor:
+        futures = {executor.submit(_encode_shard, shard_dir, shard_id, shard_user_ids, embedding_dim): shard_id
+                   for shard_id, shard_user_ids in shard_tasks.items()}
+        for future in as_completed(futures):
+            shard_id = futures[future]
+            try:
+                shard_id, encoded_user_ids, failures, num_posts, worker_memory = future.result()
+            except Exception as err:
+                # the whole shard failed (e.g., worker crashed), its users are retried by the next run
+                failures = {user_id: "%s: %s" % (type(err).__name__, err) for user_id in shard_tasks[shard_id]}
+                manifest["failures"].update(failures)
+                save_manifest(shard_dir, manifest)
+                timestamped_print("failed to encode shard [%s]: %s" % (shard_id, err))
+                continue
+
+            manifest["shards"][str(shard_id)] = {"users": encoded_user_ids, "num_posts": num_posts}
+            for user_id in encoded_user_ids:
+                manifest["failures"].pop(user_id, None)
+            manifest["failures"].update(failures)
+            save_manifest(shard_dir, manifest)
+
+            encoded_posts += num_posts
+            elapsed_time = time.time() - start_time
+            timestamped_print("shard [%s] done: %s users, %s posts, %s failures (%.1f posts/s), worker %s" % (
+                shard_id, len(encoded_user_ids), num_posts, len(failures), encoded_posts / max(elapsed_time, 1e-9),
+                worker_memory))
+
+    timestamped_print("done. %s shards, %s failed users recorded in [%s]" % (
+        len(manifest["shards"]), len(manifest["failures"]), shard_dir))
+    return manifest
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--post_dir',
+                      dest="postdir",
+                      help="directory where posts are saved", default=None)
+
+    parser.add_option('--shard_dir',
+                      dest="shard_dir",
+                      help="output directory of the embedding shards", default=None)
+
+    parser.add_option('--user_csv',
+                      dest="user_csv",
+                      help="comma separated dataset csv files (label,user_id) to restrict encoding to their users",
+                      default=None)
+
+    parser.add_option('--users_per_shard', dest="users_per_shard", help="number of users per shard (default 64)",
+                      default=64)
+
+    parser.add_option('--num_workers', dest="num_workers", help="number of worker processes (default 1)",
+                      default=1)
+
+    parser.add_option('--threads_per_worker', dest="threads_per_worker",
+                      help="number of torch threads per worker process (default 1)", default=1)
+
+    parser.add_option("--encoding_batch_size", dest="encoding_batch_size",
+                      help="number of posts per forward pass of the embedding model (default 64)", default=64)
+
+    options, args = parser.parse_args()
+
+    if options.postdir is None or options.shard_dir is None:
+        parser.error("--post_dir and --shard_dir are required")
+
+    selected_user_ids = None
+    if options.user_csv:
+        import pandas as pd
+        selected_user_ids = sorted(set(
+            str(user_id) for csv_path in options.user_csv.split(",")
+            for user_id in pd.read_csv(csv_path, header=0, usecols=range(0, 2)).values[:, 1]))
+
+    precompute_embeddings(options.postdir, options.shard_dir, user_ids=selected_user_ids,
+                          users_per_shard=int(options.users_per_shard),
+                          num_workers=int(options.num_workers),
+                          threads_per_worker=int(options.threads_per_worker),
+                          encoding_batch_size=int(options.encoding_batch_size))
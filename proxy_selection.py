@@ -0,0 +1,151 @@
+"""
+Selection of a user's representative posts before encoding, on a cheap proxy representation of the post texts
+
+Post-encode clustering (see post_reduction.py) encodes every post of a user and keeps at most
+NUM_REPRESENTATIVE_POSTS of them, so up to 95% of the encoded posts of heavy users are thrown away. A proxy
+selector picks the representatives from the texts instead, so that only the selected posts are encoded:
+
+    tfidf    -- hashed TF-IDF vectors of the posts, K-means clustered
+    minhash  -- MinHash sketches of the post words (and word pairs), farthest-first clustered by estimated
+                Jaccard distance
+
+Posts are stratified by time (equal-count periods of the user's history) and every period gets a share of the
+representatives in proportion to its posts, so that no period of the history is dropped. As in post-encode
+clustering, the last post of every cluster is kept.
+"""
+import re
+import zlib
+from typing import List
+
+import numpy as np
+
+from post_reduction import NUM_REPRESENTATIVE_POSTS, last_post_per_cluster
+
+PROXY_TFIDF = "tfidf"
+PROXY_MINHASH = "minhash"
+PROXY_SELECTIONS = [PROXY_TFIDF, PROXY_MINHASH]
+DEFAULT_NUM_STRATA = 10
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def time_strata(timestamps: np.ndarray, num_posts: int, num_strata: int = DEFAULT_NUM_STRATA) -> List:
+    """
+    split posts into equal-count periods of time and share num_posts representatives among them in proportion to
+    their number of posts (largest remainder)
+
+    :return: (post indices, number of representatives) per period
+    """
+    temporal_order = np.argsort(timestamps, kind='stable')
+    strata = [indices for indices in np.array_split(temporal_order, min(num_strata, len(timestamps)))
+              if len(indices) > 0]
+    sizes = np.array([len(indices) for indices in strata])
+    shares = sizes * num_posts / sizes.sum()
+    quotas = np.minimum(np.floor(shares).astype(np.int64), sizes)
+    for i in np.argsort(-(shares - quotas), kind='stable')[:max(num_posts - int(quotas.sum()), 0)]:
+        quotas[i] = min(quotas[i] + 1, sizes[i])
+    return list(zip(strata, quotas.tolist()))
+
+
+class ProxyPostSelector(object):
+    """
+    select up to num_posts representative posts of a user from the post texts
+    """
+
+    def __init__(self, method: str = PROXY_TFIDF, num_posts: int = NUM_REPRESENTATIVE_POSTS,
+                 num_strata: int = DEFAULT_NUM_STRATA, num_features: int = 1 << 14, num_permutations: int = 64,
+                 seed: int = 42):
+        """
+        :param method: 'tfidf' or 'minhash'
+        :param num_posts: number of representatives (clusters)
+        :param num_strata: number of periods of time the representatives are shared among
+        :param num_features: hashed TF-IDF dimension
+        :param num_permutations: MinHash sketch size
+        :param seed: seed of the K-means initialisation and the MinHash permutations
+        """
+        if method not in PROXY_SELECTIONS:
+            raise ValueError("unknown proxy selection [%s], expected one of %s" % (method, PROXY_SELECTIONS))
+        self.method = method
+        self.num_posts = num_posts
+        self.num_strata = num_strata
+        self.num_features = num_features
+        self.num_permutations = num_permutations
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self._permutation_a = rng.randint(1, 1 << 31, size=num_permutations).astype(np.uint64)
+        self._permutation_b = rng.randint(0, 1 << 31, size=num_permutations).astype(np.uint64)
+
+    @property
+    def selection_id(self) -> str:
+        """ method and parameters, identifies the selections (e.g., in a feature_store.SelectionStore) """
+        parameters = "num_strata=%s,seed=%s" % (self.num_strata, self.seed)
+        if self.method == PROXY_TFIDF:
+            parameters += ",num_features=%s" % self.num_features
+        else:
+            parameters += ",num_permutations=%s" % self.num_permutations
+        return "proxy-%s(%s)" % (self.method, parameters)
+
+    def select(self, timestamps: np.ndarray, texts: List[str]) -> np.ndarray:
+        """
+        :param timestamps: post timestamps (seconds past Epoch)
+        :param texts: post texts
+        :return: ascending indices of the selected posts, all posts if there are num_posts or fewer
+        """
+        if len(texts) <= self.num_posts:
+            return np.arange(len(texts))
+        select_in_stratum = self._select_tfidf if self.method == PROXY_TFIDF else self._select_minhash
+        selected = []
+        for stratum_indices, quota in time_strata(np.asarray(timestamps), self.num_posts, self.num_strata):
+            if quota >= len(stratum_indices):
+                selected.append(stratum_indices)
+            elif quota > 0:
+                # stratum indices are in temporal order, so the last post of a cluster is its most recent one
+                selected.append(stratum_indices[select_in_stratum([texts[i] for i in stratum_indices], quota)])
+        return np.sort(np.concatenate(selected))
+
+    def _select_tfidf(self, texts: List[str], num_clusters: int) -> np.ndarray:
+        from sklearn.cluster import KMeans
+        from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+        counts = HashingVectorizer(n_features=self.num_features, alternate_sign=False, norm=None).transform(texts)
+        tfidf = TfidfTransformer().fit_transform(counts)
+        cluster_ids = KMeans(n_clusters=num_clusters, n_init=1, random_state=self.seed).fit_predict(tfidf)
+        last_post_indices = last_post_per_cluster(cluster_ids, num_clusters)
+        return last_post_indices[last_post_indices >= 0]
+
+    def minhash_sketches(self, texts: List[str]) -> np.ndarray:
+        """
+        :return: (number of texts, num_permutations) MinHash sketches of the lower-cased words and word pairs
+        """
+        sketches = np.full((len(texts), self.num_permutations), _MERSENNE_PRIME, dtype=np.uint64)
+        for i, text in enumerate(texts):
+            words = _TOKEN_PATTERN.findall(text.lower())
+            shingles = words + [words[j] + " " + words[j + 1] for j in range(len(words) - 1)]
+            if not shingles:
+                continue
+            hashes = np.array([zlib.crc32(shingle.encode('utf-8', errors='surrogatepass'))
+                               for shingle in set(shingles)], dtype=np.uint64)
+            # a * x + b mod p stays below 2^64 for 31-bit a, b and 32-bit x
+            permuted = (self._permutation_a[:, None] * hashes[None, :] + self._permutation_b[:, None]) \
+                % np.uint64(_MERSENNE_PRIME)
+            sketches[i] = permuted.min(axis=1)
+        return sketches
+
+    def _select_minhash(self, texts: List[str], num_clusters: int) -> np.ndarray:
+        sketches = self.minhash_sketches(texts)
+        # farthest-first centres by estimated Jaccard distance, starting from the most recent post
+        centres = [len(texts) - 1]
+        distances = 1.0 - (sketches == sketches[centres[0]]).mean(axis=1)
+        cluster_ids = np.zeros(len(texts), dtype=np.int64)
+        for c in range(1, num_clusters):
+            centre = int(np.argmax(distances))
+            if distances[centre] <= 0:
+                # remaining posts are duplicates of a centre
+                break
+            centres.append(centre)
+            centre_distances = 1.0 - (sketches == sketches[centre]).mean(axis=1)
+            closer = centre_distances < distances
+            cluster_ids[closer] = c
+            distances = np.minimum(distances, centre_distances)
+        last_post_indices = last_post_per_cluster(cluster_ids, len(centres))
+        return last_post_indices[last_post_indices >= 0]
@@ -0,0 +1,162 @@
+"""
+VADER sentiment scoring of posts on a process pool, with per-post caching
+
+Only the 'pos' and 'neg' scores are kept (the inputs of the temporal sentiment features, see
+temporal_features.py). Posts are scored in chunks by worker processes, so scoring of a batch can run while the
+posts are encoded; scores are cached by text hash, so posts seen in earlier epochs are not scored again.
+"""
+import hashlib
+import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Dict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SENTIMENT_WORKERS = 4
+DEFAULT_SENTIMENT_CHUNK_SIZE = 256
+DEFAULT_SENTIMENT_CACHE_ENTRIES = 500000
+
+# VADER analyzer of the current process (pool worker or inline scoring)
+_analyzer = None
+
+
+def _get_analyzer():
+    global _analyzer
+    if _analyzer is None:
+        from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+        _analyzer = SentimentIntensityAnalyzer()
+    return _analyzer
+
+
+def score_texts(texts: List[str]) -> np.ndarray:
+    """
+    :return: (number of texts, 2) float64 array of VADER 'pos' and 'neg' scores
+    """
+    analyzer = _get_analyzer()
+    scores = np.zeros((len(texts), 2), dtype=np.float64)
+    for i, text in enumerate(texts):
+        polarity_scores = analyzer.polarity_scores(text)
+        scores[i, 0] = polarity_scores['pos']
+        scores[i, 1] = polarity_scores['neg']
+    return scores
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+
+
+class PendingSentimentScores(object):
+    """
+    scores of a list of texts, some of them still being scored by the pool
+    """
+
+    def __init__(self, scorer: 'SentimentScorer', scores: np.ndarray, pending_chunks: List):
+        self._scorer = scorer
+        self._scores = scores
+        # (future, positions in texts of every scored text, text hashes)
+        self._pending_chunks = pending_chunks
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (pos scores, neg scores) in the order of the texts
+        """
+        for future, positions_per_text, hashes in self._pending_chunks:
+            chunk_scores = future.result()
+            for positions, text_scores in zip(positions_per_text, chunk_scores):
+                self._scores[positions] = text_scores
+            self._scorer._cache_scores(hashes, chunk_scores)
+        self._pending_chunks = []
+        return self._scores[:, 0], self._scores[:, 1]
+
+
+class _CompletedFuture(object):
+    def __init__(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+
+class SentimentScorer(object):
+    """
+    score posts with VADER on a pool of worker processes (inline if num_workers is 0)
+    """
+
+    def __init__(self, num_workers: int = DEFAULT_SENTIMENT_WORKERS, chunk_size: int = DEFAULT_SENTIMENT_CHUNK_SIZE,
+                 max_cache_entries: int = DEFAULT_SENTIMENT_CACHE_ENTRIES):
+        """
+        :param num_workers: number of scoring processes, 0 to score in the calling thread
+        :param chunk_size: number of posts per task of a worker process
+        :param max_cache_entries: maximum number of cached post scores (LRU)
+        """
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.max_cache_entries = max_cache_entries
+        # spawned workers do not inherit the (possibly CUDA initialised) training process
+        self._executor = ProcessPoolExecutor(max_workers=num_workers,
+                                             mp_context=multiprocessing.get_context("spawn")) \
+            if num_workers > 0 else None
+        self._cache: Dict[bytes, Tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_scores(self, hashes: List[bytes], scores: np.ndarray):
+        with self._lock:
+            for hash_key, (pos_score, neg_score) in zip(hashes, scores.tolist()):
+                self._cache[hash_key] = (pos_score, neg_score)
+                self._cache.move_to_end(hash_key)
+            while len(self._cache) > self.max_cache_entries:
+                self._cache.popitem(last=False)
+
+    def submit(self, texts: List[str]) -> PendingSentimentScores:
+        """
+        start scoring texts, cached scores are filled in immediately
+
+        :param texts: post texts
+        :return: PendingSentimentScores, call result() for the (pos, neg) score arrays
+        """
+        scores = np.zeros((len(texts), 2), dtype=np.float64)
+        # positions of every distinct text that is not cached, repeated posts are scored once
+        missing_positions: Dict[bytes, List[int]] = OrderedDict()
+        with self._lock:
+            for i, text in enumerate(texts):
+                hash_key = text_hash(text)
+                cached_scores = self._cache.get(hash_key)
+                if cached_scores is None:
+                    missing_positions.setdefault(hash_key, []).append(i)
+                else:
+                    self._cache.move_to_end(hash_key)
+                    scores[i] = cached_scores
+                    self.hits += 1
+            self.misses += len(missing_positions)
+
+        pending_chunks = []
+        missing_hashes = list(missing_positions.keys())
+        for start in range(0, len(missing_hashes), self.chunk_size):
+            chunk_hashes = missing_hashes[start:start + self.chunk_size]
+            chunk_texts = [texts[missing_positions[hash_key][0]] for hash_key in chunk_hashes]
+            future = self._executor.submit(score_texts, chunk_texts) if self._executor is not None \
+                else _CompletedFuture(score_texts(chunk_texts))
+            pending_chunks.append((future, [missing_positions[hash_key] for hash_key in chunk_hashes],
+                                   chunk_hashes))
+        return PendingSentimentScores(self, scores, pending_chunks)
+
+    def score(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (pos scores, neg scores) of the texts
+        """
+        return self.submit(texts).result()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,208 @@
+"""
+Shared-memory hand-off of padded post sequence batches from data loader workers to the training process
+
+A batch of encoded users is a (batch size, posts, 768) float tensor, e.g., 128 x 200 x 768 (~79 MB). Collated in
+a worker and put on the data loader queue, it is copied into a new shared-memory segment per batch. Instead,
+`SharedBatchRing` allocates a fixed ring of shared-memory slots once, before the workers are started:
+
+    - `SharedMemoryBatchCollator` (in a worker) takes a free slot, writes the padded post sequences, the post mask
+      and the metric scores of the batch into it and passes a `SharedBatchSlot` handle (slot and shape) on the
+      queue instead of the tensors
+    - `SharedBatchDataLoader` (in the training process) replaces the handle with views of the slot, so that the
+      model reads the batch without a copy, and gives the slot back once the next batch is requested
+
+Views are contiguous (batch size, longest user, 768) tensors at the start of the slot, padded to the longest user in
+the batch only. Batches too large for a slot are collated as usual. The slots live in /dev/shm, which has to be
+large enough for number of slots x slot size (e.g., --shm-size for docker).
+"""
+import logging
+import multiprocessing
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+
+import torch
+from allennlp.data.data_loaders.data_collator import DataCollator, allennlp_collate
+from allennlp.data.data_loaders.data_loader import DataLoader as AllennlpDataLoader, TensorDict
+from allennlp.data.instance import Instance
+from allennlp.data.vocabulary import Vocabulary
+from allennlp.nn import util as nn_util
+
+logger = logging.getLogger(__name__)
+
+POST_SEQUENCE_FIELD = "post_sequence"
+POST_MASK_FIELD = "post_mask"
+METRIC_SCORES_FIELD = "metric_scores"
+SHARED_FIELDS = [POST_SEQUENCE_FIELD, POST_MASK_FIELD, METRIC_SCORES_FIELD]
+SHARED_SLOT_KEY = "shared_batch_slot"
+
+
+class SharedBatchSlot(object):
+    """
+    handle of a batch written to a slot of a SharedBatchRing, small enough to pass on the data loader queue
+    """
+
+    def __init__(self, slot: int, num_users: int, num_posts: int):
+        self.slot = slot
+        self.num_users = num_users
+        self.num_posts = num_posts
+
+
+class SharedBatchRing(object):
+    """
+    fixed number of reusable shared-memory batch slots, created in the training process before the worker
+    processes are started (forked workers map the same memory)
+    """
+
+    def __init__(self, num_slots: int, max_batch_posts: int, max_batch_users: int, embedding_dim: int = 768,
+                 num_metric_scores: int = 10):
+        """
+        :param num_slots: number of slots, at least 2 (a batch in use and a batch being written)
+        :param max_batch_posts: capacity of a slot, batch size x posts of the longest user in the batch
+        :param max_batch_users: maximum batch size of a slot
+        :param embedding_dim: post embedding dimension
+        :param num_metric_scores: number of metric scores per user
+        """
+        if num_slots < 2:
+            raise ValueError("a shared batch ring needs at least 2 slots, got [%s]" % num_slots)
+        self.num_slots = num_slots
+        self.max_batch_posts = max_batch_posts
+        self.max_batch_users = max_batch_users
+        self.embedding_dim = embedding_dim
+        self.num_metric_scores = num_metric_scores
+        self._post_sequences = torch.zeros(num_slots, max_batch_posts * embedding_dim).share_memory_()
+        self._post_masks = torch.zeros(num_slots, max_batch_posts, dtype=torch.bool).share_memory_()
+        self._metric_scores = torch.zeros(num_slots, max_batch_users * num_metric_scores).share_memory_()
+        # 1 for a slot written by a worker or in use by the training process
+        self._taken = multiprocessing.Array('b', num_slots, lock=False)
+        self._slot_released = multiprocessing.Condition()
+        logger.info("shared batch ring: %s slots of %.1f MB", num_slots,
+                    self._post_sequences[0].numel() * self._post_sequences.element_size() / 2 ** 20)
+
+    def fits(self, num_users: int, num_posts: int) -> bool:
+        return num_users <= self.max_batch_users and num_users * num_posts <= self.max_batch_posts
+
+    def acquire(self) -> int:
+        """
+        take a free slot, waiting until the training process releases one
+        """
+        with self._slot_released:
+            while True:
+                for slot in range(self.num_slots):
+                    if not self._taken[slot]:
+                        self._taken[slot] = 1
+                        return slot
+                self._slot_released.wait()
+
+    def release(self, slot: int):
+        with self._slot_released:
+            self._taken[slot] = 0
+            self._slot_released.notify_all()
+
+    def reset(self):
+        """
+        free all slots, e.g., of workers stopped in the middle of an epoch. Only while no worker is running.
+        """
+        with self._slot_released:
+            for slot in range(self.num_slots):
+                self._taken[slot] = 0
+            self._slot_released.notify_all()
+
+    def tensors(self, handle: SharedBatchSlot) -> Dict[str, torch.Tensor]:
+        """
+        :return: post sequence (batch, posts, dim), post mask (batch, posts) and metric scores (batch, number of
+            scores) views of a slot
+        """
+        num_users, num_posts = handle.num_users, handle.num_posts
+        return {
+            POST_SEQUENCE_FIELD: self._post_sequences[handle.slot, :num_users * num_posts * self.embedding_dim].view(
+                num_users, num_posts, self.embedding_dim),
+            POST_MASK_FIELD: self._post_masks[handle.slot, :num_users * num_posts].view(num_users, num_posts),
+            METRIC_SCORES_FIELD: self._metric_scores[handle.slot, :num_users * self.num_metric_scores].view(
+                num_users, self.num_metric_scores),
+        }
+
+
+@DataCollator.register("shared_memory")
+class SharedMemoryBatchCollator(DataCollator):
+    """
+    collate the post sequence, post mask and metric scores fields of a batch into a slot of a SharedBatchRing,
+    the other fields (user ids, labels) as usual
+    """
+
+    def __init__(self, ring: SharedBatchRing):
+        self.ring = ring
+
+    def __call__(self, instances: List[Instance]) -> TensorDict:
+        post_sequences = [instance.fields[POST_SEQUENCE_FIELD].tensor for instance in instances]
+        num_users, num_posts = len(instances), max(post_sequence.size(0) for post_sequence in post_sequences)
+        if not self.ring.fits(num_users, num_posts):
+            logger.warning("batch of %s users x %s posts does not fit in a shared batch slot, collated with "
+                           "copies", num_users, num_posts)
+            return allennlp_collate(instances)
+
+        handle = SharedBatchSlot(self.ring.acquire(), num_users, num_posts)
+        tensors = self.ring.tensors(handle)
+        for i, (instance, post_sequence) in enumerate(zip(instances, post_sequences)):
+            sequence_length = post_sequence.size(0)
+            tensors[POST_SEQUENCE_FIELD][i, :sequence_length].copy_(post_sequence)
+            tensors[POST_SEQUENCE_FIELD][i, sequence_length:].zero_()
+            tensors[POST_MASK_FIELD][i, :sequence_length] = True
+            tensors[POST_MASK_FIELD][i, sequence_length:] = False
+            tensors[METRIC_SCORES_FIELD][i].copy_(instance.fields[METRIC_SCORES_FIELD].tensor)
+
+        batch = allennlp_collate([Instance({name: field for name, field in instance.fields.items()
+                                            if name not in SHARED_FIELDS}) for instance in instances])
+        batch[SHARED_SLOT_KEY] = handle
+        return batch
+
+
+class SharedBatchDataLoader(AllennlpDataLoader):
+    """
+    wrap a data loader collating with SharedMemoryBatchCollator: batch handles are replaced with views of the
+    shared slots (moved to the target device, if set) and slots are released when the next batch is requested
+    """
+
+    def __init__(self, data_loader: AllennlpDataLoader, ring: SharedBatchRing, release_delay: int = 0):
+        """
+        :param release_delay: number of later batches requested before a slot is released, e.g., the number of
+            gradient accumulation steps - 1
+        """
+        self.data_loader = data_loader
+        self.ring = ring
+        self.release_delay = release_delay
+        self._target_device: Optional[torch.device] = None
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def __iter__(self) -> Iterator[TensorDict]:
+        self.ring.reset()
+        batches = iter(self.data_loader)
+        slots_in_use = deque()
+        try:
+            while True:
+                while len(slots_in_use) > self.release_delay:
+                    self.ring.release(slots_in_use.popleft())
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                handle = batch.pop(SHARED_SLOT_KEY, None)
+                if handle is not None:
+                    batch.update(self.ring.tensors(handle))
+                    slots_in_use.append(handle.slot)
+                if self._target_device is not None:
+                    batch = nn_util.move_to_device(batch, self._target_device)
+                yield batch
+        finally:
+            while slots_in_use:
+                self.ring.release(slots_in_use.popleft())
+
+    def iter_instances(self) -> Iterator[Instance]:
+        return self.data_loader.iter_instances()
+
+    def index_with(self, vocab: Vocabulary) -> None:
+        self.data_loader.index_with(vocab)
+
+    def set_target_device(self, device: torch.device) -> None:
+        # batches are moved after the handles are resolved
+        self._target_device = device
@@ -0,0 +1,91 @@
+"""
+One copy of the frozen encoder weights shared by all processes that encode posts
+
+Every process that calls `AutoModel.from_pretrained` holds its own ~440 MB copy of bert-base-uncased. The encoder
+is frozen, so its weights can be loaded once, set to inference mode without gradients and moved to shared memory
+(`share_memory_encoder`):
+    - forked data loader workers map the same pages (no copy-on-write, weights are never written)
+    - spawned pool workers receive the model through torch.multiprocessing, which passes the shared-memory
+      storages by handle instead of pickling the weights
+
+`MemoryStatus` reads the resident memory of the current process from /proc/self/status, so that the memory a
+worker adds on top of the shared weights can be reported. The peak RSS (VmHWM) can be reset with
+`reset_peak_rss`, e.g., to report it per epoch.
+"""
+import os
+import logging
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+_PROC_STATUS_PATH = "/proc/self/status"
+_PROC_CLEAR_REFS_PATH = "/proc/self/clear_refs"
+_MEMORY_FIELDS = ["VmRSS", "RssAnon", "RssFile", "RssShmem", "VmHWM"]
+
+
+def share_memory_encoder(embedding_model):
+    """
+    freeze a (CPU) encoder for inference and move its weights to shared memory, in place
+
+    :param embedding_model: transformer encoder on CPU
+    :return: the same encoder
+    """
+    embedding_model.eval()
+    embedding_model.requires_grad_(False)
+    embedding_model.share_memory()
+    return embedding_model
+
+
+def memory_status() -> Dict[str, int]:
+    """
+    :return: resident memory of the current process in kB (VmRSS, RssAnon, RssFile, RssShmem, VmHWM), empty if
+        /proc is not available
+    """
+    status = {}
+    try:
+        with open(_PROC_STATUS_PATH) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in _MEMORY_FIELDS:
+                    status[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return status
+
+
+def reset_peak_rss() -> bool:
+    """
+    reset the peak RSS (VmHWM) of the current process to its current RSS (Linux 4.0+)
+
+    :return: False if not supported
+    """
+    try:
+        with open(_PROC_CLEAR_REFS_PATH, "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class MemoryStatus(object):
+    """
+    memory of the current process relative to a baseline (e.g., right after a worker process started)
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.baseline = memory_status()
+
+    def increment(self) -> Dict[str, int]:
+        """
+        :return: increase of every memory field since the baseline, in kB
+        """
+        current = memory_status()
+        return {name: current[name] - self.baseline.get(name, 0) for name in current}
+
+    def report(self) -> str:
+        increment = self.increment()
+        current = memory_status()
+        return "process [%s]: RSS +%.1f MB (private +%.1f MB, shared memory %.1f MB)" % (
+            self.pid, increment.get("VmRSS", 0) / 1024, increment.get("RssAnon", 0) / 1024,
+            current.get("RssShmem", 0) / 1024)
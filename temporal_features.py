@@ -0,0 +1,251 @@
+"""
+Temporal sentiment features of a user's post history (numpy)
+
+The ten features of `calculate_metrics` are computed from the per-post VADER 'pos' and 'neg' scores, for each
+score: mean, standard deviation, entropy, mean momentum of the simple moving average (SMA) and standard deviation
+of the second-order differences of the SMA.
+
+- SMA is computed from a cumulative sum in O(n) instead of O(n * window)
+- the momentum terms (window + 1) * (sma[i - 1] - sma[i]) telescope, so their mean only needs the first and the
+  last window
+- differences of the SMA are (x[i + window] - x[i]) / window, so no moving average is materialised
+- entropy counts the distinct values of a sorted array instead of a Counter of floats
+
+`batch_sentiment_features` computes the same features for many users at once from a padded
+(users, posts) matrix. It pays off for batches of short histories, where per-call overhead dominates; with very
+skewed history lengths most of the matrix is padding.
+"""
+from typing import List
+
+import numpy as np
+
+MOMENTUM_WINDOW = 14
+# users with this number of posts or fewer get all-zero features
+MIN_POSTS_FOR_METRICS = 100
+NUM_SENTIMENT_FEATURES = 10
+
+
+def simple_moving_average(data: np.ndarray, window_size: int) -> np.ndarray:
+    """
+    :return: SMA of the same length as data, the first window_size - 1 positions are 0
+    """
+    data = np.asarray(data, dtype=np.float64)
+    sma = np.zeros(len(data), dtype=np.float64)
+    if len(data) < window_size:
+        return sma
+    cumulative_sum = np.concatenate(([0.0], np.cumsum(data)))
+    sma[window_size - 1:] = (cumulative_sum[window_size:] - cumulative_sum[:-window_size]) / window_size
+    return sma
+
+
+def mean_momentum(data: np.ndarray, window_size: int) -> float:
+    """
+    mean of (window_size + 1) * (sma[i - 1] - sma[i]) over i in [window_size, len(data)),
+        divided by len(data) - (window_size - 1)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    first_sma = data[:window_size].mean()
+    last_sma = data[-window_size:].mean()
+    return float((window_size + 1) * (first_sma - last_sma) / (len(data) - (window_size - 1)))
+
+
+def second_order_differencing(data: np.ndarray, window_size: int) -> np.ndarray:
+    """
+    second-order differences of the SMA (of the valid positions only)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    first_order_differences = (data[window_size:] - data[:-window_size]) / window_size
+    return np.diff(first_order_differences)
+
+
+def entropy(data: np.ndarray) -> float:
+    """
+    entropy (bits) of the distribution of distinct values in data
+    """
+    _, counts = np.unique(np.asarray(data), return_counts=True)
+    probabilities = counts / len(data)
+    return float(-np.sum(probabilities * np.log2(probabilities)))
+
+
+def sentiment_features(pos_scores: np.ndarray, neg_scores: np.ndarray,
+                       window_size: int = MOMENTUM_WINDOW) -> List[float]:
+    """
+    :param pos_scores: VADER 'pos' score per post, in post order
+    :param neg_scores: VADER 'neg' score per post, in post order
+    :return: [mean, std, entropy, mean momentum, std of second-order differences] of pos scores
+        followed by the same features of neg scores, all 0 for users with MIN_POSTS_FOR_METRICS posts or fewer
+    """
+    if len(pos_scores) <= MIN_POSTS_FOR_METRICS:
+        return [0.0] * NUM_SENTIMENT_FEATURES
+    features = []
+    for scores in (np.asarray(pos_scores, dtype=np.float64), np.asarray(neg_scores, dtype=np.float64)):
+        features.extend([float(scores.mean()), float(scores.std()), entropy(scores),
+                         mean_momentum(scores, window_size),
+                         float(np.std(second_order_differencing(scores, window_size)))])
+    return features
+
+
+def _masked_mean_and_std(values: np.ndarray, mask: np.ndarray, counts: np.ndarray):
+    safe_counts = np.maximum(counts, 1)
+    means = np.where(mask, values, 0.0).sum(axis=1) / safe_counts
+    deviations = np.where(mask, values - means[:, None], 0.0)
+    return means, np.sqrt((deviations ** 2).sum(axis=1) / safe_counts)
+
+
+def _batch_entropy(scores: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    num_users, max_length = scores.shape
+    valid = np.arange(max_length)[None, :] < lengths[:, None]
+    # padding is sorted to the end of every row, a run of equal values starts where the value changes
+    sorted_scores = np.sort(np.where(valid, scores, np.inf), axis=1)
+    run_starts = valid.copy()
+    run_starts[:, 1:] &= sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    start_rows, start_positions = np.nonzero(run_starts)
+    # a run ends where the next run of the same row starts, or at the end of the row
+    end_positions = np.append(start_positions[1:], 0)
+    row_ends = np.append(start_rows[1:] != start_rows[:-1], True)
+    end_positions[row_ends] = lengths[start_rows[row_ends]]
+    probabilities = (end_positions - start_positions) / lengths[start_rows]
+    return -np.bincount(start_rows, weights=probabilities * np.log2(probabilities), minlength=num_users)
+
+
+def _batch_score_features(scores: np.ndarray, lengths: np.ndarray, window_size: int) -> np.ndarray:
+    num_users, max_length = scores.shape
+    positions = np.arange(max_length)[None, :]
+    valid = positions < lengths[:, None]
+    means, stds = _masked_mean_and_std(scores, valid, lengths)
+
+    # mean momentum from the first and the last window of every user
+    cumulative_sum = np.concatenate((np.zeros((num_users, 1)), np.cumsum(np.where(valid, scores, 0.0), axis=1)),
+                                    axis=1)
+    rows = np.arange(num_users)
+    ends = np.maximum(lengths, window_size)
+    first_sma = cumulative_sum[:, window_size] / window_size if max_length >= window_size \
+        else np.zeros(num_users)
+    last_sma = (cumulative_sum[rows, np.minimum(ends, max_length)] -
+                cumulative_sum[rows, np.minimum(ends - window_size, max_length)]) / window_size
+    momentums = (window_size + 1) * (first_sma - last_sma) / np.maximum(lengths - (window_size - 1), 1)
+
+    # std of second-order differences of the SMA, valid at positions i < length - window_size - 1
+    if max_length > window_size + 1:
+        first_order_differences = (scores[:, window_size:] - scores[:, :-window_size]) / window_size
+        second_order_differences = np.diff(first_order_differences, axis=1)
+        difference_counts = np.maximum(lengths - window_size - 1, 0)
+        difference_mask = np.arange(second_order_differences.shape[1])[None, :] < difference_counts[:, None]
+        _, difference_stds = _masked_mean_and_std(second_order_differences, difference_mask, difference_counts)
+    else:
+        difference_stds = np.zeros(num_users)
+
+    return np.stack([means, stds, _batch_entropy(scores, lengths), momentums, difference_stds], axis=1)
+
+
+def batch_sentiment_features(pos_scores: np.ndarray, neg_scores: np.ndarray, lengths: np.ndarray,
+                             window_size: int = MOMENTUM_WINDOW) -> np.ndarray:
+    """
+    `sentiment_features` of many users at once
+
+    :param pos_scores: (users, posts) VADER 'pos' scores, padded after each user's lengths[i] posts
+    :param neg_scores: (users, posts) VADER 'neg' scores, padded the same way
+    :param lengths: (users,) number of posts per user
+    :return: (users, 10) float64 features, rows of users with MIN_POSTS_FOR_METRICS posts or fewer are 0
+    """
+    pos_scores = np.asarray(pos_scores, dtype=np.float64)
+    neg_scores = np.asarray(neg_scores, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    features = np.concatenate([_batch_score_features(pos_scores, lengths, window_size),
+                               _batch_score_features(neg_scores, lengths, window_size)], axis=1)
+    features[lengths <= MIN_POSTS_FOR_METRICS] = 0.0
+    return features
+
+
+def pad_score_sequences(score_sequences: List[np.ndarray]) -> (np.ndarray, np.ndarray):
+    """
+    :return: (users, longest sequence) zero-padded matrix and (users,) lengths
+    """
+    lengths = np.array([len(scores) for scores in score_sequences], dtype=np.int64)
+    padded_scores = np.zeros((len(score_sequences), max(lengths, default=0)), dtype=np.float64)
+    for i, scores in enumerate(score_sequences):
+        padded_scores[i, :len(scores)] = scores
+    return padded_scores, lengths
+
+
+class OnlineSentimentFeatures(object):
+    """
+    `sentiment_features` updated post by post in O(1) (amortised), for users whose posts arrive over time
+
+    Keeps running (Welford) mean and variance of the scores and of their second-order SMA differences,
+    counts of distinct score values for the entropy, the first window and the last window_size + 2 scores.
+    """
+
+    def __init__(self, window_size: int = MOMENTUM_WINDOW):
+        self.window_size = window_size
+        self.num_posts = 0
+        self._series = [_OnlineScoreSeries(window_size), _OnlineScoreSeries(window_size)]
+
+    def update(self, pos_scores: np.ndarray, neg_scores: np.ndarray):
+        """
+        :param pos_scores: VADER 'pos' scores of new posts, in post order
+        :param neg_scores: VADER 'neg' scores of new posts, in post order
+        """
+        for series, scores in zip(self._series, (pos_scores, neg_scores)):
+            for score in np.asarray(scores, dtype=np.float64).tolist():
+                series.add(score)
+        self.num_posts += len(pos_scores)
+
+    def features(self) -> List[float]:
+        if self.num_posts <= MIN_POSTS_FOR_METRICS:
+            return [0.0] * NUM_SENTIMENT_FEATURES
+        return self._series[0].features() + self._series[1].features()
+
+
+class _OnlineScoreSeries(object):
+    def __init__(self, window_size: int):
+        self.window_size = window_size
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.value_counts = {}
+        # sum of c * log2(c) over the value counts c
+        self._count_log_count = 0.0
+        self.first_window = []
+        # last window_size + 2 scores, enough for the latest second-order difference
+        self._recent = []
+        self._difference_count = 0
+        self._difference_mean = 0.0
+        self._difference_m2 = 0.0
+
+    def add(self, score: float):
+        window_size = self.window_size
+        self.count += 1
+        delta = score - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (score - self.mean)
+
+        value_count = self.value_counts.get(score, 0)
+        if value_count > 0:
+            self._count_log_count -= value_count * np.log2(value_count)
+        self._count_log_count += (value_count + 1) * np.log2(value_count + 1)
+        self.value_counts[score] = value_count + 1
+
+        if len(self.first_window) < window_size:
+            self.first_window.append(score)
+        self._recent.append(score)
+        if len(self._recent) > window_size + 2:
+            del self._recent[0]
+        if len(self._recent) == window_size + 2:
+            # (sma[i + 2] - sma[i + 1]) - (sma[i + 1] - sma[i]) of the latest SMA positions
+            recent = self._recent
+            difference = ((recent[window_size + 1] - recent[1]) - (recent[window_size] - recent[0])) / window_size
+            self._difference_count += 1
+            difference_delta = difference - self._difference_mean
+            self._difference_mean += difference_delta / self._difference_count
+            self._difference_m2 += difference_delta * (difference - self._difference_mean)
+
+    def features(self) -> List[float]:
+        window_size = self.window_size
+        std = np.sqrt(self._m2 / self.count)
+        entropy_bits = np.log2(self.count) - self._count_log_count / self.count
+        last_window = self._recent[-window_size:]
+        momentum = (window_size + 1) * (np.mean(self.first_window) - np.mean(last_window)) / \
+            (self.count - (window_size - 1))
+        difference_std = np.sqrt(self._difference_m2 / self._difference_count) if self._difference_count else 0.0
+        return [float(self.mean), float(std), float(entropy_bits), float(momentum), float(difference_std)]
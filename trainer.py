@@ -1,4 +1,5 @@
 import os
+import logging
 
 from depression_classifier import model_training
 from data_loader import load_abs_path
@@ -42,6 +43,130 @@ if __name__ == '__main__':
                       default=200)
 
 
+    parser.add_option("--embedding_cache_dir", dest="embedding_cache_dir",
+                      help="directory of the persistent post embedding cache (default: no cache)", default=None)
+
+    parser.add_option("--embedding_cache_size_mb", dest="embedding_cache_size_mb",
+                      help="size cap of the post embedding cache in MB (default 4096)", default=4096)
+
+    parser.add_option("--encoding_batch_size", dest="encoding_batch_size",
+                      help="number of posts per forward pass of the embedding model (default 64)", default=64)
+
+    parser.add_option("--embedding_shard_dir", dest="embedding_shard_dir",
+                      help="directory of precomputed post embedding shards (see precompute_embeddings.py)",
+                      default=None)
+
+    parser.add_option("--head_only", dest="head_only", action="store_true",
+                      help="train the classifier head only on precomputed post sequences from --embedding_shard_dir"
+                           " (the embedding model is never loaded)", default=False)
+
+    parser.add_option("--posts_index", dest="posts_index",
+                      help="path of the persisted index of user post directories "
+                           "(default: <post_dir>/.posts_index.pkl)", default=None)
+
+    parser.add_option("--packed_post_dir", dest="packed_post_dir",
+                      help="read posts from a packed post store (see packed_posts.py) instead of json files",
+                      default=None)
+
+    parser.add_option("--post_loader_workers", dest="post_loader_workers",
+                      help="number of threads loading user posts, posts of the next batch are prefetched (default 8)",
+                      default=8)
+
+    parser.add_option("--posts_cache_size_mb", dest="posts_cache_size_mb",
+                      help="memory budget of the in-process cache of parsed user posts in MB, 0 to disable "
+                           "(default 1024)", default=1024)
+
+    parser.add_option("--max_posts_per_user", dest="max_posts_per_user",
+                      help="maximum number of posts loaded per user, selected while parsing (default: no cap)",
+                      default=None)
+
+    parser.add_option("--post_selection", dest="post_selection",
+                      help="posts kept with --max_posts_per_user: 'recent' (most recent posts) or 'stratified' "
+                           "(time-stratified random sample) (default recent)", default="recent")
+
+    parser.add_option("--sentiment_workers", dest="sentiment_workers",
+                      help="number of processes scoring post sentiments (VADER), 0 to score in the training process "
+                           "(default 4)", default=4)
+
+    parser.add_option("--feature_store", dest="feature_store",
+                      help="SQLite database of per-user metric scores and representative posts, reused across runs "
+                           "(default: in memory, a temporary database with --num_workers)",
+                      default=None)
+
+    parser.add_option("--post_reducer", dest="post_reducer",
+                      help="clustering of users with more than 200 posts: 'kmeans' (scikit-learn KMeans), "
+                           "'minibatch' (MiniBatchKMeans) or 'torch' (vectorised k-means++) (default kmeans)",
+                      default="kmeans")
+
+    parser.add_option("--reducer_projection_dim", dest="reducer_projection_dim",
+                      help="random projection dimension of post embeddings before clustering with the 'torch' "
+                           "reducer (default: no projection)", default=None)
+
+    parser.add_option("--reducer_warm_start", dest="reducer_warm_start", action="store_true",
+                      help="initialise the clustering of every user from its centroids of the previous clustering. "
+                           "Selections of unchanged post sets are reused (in memory, or across runs with "
+                           "--feature_store), so users are only re-clustered, warm-started, once their posts change",
+                      default=False)
+
+    parser.add_option("--warm_start_cache_size_mb", dest="warm_start_cache_size_mb",
+                      help="memory budget of the centroids kept for --reducer_warm_start in MB, ~0.6 MB per user "
+                           "(default 128)", default=128)
+
+    parser.add_option("--reducer_workers", dest="reducer_workers",
+                      help="number of processes clustering the users of a batch, 0 to cluster in the training "
+                           "process (default 0)", default=0)
+
+    parser.add_option("--proxy_selection", dest="proxy_selection",
+                      help="select the representative posts of users with more than 200 posts before encoding from "
+                           "'tfidf' (hashed TF-IDF) or 'minhash' (MinHash) sketches of the post texts, so that only "
+                           "selected posts are encoded (default: cluster all encoded posts)", default=None)
+
+    parser.add_option("--batch_post_budget", dest="batch_post_budget",
+                      help="batch users with similar numbers of posts (from the posts index, packed post store or "
+                           "embedding shards), up to this batch size x posts of the heaviest user in the batch "
+                           "(default: batches of 128 users)", default=None)
+
+    parser.add_option("--num_workers", dest="num_workers",
+                      help="number of data loader worker processes loading, scoring and encoding (on CPU) the posts "
+                           "of the users, 0 to encode in the training process (default 0)", default=0)
+
+    parser.add_option("--shared_batch_slots", dest="shared_batch_slots",
+                      help="number of shared-memory slots the data loader workers write padded batches into, "
+                           "0 to pass batches on the data loader queue (default: number of workers + 2)",
+                      default=None)
+
+    parser.add_option("--instrumentation", dest="instrumentation", action="store_true",
+                      help="time the pipeline stages (post load, sentiment scoring, encoding, clustering, sort, pad, "
+                           "attention, feedforward) and count users, posts and tokens per batch and epoch",
+                      default=False)
+
+    parser.add_option("--log_level", dest="log_level",
+                      help="logging level, e.g., DEBUG for the per-batch shapes and stage timings "
+                           "(default: logging not configured)", default=None)
+
+    parser.add_option("--run_log", dest="run_log",
+                      help="json lines file the throughput (users/posts/tokens per second), memory and data wait "
+                           "vs compute time of every epoch are appended to, e.g., gradient_descent/run_log.jsonl; "
+                           "implies --instrumentation (default: no run log)",
+                      default=None)
+
+    parser.add_option("--profile", dest="profile", action="store_true",
+                      help="profile training steps with torch.profiler, Chrome traces and stack summaries are "
+                           "written to gradient_descent/profiler", default=False)
+
+    parser.add_option("--profile_wait", dest="profile_wait",
+                      help="training steps skipped before every profiled window (default 1)", default=1)
+
+    parser.add_option("--profile_warmup", dest="profile_warmup",
+                      help="training steps profiled and discarded before every recorded window (default 1)",
+                      default=1)
+
+    parser.add_option("--profile_active", dest="profile_active",
+                      help="training steps recorded per profiled window (default 3)", default=3)
+
+    parser.add_option("--profile_repeat", dest="profile_repeat",
+                      help="number of profiled windows, 0 to profile until training ends (default 1)", default=1)
+
     options, args = parser.parse_args()
 
     train_set_path = options.trainset
@@ -53,6 +178,31 @@ if __name__ == '__main__':
 
     num_epochs = int(options.num_epochs)
     max_post_size_option = int(options.max_post_size_option)
+    embedding_cache_dir = options.embedding_cache_dir
+    embedding_cache_size_mb = float(options.embedding_cache_size_mb)
+    encoding_batch_size = int(options.encoding_batch_size)
+    embedding_shard_dir = options.embedding_shard_dir
+    head_only = options.head_only
+    post_loader_workers = int(options.post_loader_workers)
+    posts_cache_size_mb = float(options.posts_cache_size_mb)
+    max_posts_per_user = int(options.max_posts_per_user) if options.max_posts_per_user else None
+    post_selection = options.post_selection
+    sentiment_workers = int(options.sentiment_workers)
+    feature_store_path = options.feature_store
+    post_reducer = options.post_reducer
+    reducer_projection_dim = int(options.reducer_projection_dim) if options.reducer_projection_dim else None
+    reducer_warm_start = options.reducer_warm_start
+    warm_start_cache_size_mb = float(options.warm_start_cache_size_mb)
+    reducer_workers = int(options.reducer_workers)
+    proxy_selection = options.proxy_selection
+    batch_post_budget = int(options.batch_post_budget) if options.batch_post_budget else None
+    num_workers = int(options.num_workers)
+    shared_batch_slots = int(options.shared_batch_slots) if options.shared_batch_slots is not None else None
+    instrumentation_enabled = options.instrumentation
+    log_level = options.log_level
+    run_log_path = options.run_log
+    profile_schedule = (int(options.profile_wait), int(options.profile_warmup), int(options.profile_active),
+                        int(options.profile_repeat)) if options.profile else None
 
     print("================= model settings ========================")
     print("trainset file path: ", train_set_path)
@@ -64,8 +214,38 @@ if __name__ == '__main__':
 
     print("num_epochs: ", num_epochs)
     print("max_post_size_option: ", max_post_size_option)
+    print("embedding cache dir: ", embedding_cache_dir)
+    print("embedding cache size (MB): ", embedding_cache_size_mb)
+    print("encoding batch size: ", encoding_batch_size)
+    print("embedding shard dir: ", embedding_shard_dir)
+    print("head-only training: ", head_only)
+    print("post loader workers: ", post_loader_workers)
+    print("posts cache size (MB): ", posts_cache_size_mb)
+    print("max posts per user: ", max_posts_per_user)
+    print("post selection: ", post_selection)
+    print("sentiment workers: ", sentiment_workers)
+    print("feature store: ", feature_store_path)
+    print("post reducer: ", post_reducer)
+    print("reducer projection dim: ", reducer_projection_dim)
+    print("reducer warm start: ", reducer_warm_start)
+    print("warm start cache size (MB): ", warm_start_cache_size_mb)
+    print("reducer workers: ", reducer_workers)
+    print("proxy selection: ", proxy_selection)
+    print("batch post budget: ", batch_post_budget)
+    print("data loader workers: ", num_workers)
+    print("shared batch slots: ", shared_batch_slots)
+    print("instrumentation: ", instrumentation_enabled)
+    print("log level: ", log_level)
+    print("run log: ", run_log_path)
+    print("profile schedule (wait, warmup, active, repeat): ", profile_schedule)
     print("============================================================")
 
+    if log_level:
+        logging.basicConfig(level=log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if instrumentation_enabled:
+        import instrumentation
+        instrumentation.enable()
+
     if no_gpu != -1:
         # check GPU device usage and help to set suitable GPU device
         print("================================ check current GPU usage =============================")
@@ -102,12 +282,60 @@ if __name__ == '__main__':
 
     print("post data directory is set to [%s]" % data_loader.post_data_dir)
 
+    if options.posts_index:
+        data_loader.posts_index_path = options.posts_index
+    if post_selection not in data_loader.POST_SELECTIONS:
+        raise ValueError("unknown post selection [%s], expected one of %s" % (
+            post_selection, data_loader.POST_SELECTIONS))
+    from post_reduction import REDUCERS
+    if post_reducer not in REDUCERS:
+        raise ValueError("unknown post reducer [%s], expected one of %s" % (post_reducer, REDUCERS))
+    from proxy_selection import PROXY_SELECTIONS
+    if proxy_selection and proxy_selection not in PROXY_SELECTIONS:
+        raise ValueError("unknown proxy selection [%s], expected one of %s" % (proxy_selection, PROXY_SELECTIONS))
+    if proxy_selection and head_only:
+        raise ValueError("--proxy_selection selects posts before encoding, it cannot be used with --head_only "
+                         "(posts are already encoded in the embedding shards)")
+    data_loader.max_posts_per_user = max_posts_per_user
+    data_loader.post_selection = post_selection
+    if options.packed_post_dir:
+        from packed_posts import PackedPostStore
+        data_loader.packed_post_store = PackedPostStore(options.packed_post_dir)
+        print("posts are read from packed post store [%s]" % options.packed_post_dir)
+    else:
+        # build (or refresh) the index of user post directories once, before data loader workers are started
+        data_loader.load_posts_dataset_index(post_data_dir)
+        if posts_cache_size_mb > 0:
+            data_loader.user_posts_cache = data_loader.UserPostsCache(int(posts_cache_size_mb * 1024 * 1024))
+
 
     train_batch_size = 128
 
 
-    print("model training in batches [size: %s]" % train_batch_size)
+    if batch_post_budget:
+        print("model training in batches [post budget: %s]" % batch_post_budget)
+    else:
+        print("model training in batches [size: %s]" % train_batch_size)
     model_training(train_set_path, heldout_set_path, evaluation_data_path, no_gpu, train_batch_size,
                    model_file_prefix,
                    num_epochs=num_epochs,
-                   max_post_size_option=max_post_size_option)
\ No newline at end of file
+                   max_post_size_option=max_post_size_option,
+                   embedding_cache_dir=embedding_cache_dir,
+                   embedding_cache_size_mb=embedding_cache_size_mb,
+                   encoding_batch_size=encoding_batch_size,
+                   embedding_shard_dir=embedding_shard_dir,
+                   head_only=head_only,
+                   post_loader_workers=post_loader_workers,
+                   sentiment_workers=sentiment_workers,
+                   feature_store_path=feature_store_path,
+                   post_reducer=post_reducer,
+                   reducer_projection_dim=reducer_projection_dim,
+                   reducer_warm_start=reducer_warm_start,
+                   warm_start_cache_size_mb=warm_start_cache_size_mb,
+                   reducer_workers=reducer_workers,
+                   proxy_selection=proxy_selection,
+                   batch_post_budget=batch_post_budget,
+                   num_workers=num_workers,
+                   shared_batch_slots=shared_batch_slots,
+                   run_log_path=run_log_path,
+                   profile_schedule=profile_schedule)
\ No newline at end of file
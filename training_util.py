@@ -301,8 +301,7 @@ def evaluate(model: Model,
         all_labels = []
 
         for batch in generator_tqdm:
-            print("PRINTING BATCH.....")
-            print(batch)
+            logger.debug("batch: %s", batch)
             batch_count += 1
             batch = nn_util.move_to_device(batch, cuda_device)
             output_dict = model(**batch)
@@ -347,10 +346,10 @@ def evaluate(model: Model,
                 incorrect_indices = incorrect_indices[0]
                 if len(incorrect_indices) > 0:
                     # Convert indices to absolute indices in the dataset
-                    print(incorrect_indices)
+                    logger.debug("misclassified indices: %s", incorrect_indices)
                     misclassified_user_ids = [
                         batch['user_id'][idx] for idx in incorrect_indices]
-                    print("Misclassified:", misclassified_user_ids)
+                    logger.debug("Misclassified: %s", misclassified_user_ids)
                     misclassified_instances.extend(misclassified_user_ids)
                 # Report the average loss so far.
                 all_predictions.extend(predicted_labels)